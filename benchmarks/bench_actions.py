@@ -0,0 +1,177 @@
+"""Load test of the action coordinator: relay presses under concurrent spam.
+
+The bot runs against the fake Bot API and a simulated host (see
+bench_e2e.py). One chat starts a boot of Ubuntu, then --chats chats tap the
+same button on their own keyboard --taps times each, mixed with /power_switch
+and /reset_switch commands, all at once while the boot runs. Once the host
+is up the same chats spam the force_shutdown Yes button.
+
+Counts the relay presses of the simulated host, which should be one power
+pulse for the boot and one hold for the shutdown however many taps there
+are, the taps that joined the running action, and the latency of answering
+a duplicate tap. With --uncoordinated every request starts its action, as
+before the coordinator, for comparison.
+
+Usage:
+    python3 benchmarks/bench_actions.py --chats 10 --taps 5
+    python3 benchmarks/bench_actions.py --uncoordinated
+"""
+import argparse
+import itertools
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_host import FakeHost  # noqa: E402
+from benchmarks.fake_telegram import FakeTelegramAPI, callback_update, command_update  # noqa: E402
+from bot.actions import STARTED, Action, ActionCoordinator, ActionRequest  # noqa: E402
+from bot.suckerfish_bot import SuckerfishBot  # noqa: E402
+from utils.metrics import REGISTRY  # noqa: E402
+
+TOKEN = '123456:fake-token'
+FIRST_CHAT = 1000
+
+
+class Uncoordinated(ActionCoordinator):
+    """Starts every action requested, like the handlers did before"""
+
+    def request(self, kind, start, key=None, requester=None) -> ActionRequest:
+        action = Action(kind, key)
+        inner = start()
+        if inner is None:
+            action.future.set_result(None)
+        else:
+            inner.add_done_callback(action._complete)
+        return ActionRequest(STARTED, action)
+
+
+def spam(api: FakeTelegramAPI, data: str, chats: int, taps: int, commands: List[str],
+         update_ids: itertools.count) -> List[int]:
+    """Push taps on data from every chat, interleaved with the commands, returns the query ids"""
+    query_ids = []
+    for tap in range(taps):
+        for chat in range(chats):
+            query_id = next(update_ids)
+            query_ids.append(query_id)
+            api.push_update(callback_update(data, FIRST_CHAT + 1 + chat, update_id=query_id))
+        for command in commands:
+            api.push_update(command_update(command, FIRST_CHAT, update_id=next(update_ids)))
+    return query_ids
+
+
+def answer_latencies(api: FakeTelegramAPI, query_ids: List[int], pushed_at: float, timeout: float) -> List[float]:
+    ids = set(str(query_id) for query_id in query_ids)
+    match = lambda params: str(params.get('callback_query_id')) in ids
+    calls = api.wait_calls('answerCallbackQuery', len(ids), timeout=timeout, match=match)
+    return [call[0] - pushed_at for call in calls]
+
+
+def edits(api: FakeTelegramAPI, text: str, since: int = 0, count: int = 1, timeout: float = 10) -> int:
+    match = lambda params: params.get('text') == text
+    return len(api.wait_calls('editMessageText', count, since, timeout=timeout, match=match))
+
+
+def report(name: str, latencies: List[float]) -> None:
+    if not latencies:
+        print(f"  {name:<22} no answers")
+        return
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"  {name:<22} n={len(latencies):<4} p50 {statistics.median(latencies) * 1000:6.1f} ms  "
+          f"p99 {p99 * 1000:6.1f} ms")
+
+
+def coordinator_cost(requests: int = 100000) -> float:
+    """Seconds per request joining a running action"""
+    coordinator = ActionCoordinator('bench')
+    # Never resolves, so every later request joins it
+    coordinator.request('boot', Future, key='Ubuntu')
+    t_start = time.perf_counter()
+    for i in range(requests):
+        coordinator.request('boot', Future, key='Ubuntu', requester=i % 10)
+    return (time.perf_counter() - t_start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=10, help="Chats tapping the buttons.")
+    parser.add_argument("--taps", type=int, default=5, help="Taps of each chat on its button.")
+    parser.add_argument("--commands", type=int, default=2, help="/power_switch and /reset_switch after each tap round.")
+    parser.add_argument("--boot-time", type=float, default=1.0, help="Seconds the simulated host takes to boot.")
+    parser.add_argument("--uncoordinated", action="store_true", help="Start an action for every request.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    api = FakeTelegramAPI().start()
+    fake = FakeHost(boot_time=args.boot_time, hold_threshold=0.1).start()
+    host_config = {
+        'name': 'pc0', 'host_ip': '127.0.0.1', 'host_username': 'user',
+        'host_password': 'password', 'power_pin': fake.power_pin, 'reset_pin': fake.reset_pin,
+        'ssh_port': fake.ssh.port, 'pulse_time': 0.02, 'hold_time': 0.2,
+        'probe_interval': 0.02, 'monitor_interval': 0.5, 'monitor_ttl': 5,
+        'prober': fake.prober(timeout=0.05), 'pin_factory': fake.pin_factory,
+    }
+    commands = ['/power_switch', '/reset_switch'] * args.commands
+    update_ids = itertools.count(1)
+    timeout = 10 + args.boot_time * 4
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        bot = SuckerfishBot(TOKEN, [host_config], state_dir=state_dir, notify_host_changes=False,
+                            base_url=api.base_url)
+        host = bot.fleet.get('pc0')
+        if args.uncoordinated:
+            host.actions = Uncoordinated('pc0')
+        bot.start()
+
+        print(f"{'uncoordinated' if args.uncoordinated else 'coordinated'}, "
+              f"{args.chats} chats x {args.taps} taps, {len(commands) * args.taps} switch commands")
+
+        # Boot, everybody taps Ubuntu while it runs
+        since = len(api.calls)
+        api.push_update(callback_update('power_on_pc0:Ubuntu', FIRST_CHAT, update_id=next(update_ids)))
+        api.wait_call('editMessageText', since, timeout=timeout)
+        t_start = time.perf_counter()
+        query_ids = spam(api, 'power_on_pc0:Ubuntu', args.chats, args.taps, commands, update_ids)
+        boot_answers = answer_latencies(api, query_ids, t_start, timeout)
+        booted = edits(api, 'Ubuntu booted', since, 1 + args.chats, timeout)
+        boot_presses = dict(fake.presses)
+        time.sleep(0.5)
+
+        # Force shutdown, everybody taps Yes
+        since = len(api.calls)
+        t_start = time.perf_counter()
+        query_ids = spam(api, 'force_shutdown_pc0:yes', args.chats, args.taps, [], update_ids)
+        shutdown_answers = answer_latencies(api, query_ids, t_start, timeout)
+        done = edits(api, 'Done', since, args.chats, timeout)
+        time.sleep(0.5)
+        shutdown_presses = {switch: fake.presses[switch] - boot_presses[switch] for switch in fake.presses}
+
+        bot.updater.stop()
+        for lane in set(bot.lanes.values()):
+            lane.shutdown()
+        bot.fleet.stop()
+        bot.ssh_pool.close_all()
+    fake.stop()
+    api.stop()
+
+    print(f"  boot      relay presses {boot_presses}, {booted} messages show 'Ubuntu booted'")
+    print(f"  shutdown  relay presses {shutdown_presses}, {done} messages show 'Done'")
+    report('boot taps answered', boot_answers)
+    report('shutdown taps answered', shutdown_answers)
+    for line in REGISTRY.summary().splitlines():
+        if line.startswith('suckerfish_actions'):
+            print(f"  {line}")
+    print(f"  joining a running action: {coordinator_cost() * 1e6:.2f} us per request")
+
+
+if __name__ == "__main__":
+    main()
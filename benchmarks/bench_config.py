@@ -0,0 +1,116 @@
+"""Cost of the chat ACL check and latency of the config reload.
+
+The ACL check of every restricted update is timed as it was, the chat id
+turned into a string and searched in the allowed_chats list, and as the
+compiled bot.acl.ChatACL does it, one lookup in a frozenset, for ACLs of
+growing size. The chat asking is the last of the list, the worst case of
+the scan.
+
+The reload is timed from the config file being saved, written to a
+temporary file renamed in place as editors do, to the new config being
+handed to the bot, with inotify and with the stat polling used where
+inotify is missing. The file is loaded and validated with get_config.
+
+Usage:
+    python3 benchmarks/bench_config.py
+    python3 benchmarks/bench_config.py --chats 1 10 1000 10000 --reloads 20 --debounce 0.05
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bot.acl import ChatACL  # noqa: E402
+from utils.config import get_config  # noqa: E402
+from utils.config_watcher import ConfigWatcher  # noqa: E402
+
+
+def bench_acl(sizes, number: int) -> None:
+    print(f"ACL check, ns per update ({number} checks)\n")
+    print(f"{'chats':>8}{'list':>12}{'ChatACL':>12}{'denied list':>14}{'denied ACL':>12}")
+    for size in sizes:
+        allowed_chats = [str(1000 + i) for i in range(size)]
+        acl = ChatACL(allowed_chats)
+        allowed, denied = 1000 + size - 1, 1
+        timings = [
+            timeit.timeit(lambda: allowed_chats is None or str(allowed) in allowed_chats, number=number),
+            timeit.timeit(lambda: acl.allows(allowed), number=number),
+            timeit.timeit(lambda: allowed_chats is None or str(denied) in allowed_chats, number=number),
+            timeit.timeit(lambda: acl.allows(denied), number=number),
+        ]
+        print(f"{size:>8}" + ''.join(f"{t / number * 1e9:>{w}.0f}" for t, w in zip(timings, (12, 12, 14, 12))))
+
+
+def config_file(path: str, allowed_chats: list) -> None:
+    """Save a config the way editors do, a new file renamed in place"""
+    config = {
+        'telegram_api': {'bot_token': '123456:fake-token', 'allowed_chats': allowed_chats},
+        'host_pc': {'local_ip': '127.0.0.1', 'username': 'user', 'password': 'password'},
+        'pin_wiring': {'power_pin': 21, 'reset_pin': 20},
+        'logging': {'dev_chat_id': '1', 'dev_bot_token': '123456:fake-token', 'log_file': 'bot.log',
+                    'chat_log_level': 'error', 'file_log_level': 'info'},
+    }
+    with open(f'{path}.tmp', 'w') as f:
+        yaml.safe_dump(config, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def bench_reload(use_inotify: bool, reloads: int, poll_interval: float, debounce: float) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'config.yaml')
+        config_file(path, ['0'])
+        applied = []
+        changed = threading.Condition()
+
+        def on_change(config: tuple) -> None:
+            with changed:
+                applied.append((time.perf_counter(), config[0]['allowed_chats']))
+                changed.notify_all()
+
+        watcher = ConfigWatcher(path, get_config, on_change, poll_interval=poll_interval,
+                                debounce=debounce, use_inotify=use_inotify)
+        watcher.start()
+        name = 'inotify' if watcher.inotify else f'polling every {poll_interval:g} s'
+        latencies = []
+        for i in range(1, reloads + 1):
+            t_saved = time.perf_counter()
+            config_file(path, [str(i)])
+            with changed:
+                if not changed.wait_for(lambda: applied and applied[-1][1] == [str(i)], timeout=poll_interval + 5):
+                    print(f"{name}: reload {i} was never applied")
+                    break
+            latencies.append(applied[-1][0] - t_saved)
+        watcher.stop()
+
+    if latencies:
+        print(f"{name:<24}{statistics.median(latencies) * 1000:>10.0f}{max(latencies) * 1000:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, nargs='+', default=[1, 10, 1000], help="Sizes of the ACL.")
+    parser.add_argument("--checks", type=int, default=200000, help="ACL checks timed per size.")
+    parser.add_argument("--reloads", type=int, default=10, help="Saves of the config file per watcher.")
+    parser.add_argument("--poll-interval", type=float, default=2, help="Seconds between stat polls.")
+    parser.add_argument("--debounce", type=float, default=0.2, help="Seconds the saves settle before loading.")
+    args = parser.parse_args()
+
+    bench_acl(args.chats, args.checks)
+    print(f"\nReload latency from save to applied, ms (debounce {args.debounce:g} s)\n")
+    print(f"{'':<24}{'median':>10}{'max':>10}")
+    bench_reload(True, args.reloads, args.poll_interval, args.debounce)
+    bench_reload(False, args.reloads, args.poll_interval, args.debounce)
+
+
+if __name__ == "__main__":
+    main()
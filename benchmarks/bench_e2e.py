@@ -0,0 +1,298 @@
+"""End-to-end benchmark of the bot against hermetic stand-ins.
+
+The bot runs unchanged against a local fake Bot API, simulated PCs on mock
+relays and fake ssh servers on the loopback (see fake_host.py), so a run
+covers the whole path of a command, from long polling through the
+dispatcher, handlers, GPIO pulses, probes and the ssh boot steps, without
+any network or hardware. Pulses and boots are scaled down to milliseconds.
+
+Every host gets a simulated user repeating is_online, power_on (alternating
+Ubuntu and Windows, picked from the keyboard built from the grub menu, which
+arms grub over ssh), force_shutdown and waiting
+for the host to be seen offline. A burst of is_online commands then
+measures the command throughput. Reports the p50/p99 latency of every step
+from the update being handed to the API until the bot's answer, and how
+many threads of each kind were alive and busy in bot code.
+
+With --arm-at-shutdown Windows is armed before every forced shutdown (when
+Ubuntu runs), so its boots are a single power pulse, see /next_boot.
+
+Usage:
+    python3 benchmarks/bench_e2e.py --hosts 4 --rounds 6
+    python3 benchmarks/bench_e2e.py --arm-at-shutdown
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_host import FakeHost  # noqa: E402
+from benchmarks.fake_telegram import FakeTelegramAPI, callback_update, command_update  # noqa: E402
+from utils.metrics import REGISTRY  # noqa: E402
+
+if TYPE_CHECKING:
+    from bot.suckerfish_bot import SuckerfishBot
+
+TOKEN = '123456:fake-token'
+BURST_CHAT = 999
+
+# Innermost frames of a thread parked waiting for work
+IDLE_FILES = ('threading.py', 'queue.py', 'selectors.py', 'socketserver.py')
+REPO_DIRS = tuple(os.path.join(ROOT, folder) + os.sep for folder in ('bot', 'utils'))
+
+
+class ThreadSampler:
+    """Samples every thread's stack to tell how many are alive and busy in bot code"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self.alive: Dict[str, List[int]] = defaultdict(list)
+        self.busy: Dict[str, int] = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='thread_sampler', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    @staticmethod
+    def group(name: str) -> str:
+        # Thread names carry counters and uuids
+        return re.sub(r'[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}|\d+', 'N', name)
+
+    @staticmethod
+    def is_busy(frame) -> bool:
+        if frame is None or frame.f_code.co_filename.endswith(IDLE_FILES):
+            return False
+        while frame is not None:
+            if frame.f_code.co_filename.startswith(REPO_DIRS):
+                return True
+            frame = frame.f_back
+        return False
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            counts: Dict[str, int] = defaultdict(int)
+            for thread in threading.enumerate():
+                if thread.ident == me:
+                    continue
+                group = self.group(thread.name)
+                counts[group] += 1
+                if self.is_busy(frames.get(thread.ident)):
+                    self.busy[group] += 1
+            for group in set(counts) | set(self.alive):
+                self.alive[group].append(counts.get(group, 0))
+            self.samples += 1
+
+    def report(self) -> None:
+        print(f"\n{'threads':<36} {'max':>5} {'mean':>6} {'busy':>7}")
+        total = [sum(column) for column in itertools.zip_longest(*self.alive.values(), fillvalue=0)]
+        for group, counts in sorted(self.alive.items()):
+            occupied = sum(counts)
+            busy = self.busy[group] / occupied if occupied else 0
+            print(f"{group[:36]:<36} {max(counts):>5} {statistics.mean(counts):>6.2f} {busy:>6.1%}")
+        if total:
+            print(f"{'total':<36} {max(total):>5} {statistics.mean(total):>6.2f}")
+
+
+class Latencies:
+    """Latencies of every step, appended from the user threads"""
+
+    def __init__(self):
+        self.steps: Dict[str, List[float]] = defaultdict(list)
+
+    def add(self, step: str, latency: float) -> None:
+        self.steps[step].append(latency)
+
+    def report(self) -> None:
+        print(f"{'step':<24} {'n':>5} {'p50':>10} {'p99':>10} {'max':>10}")
+        for step, latencies in self.steps.items():
+            latencies = sorted(latencies)
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(f"{step:<24} {len(latencies):>5} {statistics.median(latencies) * 1000:>7.1f} ms "
+                  f"{p99 * 1000:>7.1f} ms {latencies[-1] * 1000:>7.1f} ms")
+
+
+class User:
+    """A chat driving one host through its commands"""
+
+    update_ids = itertools.count(1)
+
+    def __init__(self, api: FakeTelegramAPI, bot: 'SuckerfishBot', name: str,
+                 chat_id: int, latencies: Latencies, timeout: float = 30):
+        self.api = api
+        self.host = bot.fleet.get(name)
+        self.name = name
+        self.chat_id = chat_id
+        self.latencies = latencies
+        self.timeout = timeout
+        self.error: Optional[Exception] = None
+
+    def in_chat(self, match: Optional[Callable[[dict], bool]] = None) -> Callable[[dict], bool]:
+        return lambda params: (str(params.get('chat_id')) == str(self.chat_id)
+                               and (match is None or match(params)))
+
+    def send(self, update: dict, *waits) -> dict:
+        """Push an update and time each (step, method, match) answer from the bot
+
+        Returns:
+            dict: The params of the last answer.
+        """
+        since = len(self.api.calls)
+        t_start = time.perf_counter()
+        self.api.push_update(update)
+        for step, method, match in waits:
+            call = self.api.wait_call(method, since, self.timeout, match)
+            if call is None:
+                raise RuntimeError(f"{self.name}: no {method} for {step}")
+            self.latencies.add(step, call[0] - t_start)
+        return call[2]
+
+    def command(self, step: str, text: str, match: Optional[Callable[[dict], bool]] = None) -> dict:
+        return self.send(command_update(text, self.chat_id),
+                         (step, 'sendMessage', self.in_chat(match)))
+
+    def press(self, step: str, data: str, done_text: str) -> None:
+        query_id = next(self.update_ids)
+        self.send(callback_update(data, self.chat_id, update_id=query_id),
+                  ('answer callback', 'answerCallbackQuery',
+                   lambda params: str(params.get('callback_query_id')) == str(query_id)),
+                  (step, 'editMessageText', self.in_chat(lambda params: params.get('text') == done_text)))
+
+    def wait_offline(self) -> None:
+        deadline = time.monotonic() + self.timeout
+        while self.host.monitor.state is None or self.host.monitor.state.online:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{self.name}: the monitor never saw the host go offline")
+            time.sleep(0.005)
+
+    def run(self, rounds: int) -> None:
+        has_keyboard = lambda params: 'reply_markup' in params
+        try:
+            for i in range(rounds):
+                os_name = 'Windows' if i % 2 else 'Ubuntu'
+                self.command('is_online', f'/is_online {self.name}')
+                answer = self.command('power_on keyboard', f'/power_on {self.name}', has_keyboard)
+                buttons = [button for row in json.loads(answer['reply_markup'])['inline_keyboard']
+                           for button in row if os_name in button['text']]
+                if not buttons:
+                    raise RuntimeError(f"{self.name}: no {os_name} in the power_on keyboard")
+                self.press(f'boot {os_name}', buttons[0]['callback_data'], f"{buttons[0]['text']} booted")
+                self.command('force_shutdown keyboard', f'/force_shutdown {self.name}', has_keyboard)
+                self.press('force shutdown', f'force_shutdown_{self.name}:yes', 'Done')
+                self.wait_offline()
+        except Exception as e:
+            self.error = e
+
+
+def burst(api: FakeTelegramAPI, name: str, commands: int) -> float:
+    """Push commands is_online at once, returns the commands answered per second"""
+    match = lambda params: str(params.get('chat_id')) == str(BURST_CHAT)
+    since = len(api.calls)
+    t_start = time.perf_counter()
+    for _ in range(commands):
+        api.push_update(command_update(f'/is_online {name}', BURST_CHAT))
+    calls = api.wait_calls('sendMessage', commands, since, timeout=60, match=match)
+    if len(calls) < commands:
+        raise RuntimeError(f"Only {len(calls)} of {commands} commands were answered")
+    return commands / (calls[-1][0] - t_start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, default=4, help="Simulated hosts, one user each.")
+    parser.add_argument("--rounds", type=int, default=6, help="Boot and shutdown rounds per user.")
+    parser.add_argument("--burst", type=int, default=500, help="is_online commands of the throughput burst.")
+    parser.add_argument("--boot-time", type=float, default=0.2, help="Seconds a simulated host takes to boot.")
+    parser.add_argument("--pulse-time", type=float, default=0.02, help="Seconds the switches are pressed.")
+    parser.add_argument("--hold-time", type=float, default=0.2, help="Seconds the power switch is held.")
+    parser.add_argument("--arm-at-shutdown", action="store_true", help="Arm Windows before each forced shutdown.")
+    parser.add_argument("--armed-check-timeout", type=float, default=0.1,
+                        help="Seconds to look for Ubuntu after booting the armed Windows.")
+    parser.add_argument("--metrics", action="store_true", help="Also print the bot's own metrics summary.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # Imported here, bench_runtimes.py measures the runtimes without it
+    from bot.suckerfish_bot import SuckerfishBot
+
+    api = FakeTelegramAPI().start()
+    fakes = [FakeHost(boot_time=args.boot_time, hold_threshold=args.hold_time / 2).start()
+             for _ in range(args.hosts)]
+    host_configs = [{
+        'name': f'pc{i}', 'host_ip': '127.0.0.1', 'host_username': 'user',
+        'host_password': 'password', 'power_pin': fake.power_pin, 'reset_pin': fake.reset_pin,
+        'windows_entry_id': 1, 'ssh_port': fake.ssh.port,
+        'pulse_time': args.pulse_time, 'hold_time': args.hold_time,
+        'probe_interval': 0.02, 'monitor_interval': 0.5, 'monitor_max_interval': 2, 'monitor_ttl': 5,
+        'prober': fake.prober(timeout=0.05), 'pin_factory': fake.pin_factory,
+        'arm_at_shutdown': 'Windows' if args.arm_at_shutdown else None,
+        'armed_check_timeout': args.armed_check_timeout,
+    } for i, fake in enumerate(fakes)]
+
+    sampler = ThreadSampler()
+    with tempfile.TemporaryDirectory() as state_dir:
+        # The burst measures throughput, queue all of it rather than shedding
+        bot = SuckerfishBot(TOKEN, host_configs, state_dir=state_dir,
+                            notify_host_changes=False, base_url=api.base_url,
+                            lanes={'instant': {'queue': args.burst}},
+                            # Keep the public ip lookup off the internet
+                            network={'providers': [f'{api.base_url}/ip'], 'timeout': 0.1})
+        bot.start()
+        sampler.start()
+
+        latencies = Latencies()
+        users = [User(api, bot, f'pc{i}', 1000 + i, latencies) for i in range(args.hosts)]
+        threads = [threading.Thread(target=user.run, args=(args.rounds,), name=f'user_{user.name}')
+                   for user in users]
+        t_start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - t_start
+        throughput = burst(api, 'pc0', args.burst)
+
+        sampler.stop()
+        bot.updater.stop()
+        bot.fleet.stop()
+        bot.ssh_pool.close_all()
+    for fake in fakes:
+        fake.stop()
+    api.stop()
+
+    for user in users:
+        if user.error is not None:
+            print(f"{user.name} failed: {user.error}")
+    boots = sum(fake.boots for fake in fakes)
+    presses = sum(sum(fake.presses.values()) for fake in fakes)
+    print(f"{args.hosts} hosts x {args.rounds} rounds in {elapsed:.2f} s: "
+          f"{boots} boots, {presses} relay presses, {len(api.calls)} API calls\n")
+    latencies.report()
+    print(f"\nthroughput: {throughput:.0f} is_online commands/s over a burst of {args.burst}")
+    sampler.report()
+    if args.metrics:
+        print(f"\n{REGISTRY.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Latency of the OS fingerprint of a host, concurrent against one port at a time.
+
+Each scenario is a host on the loopback with its own services: listeners
+answering like an ssh server (the version line) or accepting like RDP and
+GameStream, closed ports refusing the connection, and filtered ones whose
+SYNs are dropped, from a listener with a full accept queue. The same host
+is fingerprinted by the OSFingerprinter of the bot (every port at once on
+one select), by its asyncio version and by connecting to one port after
+the other with the same timeout, as a naive fingerprint would.
+
+- linux: sshd of Ubuntu, no RDP nor GameStream,
+- windows: RDP and GameStream open, ssh filtered by the firewall,
+- gamestream: only GameStream answers, ssh and RDP filtered,
+- no services: up but every port refused,
+- offline: nothing answers, as an offline or fully filtered host.
+
+With --host the services of a real host are fingerprinted instead.
+
+Usage:
+    python3 benchmarks/bench_fingerprint.py
+    python3 benchmarks/bench_fingerprint.py --rounds 50 --timeout 0.3
+    python3 benchmarks/bench_fingerprint.py --host 192.168.1.10
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot.async_host import AsyncFingerprinter  # noqa: E402
+from bot.fingerprint import (CLOSED, FILTERED, GAMESTREAM, GAMESTREAM_TLS, OPEN, RDP, SSH,  # noqa: E402
+                             OSFingerprinter, classify, ssh_banner)
+
+BANNER = b'SSH-2.0-OpenSSH_8.9p1 Ubuntu-3ubuntu0.6\r\n'
+SCENARIOS = {
+    'linux': {SSH: 'banner', RDP: CLOSED, GAMESTREAM: CLOSED, GAMESTREAM_TLS: CLOSED},
+    'windows': {SSH: FILTERED, RDP: OPEN, GAMESTREAM: OPEN, GAMESTREAM_TLS: OPEN},
+    'gamestream': {SSH: FILTERED, RDP: FILTERED, GAMESTREAM: OPEN, GAMESTREAM_TLS: OPEN},
+    'no services': {SSH: CLOSED, RDP: CLOSED, GAMESTREAM: CLOSED, GAMESTREAM_TLS: CLOSED},
+    'offline': {SSH: FILTERED, RDP: FILTERED, GAMESTREAM: FILTERED, GAMESTREAM_TLS: FILTERED},
+}
+
+
+class LoopbackServices:
+    """Listeners on the loopback playing the services of the scenarios"""
+
+    def __init__(self):
+        self.sockets: List[socket.socket] = []
+        self.banner_port = self._listen(banner=BANNER)
+        self.open_port = self._listen(banner=b'')
+        # A closed port: bound and released, nothing listens on it
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.closed_port = sock.getsockname()[1]
+        sock.close()
+        # Linux drops the SYNs to a listener whose accept queue is full, like a firewall does
+        self.filtered_port = self._listen(backlog=0)
+        for _ in range(4):
+            sock = socket.socket()
+            sock.setblocking(False)
+            sock.connect_ex(('127.0.0.1', self.filtered_port))
+            self.sockets.append(sock)
+        time.sleep(0.1)
+
+    def _listen(self, banner: Optional[bytes] = None, backlog: int = 64) -> int:
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(backlog)
+        self.sockets.append(sock)
+        if banner is not None:
+            threading.Thread(target=self._serve, args=(sock, banner), daemon=True).start()
+        return sock.getsockname()[1]
+
+    @staticmethod
+    def _serve(sock: socket.socket, banner: bytes) -> None:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            if banner:
+                conn.sendall(banner)
+            # Kept open a moment, like a service waiting for the client to speak
+            timer = threading.Timer(1, conn.close)
+            timer.daemon = True
+            timer.start()
+
+    def ports(self, scenario: Dict[str, str]) -> Dict[str, int]:
+        port_of = {'banner': self.banner_port, OPEN: self.open_port, CLOSED: self.closed_port,
+                   FILTERED: self.filtered_port}
+        return {service: port_of[state] for service, state in scenario.items()}
+
+    def close(self) -> None:
+        for sock in self.sockets:
+            sock.close()
+
+
+def sequential(host_ip: str, ports: Dict[str, int], timeout: float) -> Optional[str]:
+    """One port after the other, each with the timeout, as a naive fingerprint would"""
+    states, banner = {}, None
+    for service, port in ports.items():
+        try:
+            with socket.create_connection((host_ip, port), timeout=timeout) as sock:
+                states[service] = OPEN
+                if service == SSH:
+                    banner = ssh_banner(sock.recv(256))
+        except ConnectionRefusedError:
+            states[service] = CLOSED
+        except OSError:
+            states[service] = FILTERED
+    return classify(states, banner)
+
+
+def run(name: str, fingerprint, rounds: int) -> None:
+    latencies, families = [], set()
+    for _ in range(rounds):
+        t_start = time.perf_counter()
+        families.add(fingerprint())
+        latencies.append(time.perf_counter() - t_start)
+    latencies.sort()
+    print(f"  {name:<12}{statistics.median(latencies) * 1000:>10.1f}{latencies[-1] * 1000:>10.1f}"
+          f"  {', '.join(sorted(family or 'unknown' for family in families))}")
+
+
+def bench(host_ip: str, ports: Dict[str, int], timeout: float, rounds: int) -> None:
+    fingerprinter = OSFingerprinter(host_ip, ports=ports, timeout=timeout)
+    async_fingerprinter = AsyncFingerprinter(fingerprinter)
+    loop = asyncio.new_event_loop()
+    print(f"  {'':<12}{'median ms':>10}{'max ms':>10}  detected")
+    run('concurrent', lambda: fingerprinter.fingerprint().family, rounds)
+    run('asyncio', lambda: loop.run_until_complete(async_fingerprinter.fingerprint()).family, rounds)
+    run('sequential', lambda: sequential(host_ip, ports, timeout), rounds)
+    loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", help="Fingerprint a real host instead of the loopback scenarios.")
+    parser.add_argument("--ssh-port", type=int, default=22, help="ssh port of --host.")
+    parser.add_argument("--timeout", type=float, default=0.5, help="Seconds to wait for the services.")
+    parser.add_argument("--rounds", type=int, default=20, help="Fingerprints per scenario and method.")
+    args = parser.parse_args()
+
+    print(f"Fingerprint latency, timeout {args.timeout:g} s, {args.rounds} rounds\n")
+    if args.host:
+        ports = dict(OSFingerprinter(args.host).ports, **{SSH: args.ssh_port})
+        print(f"{args.host} {ports}")
+        print(OSFingerprinter(args.host, ports=ports, timeout=args.timeout).fingerprint())
+        bench(args.host, ports, args.timeout, args.rounds)
+        return
+
+    services = LoopbackServices()
+    try:
+        for name, scenario in SCENARIOS.items():
+            print(f"{name}: {', '.join(f'{service} {state}' for service, state in scenario.items())}")
+            bench('127.0.0.1', services.ports(scenario), args.timeout, args.rounds)
+    finally:
+        services.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Fleet fan-out benchmark with simulated hosts on gpiozero mock pins.
+
+Measures the latency of '/is_online all' (uncached, so every host is probed)
+and of booting every host at once as the fleet grows. With one worker per
+host both should stay flat instead of growing with the host count.
+
+Usage:
+    python3 benchmarks/bench_fleet.py --hosts 32 --probe-latency 0.05
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gpiozero.pins.mock import MockFactory  # noqa: E402
+
+from bot.fleet import Fleet  # noqa: E402
+from bot.host import Host  # noqa: E402
+from bot.probe import ProbeResult  # noqa: E402
+
+
+class SimulatedProber:
+    """A host that answers after a fixed latency and boots in boot_time seconds"""
+
+    def __init__(self, latency: float, boot_time: float):
+        self.latency = latency
+        # An unanswered probe costs the latency too, the host schedules its waits with it
+        self.timeout = latency
+        self.boot_time = boot_time
+        self.powered_at = None
+
+    def probe(self, timeout=None) -> ProbeResult:
+        time.sleep(self.latency)
+        online = self.powered_at is not None and time.monotonic() - self.powered_at >= self.boot_time
+        return ProbeResult(online, self.latency if online else None, 'sim' if online else 'none')
+
+    def wait_online(self, timeout, interval=0.5, probe_timeout=None, stop_event=None) -> ProbeResult:
+        deadline = time.monotonic() + timeout
+        while True:
+            result = self.probe()
+            if result.online or time.monotonic() >= deadline:
+                return result
+            time.sleep(interval)
+
+
+def make_fleet(count: int, latency: float, boot_time: float, state_dir: str) -> Fleet:
+    hosts = []
+    for i in range(count):
+        prober = SimulatedProber(latency, boot_time)
+        host = Host(f'pc{i}', f'10.0.0.{i + 1}', 'user', 'password',
+                    power_pin=21, reset_pin=20,
+                    state_dir=state_dir,
+                    probe_interval=0.05,
+                    prober=prober,
+                    pin_factory=MockFactory())
+        hosts.append(host)
+    return Fleet(hosts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, default=32, help="Largest fleet size.")
+    parser.add_argument("--probe-latency", type=float, default=0.05, help="Seconds per simulated probe.")
+    parser.add_argument("--boot-time", type=float, default=0.5, help="Seconds a simulated host takes to boot.")
+    args = parser.parse_args()
+
+    sizes = [1]
+    while sizes[-1] * 2 <= args.hosts:
+        sizes.append(sizes[-1] * 2)
+    if sizes[-1] != args.hosts:
+        sizes.append(args.hosts)
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        print(f"{'hosts':>6} {'is_online all':>15} {'sequential':>12} {'boot all':>10}")
+        for size in sizes:
+            fleet = make_fleet(size, args.probe_latency, args.boot_time, state_dir)
+
+            t_start = time.perf_counter()
+            fleet.map(lambda host: host.is_online(max_age=0))
+            fan_out = time.perf_counter() - t_start
+
+            t_start = time.perf_counter()
+            for host in fleet:
+                host.is_online(max_age=0)
+            sequential = time.perf_counter() - t_start
+
+            # Boot every host at once, the pulse turns the simulated host on
+            t_start = time.perf_counter()
+            futures = []
+            for host in fleet:
+                host.prober.powered_at = time.monotonic()
+                futures.append(host.boot.start('Ubuntu', 0, 0))
+            states = [future.result() for future in futures]
+            boot_all = time.perf_counter() - t_start
+            assert all(state == 'done' for state in states), states
+
+            print(f"{size:>6} {fan_out * 1000:>12.1f} ms {sequential * 1000:>9.1f} ms {boot_all:>8.2f} s")
+            fleet.stop()
+
+
+if __name__ == "__main__":
+    main()
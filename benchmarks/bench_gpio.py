@@ -0,0 +1,75 @@
+"""Measure handler turnaround of the GPIO pulse scheduler on gpiozero mock pins.
+
+Compares how long a handler is blocked by the old sleeping switch actions and
+by PulseScheduler, and checks that queued pulses on one pin never overlap.
+
+Usage:
+    python3 benchmarks/bench_gpio.py --pulses 10 --duration 0.05
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gpiozero import LED, Device  # noqa: E402
+from gpiozero.pins.mock import MockFactory  # noqa: E402
+
+from bot.gpio_scheduler import PulseScheduler  # noqa: E402
+
+
+def sleeping_pulse(led: LED, duration: float) -> None:
+    """The old switch action implementation"""
+    led.on()
+    time.sleep(duration)
+    led.off()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pulses", type=int, default=10, help="Pulses to queue.")
+    parser.add_argument("--duration", type=float, default=0.05, help="Pulse length in seconds.")
+    args = parser.parse_args()
+
+    Device.pin_factory = MockFactory()
+    power = LED(21)
+    pin = Device.pin_factory.pin(21)
+
+    # Old path, the handler is blocked for the whole pulse
+    turnaround = []
+    for _ in range(args.pulses):
+        t_start = time.perf_counter()
+        sleeping_pulse(power, args.duration)
+        turnaround.append(time.perf_counter() - t_start)
+    print(f"   sleep: handler p50 {statistics.median(turnaround) * 1000:8.3f} ms  "
+          f"max {max(turnaround) * 1000:8.3f} ms")
+
+    # Scheduler, the handler only queues the pulse
+    pin.clear_states()
+    scheduler = PulseScheduler()
+    scheduler.add_pin('power', power)
+    turnaround = []
+    futures = []
+    t_queue = time.perf_counter()
+    for _ in range(args.pulses):
+        t_start = time.perf_counter()
+        futures.append(scheduler.pulse('power', args.duration))
+        turnaround.append(time.perf_counter() - t_start)
+    lengths = [future.result() for future in futures]
+    total = time.perf_counter() - t_queue
+    print(f"schedule: handler p50 {statistics.median(turnaround) * 1000:8.3f} ms  "
+          f"max {max(turnaround) * 1000:8.3f} ms")
+    print(f"          pulse length p50 {statistics.median(lengths) * 1000:8.3f} ms  "
+          f"all done after {total:.3f} s")
+
+    # Each pulse must be a clean on/off pair, i.e. pulses never overlapped
+    states = [state.state for state in pin.states][1:]
+    overlaps = sum(1 for a, b in zip(states, states[1:]) if a == b)
+    print(f"          state changes {len(states)}  overlapping pulses {overlaps}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Latency of the quick commands while long jobs saturate their lane.
+
+The bot runs against the fake Bot API and simulated hosts (see bench_e2e.py).
+A user sends /get_chat_id and /is_online one after the other and times the
+answers, first on an idle bot and then while every host runs a /run command
+that keeps an ssh session busy for --job-time seconds. There are more hosts
+than the long lane has workers and queue, so some of the jobs are refused
+with the busy reply.
+
+With --shared every handler and job runs in one pool of four workers, like
+python-telegram-bot's default worker pool, for comparison.
+
+Usage:
+    python3 benchmarks/bench_lanes.py --hosts 8 --job-time 2
+    python3 benchmarks/bench_lanes.py --shared
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_host import FakeHost  # noqa: E402
+from benchmarks.fake_telegram import FakeTelegramAPI, command_update  # noqa: E402
+from bot.lanes import INSTANT, IO, LONG, Lane  # noqa: E402
+from bot.suckerfish_bot import BUSY_TEXT, SuckerfishBot  # noqa: E402
+from utils.metrics import REGISTRY  # noqa: E402
+
+TOKEN = '123456:fake-token'
+PROBE_CHAT = 1
+JOB_CHAT = 2
+
+
+def sleep_command(args: List[str]):
+    time.sleep(float(args[1]))
+    return 0, 'slept\n', ''
+
+
+def probe(api: FakeTelegramAPI, commands: int, host: str) -> List[float]:
+    """Send instant commands one at a time, returns their latencies"""
+    match = lambda params: str(params.get('chat_id')) == str(PROBE_CHAT)
+    latencies = []
+    for i in range(commands):
+        text = '/get_chat_id' if i % 2 else f'/is_online {host}'
+        since = len(api.calls)
+        t_start = time.perf_counter()
+        api.push_update(command_update(text, PROBE_CHAT))
+        call = api.wait_call('sendMessage', since, timeout=60, match=match)
+        if call is None:
+            raise RuntimeError(f"No answer to {text}")
+        latencies.append(call[0] - t_start)
+        time.sleep(0.01)
+    return latencies
+
+
+def report(name: str, latencies: List[float]) -> None:
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"  {name:<8} n={len(latencies):<4} p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+          f"p99 {p99 * 1000:7.1f} ms  max {latencies[-1] * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, default=8, help="Simulated hosts, one /run job each.")
+    parser.add_argument("--job-time", type=float, default=2, help="Seconds each /run job keeps its ssh session.")
+    parser.add_argument("--probes", type=int, default=60, help="Instant commands sent in each phase.")
+    parser.add_argument("--shared", action="store_true", help="Run everything in one pool of four workers.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    api = FakeTelegramAPI().start()
+    fakes = [FakeHost().start() for _ in range(args.hosts)]
+    host_configs = []
+    for i, fake in enumerate(fakes):
+        fake.ssh.commands['sleep'] = sleep_command
+        # Boot the simulated host without the bot
+        fake._power_on()
+        host_configs.append({
+            'name': f'pc{i}', 'host_ip': '127.0.0.1', 'host_username': 'user',
+            'host_password': 'password', 'power_pin': fake.power_pin, 'reset_pin': fake.reset_pin,
+            'ssh_port': fake.ssh.port, 'monitor_interval': 0.5, 'monitor_ttl': 5,
+            'prober': fake.prober(timeout=0.05), 'pin_factory': fake.pin_factory,
+        })
+    time.sleep(0.5)
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        bot = SuckerfishBot(TOKEN, host_configs, state_dir=state_dir, notify_host_changes=False,
+                            base_url=api.base_url, run_commands={'slow': f'sleep {args.job_time}'})
+        if args.shared:
+            shared = Lane('shared', workers=4, queue=1000)
+            bot.lanes.update({INSTANT: shared, IO: shared, LONG: shared})
+        bot.start()
+        for host in bot.fleet:
+            host.connect_ssh()
+
+        print(f"{'shared pool of 4' if args.shared else 'lanes'}, {args.hosts} jobs of {args.job_time} s")
+        report('idle', probe(api, args.probes, 'pc0'))
+
+        since = len(api.calls)
+        for i in range(args.hosts):
+            api.push_update(command_update(f'/run slow pc{i}', JOB_CHAT))
+        report('loaded', probe(api, args.probes, 'pc0'))
+
+        # Wait for the accepted jobs to finish
+        done = lambda params: 'Exited' in str(params.get('text')) or params.get('text') == BUSY_TEXT
+        finished = api.wait_calls('editMessageText', args.hosts, since, timeout=60 + 4 * args.job_time, match=done)
+        refused = sum(1 for call in finished if call[2].get('text') == BUSY_TEXT)
+        print(f"  jobs     {len(finished) - refused} ran, {refused} refused busy")
+        for line in REGISTRY.summary().splitlines():
+            if line.startswith(('suckerfish_lane_wait_seconds', 'suckerfish_lane_shed')):
+                print(f"  {line}")
+
+        bot.updater.stop()
+        for lane in set(bot.lanes.values()):
+            lane.shutdown()
+        bot.fleet.stop()
+        bot.ssh_pool.close_all()
+    for fake in fakes:
+        fake.stop()
+    api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Write syscalls and bytes of the log file handlers.
+
+Logs --records records like the bot's (mostly INFO, one ERROR in a
+hundred) through the FileHandler the logger used before and through
+BufferedRotatingHandler, and reports the write syscalls and bytes written
+by the process (from /proc/self/io, so Linux only), per 10k records, the
+time per record and the disk used at the end. The buffered handler rotates
+at --max-kb and caps the log at --total-kb, so with enough records the
+rotation and gzip of the segments are part of the numbers.
+
+Usage:
+    python3 benchmarks/bench_log_writer.py --records 10000
+    python3 benchmarks/bench_log_writer.py --records 200000 --max-kb 256 --total-kb 1024
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.log_writer import BufferedRotatingHandler  # noqa: E402
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def proc_io() -> dict:
+    with open('/proc/self/io') as f:
+        return {key: int(value) for key, value in (line.split(': ') for line in f)}
+
+
+def disk_usage(folder: str) -> int:
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+
+def run(name: str, handler: logging.Handler, folder: str, records: int, seed: int) -> None:
+    handler.setFormatter(logging.Formatter(FORMAT))
+    logger = logging.getLogger(f'bench.{name}')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    rng = random.Random(seed)
+
+    before = proc_io()
+    t_start = time.perf_counter()
+    for i in range(records):
+        if rng.random() < 0.01:
+            logger.error(f"Boot {i:08x}: could not edit the progress message: Timed out")
+        else:
+            logger.info(f"Job[{i}]: Executing on pc{i % 4}: sudo grub-reboot 'gnulinux-simple-{i % 7}'")
+    elapsed = time.perf_counter() - t_start
+    handler.close()
+    after = proc_io()
+    logger.removeHandler(handler)
+
+    per_10k = 10000 / records
+    files = sorted(os.listdir(folder))
+    print(f"  {name:<10} {(after['syscw'] - before['syscw']) * per_10k:8.0f} writes  "
+          f"{(after['wchar'] - before['wchar']) * per_10k / 1024:8.1f} kB written per 10k records  "
+          f"{elapsed / records * 1e6:5.1f} us/record  "
+          f"{disk_usage(folder) / 1024:8.1f} kB on disk in {len(files)} files")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000, help="Records logged by each handler.")
+    parser.add_argument("--max-kb", type=int, default=1024, help="Rotation size of the buffered handler.")
+    parser.add_argument("--total-kb", type=int, default=10240, help="Disk cap of the buffered handler.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the error records.")
+    args = parser.parse_args()
+
+    if not os.path.exists('/proc/self/io'):
+        sys.exit('/proc/self/io is needed to count the writes')
+
+    print(f"{args.records} records, 1% errors")
+    with tempfile.TemporaryDirectory() as folder:
+        run('FileHandler', logging.FileHandler(os.path.join(folder, 'suckerfish.log'), mode='w'),
+            folder, args.records, args.seed)
+    with tempfile.TemporaryDirectory() as folder:
+        handler = BufferedRotatingHandler(os.path.join(folder, 'suckerfish.log'),
+                                          max_bytes=args.max_kb * 1024,
+                                          max_total_bytes=args.total_kb * 1024)
+        run('buffered', handler, folder, args.records, args.seed)
+    with tempfile.TemporaryDirectory() as folder:
+        # Errors buffered too, the write batching alone
+        handler = BufferedRotatingHandler(os.path.join(folder, 'suckerfish.log'),
+                                          max_bytes=args.max_kb * 1024,
+                                          max_total_bytes=args.total_kb * 1024,
+                                          flush_level=logging.CRITICAL + 1)
+        run('batch only', handler, folder, args.records, args.seed)
+
+
+if __name__ == "__main__":
+    main()
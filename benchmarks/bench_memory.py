@@ -0,0 +1,211 @@
+"""Memory of the bot in its default and low-memory configurations.
+
+Each configuration runs in a fresh python process against the hermetic
+stand-ins of bench_e2e.py, with the dev chat logger of bot_main.py sending
+to the fake Bot API too. The fakes are started first and are the baseline
+(they load http.server, paramiko and gpiozero themselves), then the child
+reports the RSS added by each stage:
+
+- imports: the bot module and the logger,
+- logger: the DevChatLogger, with its own Telegram client unless shared,
+- bot: the bot, its hosts and, when shared, the client of the logger,
+- started: the bot polling, once it settled,
+- workload: a burst of is_online, --rounds boot and shutdown rounds per
+  host, errors for the dev chat and a profile sent as a file, then a
+  garbage collection,
+
+then the steady RSS, the sum of them, the threads and the heavy libraries
+loaded. The benchmark fails if the steady RSS of a configuration exceeds
+its budget, by default only the low-memory ones have one.
+
+Usage:
+    python3 benchmarks/bench_memory.py
+    python3 benchmarks/bench_memory.py --configs threads-low asyncio-low --budget asyncio-low=5
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.bench_e2e import TOKEN, Latencies, User, burst  # noqa: E402
+from benchmarks.bench_runtimes import proc_status  # noqa: E402
+from benchmarks.fake_host import FakeHost  # noqa: E402
+from benchmarks.fake_telegram import FakeTelegramAPI  # noqa: E402
+
+CONFIGS = ('threads', 'threads-low', 'asyncio', 'asyncio-low')
+DEV_CHAT = 4242
+HEAVY_MODULES = ('telegram', 'telegram.ext', 'apscheduler', 'requests', 'urllib3', 'IPython')
+# MB of steady RSS over the fakes, with room for other platforms and versions
+BUDGETS = {'threads-low': 22, 'asyncio-low': 6}
+
+
+def child(config: str, args) -> dict:
+    """Run one configuration in this process and measure it"""
+    runtime, low_memory = config.split('-')[0], config.endswith('-low')
+    logging.basicConfig(level=logging.ERROR)
+
+    api = FakeTelegramAPI().start()
+    fakes = [FakeHost(boot_time=0.2, hold_threshold=0.1).start() for _ in range(args.hosts)]
+    host_configs = []
+    for i, fake in enumerate(fakes):
+        host_config = {
+            'name': f'pc{i}', 'host_ip': '127.0.0.1', 'host_username': 'user',
+            'host_password': 'password', 'power_pin': fake.power_pin, 'reset_pin': fake.reset_pin,
+            'windows_entry_id': 1, 'ssh_port': fake.ssh.port, 'pulse_time': 0.02, 'hold_time': 0.2,
+            'probe_interval': 0.02, 'monitor_interval': 0.5, 'monitor_max_interval': 2, 'monitor_ttl': 5,
+            'pin_factory': fake.pin_factory,
+        }
+        if runtime == 'asyncio':
+            host_config['async_prober'] = fake.async_prober(timeout=0.05)
+        else:
+            host_config['prober'] = fake.prober(timeout=0.05)
+        host_configs.append(host_config)
+
+    time.sleep(0.5)
+    gc.collect()
+    rss = [proc_status('VmRSS')]
+    threads_base = threading.active_count()
+    result = {'config': config}
+
+    def stage(name: str) -> None:
+        rss.append(proc_status('VmRSS'))
+        result[f'{name}_mb'] = (rss[-1] - rss[-2]) / 1024
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        # Imported here, as bot_main.py does, so each runtime only loads its own libraries
+        if runtime == 'asyncio':
+            from bot.async_bot import AsyncSuckerfishBot as bot_class
+            options = dict(max_pending=args.burst * 2)
+        else:
+            from bot.suckerfish_bot import SuckerfishBot as bot_class
+            options = dict(lanes={'instant': {'queue': args.burst}}, low_memory=low_memory)
+        from utils.loggers import DevChatLogger
+        stage('imports')
+
+        logger = DevChatLogger(TOKEN, DEV_CHAT, chat_log_level=logging.ERROR, file_log_level=logging.WARNING,
+                               log_file=os.path.join(state_dir, 'dev_chat_log.log'), chat_rate=100,
+                               base_url=api.base_url, shared_client=low_memory)
+        # Keep the log records off the output of the child
+        logging.getLogger().handlers = [logger.file_handler]
+        stage('logger')
+
+        bot = bot_class(TOKEN, host_configs, logger=logger, state_dir=state_dir, base_url=api.base_url,
+                        notify_host_changes=False,
+                        # Keep the public ip lookup off the internet
+                        network={'providers': [f'{api.base_url}/ip'], 'timeout': 0.1},
+                        **options)
+        if low_memory:
+            logger.use_client(bot.dev_chat_client(TOKEN))
+        stage('bot')
+
+        bot.start()
+        time.sleep(1)
+        stage('started')
+        result['threads_started'] = threading.active_count() - threads_base
+
+        result['burst_per_s'] = burst(api, 'pc0', args.burst)
+        latencies = Latencies()
+        users = [User(api, bot, f'pc{i}', 1000 + i, latencies) for i in range(args.hosts)]
+        workers = [threading.Thread(target=user.run, args=(args.rounds,)) for user in users]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        errors = [f"{user.name}: {user.error}" for user in users if user.error is not None]
+
+        # The dev chat gets errors and a profile, through the client of the logger
+        since = len(api.calls)
+        for i in range(args.errors):
+            logger.error(f"benchmark error {i}")
+        logger.send_report('benchmark profile', 'summary', 'profile.txt', 'x' * 64 * 1024)
+        to_dev_chat = lambda params: str(params.get('chat_id')) == str(DEV_CHAT)
+        if not api.wait_calls('sendMessage', 1, since, match=to_dev_chat):
+            errors.append("dev chat: no message")
+        if not api.wait_call('sendDocument', since):
+            errors.append("dev chat: no file")
+        if errors:
+            result['errors'] = errors
+
+        gc.collect()
+        time.sleep(1)
+        stage('workload')
+        result['steady_mb'] = (rss[-1] - rss[0]) / 1024
+        result['peak_mb'] = (proc_status('VmHWM') - rss[0]) / 1024
+        result['threads_steady'] = threading.active_count() - threads_base
+        result['loaded'] = [name for name in HEAVY_MODULES if name in sys.modules]
+
+        if runtime == 'asyncio':
+            bot.stop()
+        else:
+            bot.updater.stop()
+            bot.fleet.stop()
+            bot.ssh_pool.close_all()
+        logger.close()
+    for fake in fakes:
+        fake.stop()
+    api.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", nargs='+', choices=CONFIGS, default=list(CONFIGS),
+                        help="Configurations to measure.")
+    parser.add_argument("--hosts", type=int, default=2, help="Simulated hosts.")
+    parser.add_argument("--burst", type=int, default=200, help="is_online commands in the burst.")
+    parser.add_argument("--rounds", type=int, default=1, help="Boot and shutdown rounds per host.")
+    parser.add_argument("--errors", type=int, default=20, help="Errors logged to the dev chat.")
+    parser.add_argument("--budget", nargs='+', default=[], metavar='CONFIG=MB',
+                        help=f"Max steady RSS over the fakes, replacing the defaults {BUDGETS}.")
+    parser.add_argument("--child", choices=CONFIGS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.child, args)))
+        return
+
+    budgets = dict(BUDGETS)
+    for budget in args.budget:
+        config, _, mb = budget.partition('=')
+        if config not in CONFIGS:
+            parser.error(f"Unknown configuration in --budget: {config}")
+        budgets[config] = float(mb)
+
+    results = []
+    for config in args.configs:
+        command = [sys.executable, os.path.abspath(__file__), '--child', config] + sys.argv[1:]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{args.hosts} hosts, RSS added in MB over the fakes\n")
+    print(f"{'':<16}" + ''.join(f"{result['config']:>13}" for result in results))
+    for key in ('imports_mb', 'logger_mb', 'bot_mb', 'started_mb', 'workload_mb', 'steady_mb', 'peak_mb',
+                'threads_started', 'threads_steady', 'burst_per_s'):
+        print(f"{key:<16}" + ''.join(f"{result[key]:>13.1f}" for result in results))
+    for result in results:
+        print(f"{result['config']} loaded: {', '.join(result['loaded']) or 'none of the heavy modules'}")
+
+    failed = False
+    for result in results:
+        for error in result.get('errors', []):
+            print(f"{result['config']} failed {error}")
+            failed = True
+        budget = budgets.get(result['config'])
+        if budget is not None and result['steady_mb'] > budget:
+            print(f"{result['config']} is over budget: {result['steady_mb']:.1f} MB > {budget:g} MB")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
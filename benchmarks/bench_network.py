@@ -0,0 +1,143 @@
+"""Cost of answering /current_ip, before and with the network identity cache.
+
+Local HTTP servers stand in for the public ip providers, answering after
+--delay seconds like a service across the internet. Compares:
+
+- the old handler: a new requests.get per command plus
+  socket.gethostbyname(socket.getfqdn()) for the local ip,
+- a lookup of NetworkIdentity, through one session that keeps the
+  connection open, and reading the interfaces with local_addresses(),
+- answering from the cache, what /current_ip does now,
+- a lookup whose first provider refuses connections and second one hangs
+  past the timeout, before the third answers.
+
+Usage:
+    python3 benchmarks/bench_network.py --delay 0.05 --calls 20
+"""
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+from bot.network_identity import NetworkIdentity, local_addresses  # noqa: E402
+
+
+class FakeProvider:
+    """Answers every GET with an ip after a delay"""
+
+    def __init__(self, delay: float, ip: str = '203.0.113.7'):
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out in two writes, don't wait for the ack in between
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                provider.connections.add(self.client_address)
+                time.sleep(provider.delay)
+                body = provider.ip.encode()
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    # The client gave up waiting
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        self.delay = delay
+        self.ip = ip
+        self.connections = set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def closed_port_url() -> str:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{s.getsockname()[1]}/'
+
+
+def timed(fn: Callable, calls: int) -> List[float]:
+    latencies = []
+    for _ in range(calls):
+        t_start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t_start)
+    return latencies
+
+
+def report(name: str, latencies: List[float]) -> None:
+    print(f"  {name:<34} p50 {statistics.median(latencies) * 1000:8.3f} ms  max {max(latencies) * 1000:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delay", type=float, default=0.05, help="Seconds each provider takes to answer.")
+    parser.add_argument("--calls", type=int, default=20, help="Calls of each path.")
+    parser.add_argument("--timeout", type=float, default=0.5, help="Seconds to wait for each provider.")
+    args = parser.parse_args()
+
+    provider = FakeProvider(args.delay)
+    print(f"providers answering after {args.delay * 1000:.0f} ms, {args.calls} calls each")
+
+    def old_handler():
+        requests.get(provider.url).text
+        socket.gethostbyname(socket.getfqdn())
+
+    report('old handler', timed(old_handler, args.calls))
+    before = len(provider.connections)
+    report('  requests.get alone', timed(lambda: requests.get(provider.url).text, args.calls))
+    print(f"    {len(provider.connections) - before} connections opened")
+    report('  gethostbyname(getfqdn())', timed(lambda: socket.gethostbyname(socket.getfqdn()), args.calls))
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        identity = NetworkIdentity(os.path.join(state_dir, 'network.json'), providers=[provider.url],
+                                   timeout=args.timeout)
+        before = len(provider.connections)
+        report('session lookup', timed(identity.lookup_public_ip, args.calls))
+        print(f"    {len(provider.connections) - before} connections opened")
+        report('local_addresses()', timed(local_addresses, args.calls))
+        identity.refresh()
+        report('/current_ip from the cache', timed(lambda: identity.state.public_ip, args.calls))
+
+        hanging = FakeProvider(args.timeout * 4)
+        fallback = NetworkIdentity(os.path.join(state_dir, 'fallback.json'),
+                                   providers=[closed_port_url(), hanging.url, provider.url],
+                                   timeout=args.timeout)
+        latencies = timed(fallback.lookup_public_ip, 3)
+        report('refused, hung, then answered', latencies)
+        print(f"    answer {fallback.lookup_public_ip()}")
+        hanging.stop()
+    provider.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Compare the in-process HostProber against forking ping.
+
+Usage:
+    python3 benchmarks/bench_probe.py --host 192.168.1.10 --rounds 20
+"""
+import argparse
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot.probe import HostProber  # noqa: E402
+
+
+def subprocess_probe(host_ip: str) -> bool:
+    """The old is_host_online implementation"""
+    try:
+        subprocess.check_output(["ping", "-c", "1", host_ip])
+    except Exception:
+        return False
+    return True
+
+
+def cpu_time() -> float:
+    """User + system time of this process and its children"""
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime + self_usage.ru_stime +
+            child_usage.ru_utime + child_usage.ru_stime)
+
+
+def run(name: str, probe, rounds: int) -> None:
+    latencies = []
+    online = 0
+    cpu_start = cpu_time()
+    for _ in range(rounds):
+        t_start = time.perf_counter()
+        online += bool(probe())
+        latencies.append(time.perf_counter() - t_start)
+    cpu = cpu_time() - cpu_start
+
+    latencies.sort()
+    print(f"{name:>12}: online {online}/{rounds}  "
+          f"p50 {statistics.median(latencies) * 1000:8.2f} ms  "
+          f"max {latencies[-1] * 1000:8.2f} ms  "
+          f"cpu/probe {cpu / rounds * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="Host to probe.")
+    parser.add_argument("--rounds", type=int, default=20, help="Probes per method.")
+    parser.add_argument("--timeout", type=float, default=1.0, help="Per probe timeout.")
+    args = parser.parse_args()
+
+    prober = HostProber(args.host, timeout=args.timeout)
+
+    run("subprocess", lambda: subprocess_probe(args.host), args.rounds)
+    run("icmp+tcp", lambda: prober.probe().online, args.rounds)
+    run("icmp", lambda: prober.probe_icmp(args.timeout) is not None, args.rounds)
+    run("tcp", lambda: prober.probe_tcp(prober.tcp_ports[0], args.timeout) is not None, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Cost of the /profile and /memprofile profilers on the command throughput.
+
+Runs the bot against the hermetic stand-ins of bench_e2e.py and pushes
+bursts of is_online with the profilers off, with the CPU sampler running
+and with tracemalloc tracing, then times building their reports. Off, the
+profilers have no thread and wrap nothing, so that run is the baseline.
+
+Usage:
+    python3 benchmarks/bench_profiling.py --burst 500 --repeat 3
+    python3 benchmarks/bench_profiling.py --interval 1
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_e2e import TOKEN, burst  # noqa: E402
+from benchmarks.fake_host import FakeHost  # noqa: E402
+from benchmarks.fake_telegram import FakeTelegramAPI  # noqa: E402
+from bot.suckerfish_bot import SuckerfishBot  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--burst", type=int, default=500, help="is_online commands per burst.")
+    parser.add_argument("--repeat", type=int, default=3, help="Bursts per mode, the median is reported.")
+    parser.add_argument("--frames", type=int, default=1, help="Frames kept per allocation by tracemalloc.")
+    parser.add_argument("--interval", type=float, default=5, help="Milliseconds between CPU samples.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    api = FakeTelegramAPI().start()
+    fake = FakeHost().start()
+    host_config = {
+        'name': 'pc0', 'host_ip': '127.0.0.1', 'host_username': 'user', 'host_password': 'password',
+        'power_pin': fake.power_pin, 'reset_pin': fake.reset_pin, 'windows_entry_id': 1,
+        'ssh_port': fake.ssh.port, 'prober': fake.prober(), 'pin_factory': fake.pin_factory,
+    }
+    with tempfile.TemporaryDirectory() as state_dir:
+        bot = SuckerfishBot(TOKEN, [host_config], state_dir=state_dir, base_url=api.base_url,
+                            notify_host_changes=False,
+                            lanes={'instant': {'queue': args.burst}},
+                            # Keep the public ip lookup off the internet
+                            network={'providers': [f'{api.base_url}/ip'], 'timeout': 0.1})
+        bot.start()
+        burst(api, 'pc0', 50)
+
+        def measure(name: str) -> None:
+            rates = [burst(api, 'pc0', args.burst) for _ in range(args.repeat)]
+            print(f"  {name:<22} {statistics.median(rates):7.0f} commands/s, {threading.active_count()} threads")
+
+        print(f"is_online bursts of {args.burst}, median of {args.repeat}")
+        measure('profilers off')
+
+        bot.cpu_profiler.start(args.interval / 1000)
+        measure(f'CPU sampler {args.interval:g} ms')
+        t_start = time.perf_counter()
+        report = bot.cpu_profiler.stop()
+        print(f"    report in {(time.perf_counter() - t_start) * 1000:.1f} ms, "
+              f"summary {len(report.summary)} chars, dump {len(report.dump) / 1024:.0f} KiB")
+
+        bot.memory_profiler.frames = args.frames
+        bot.memory_profiler.start()
+        measure(f'tracemalloc {args.frames} frames')
+        t_start = time.perf_counter()
+        report = bot.memory_profiler.stop()
+        print(f"    report in {(time.perf_counter() - t_start) * 1000:.1f} ms, "
+              f"summary {len(report.summary)} chars, dump {len(report.dump) / 1024:.0f} KiB")
+
+        measure('profilers off again')
+        bot.updater.stop()
+        bot.fleet.stop()
+        bot.ssh_pool.close_all()
+    fake.stop()
+    api.stop()
+
+
+if __name__ == "__main__":
+    main()
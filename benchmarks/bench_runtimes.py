@@ -0,0 +1,200 @@
+"""Footprint and latency of the threads and asyncio runtimes, side by side.
+
+Each runtime runs in a fresh python process against the hermetic stand-ins
+of bench_e2e.py (fake Bot API, simulated PCs on mock relays, fake ssh), so
+the imports of one do not count against the other. The fakes are started
+first and their memory and threads are the baseline, then the bot is
+started and the child reports:
+
+- the RSS and the threads added by the bot once started,
+- the CPU used by the process while the bot sits idle for --idle seconds,
+- a burst of is_online from --burst distinct chats at once: p50/p99 of the
+  time to each chat's answer and the commands answered per second,
+- --rounds boot and forced shutdown rounds per host, as in bench_e2e.py,
+- the peak RSS over the baseline and the CPU of the whole run.
+
+The fakes live in the same process, so the CPU includes theirs; it is the
+same work for both runtimes.
+
+Usage:
+    python3 benchmarks/bench_runtimes.py --hosts 4 --burst 200 --rounds 2
+    python3 benchmarks/bench_runtimes.py --runtimes asyncio --idle 10
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.bench_e2e import TOKEN, Latencies, User  # noqa: E402
+from benchmarks.fake_host import FakeHost  # noqa: E402
+from benchmarks.fake_telegram import FakeTelegramAPI, command_update  # noqa: E402
+
+RUNTIMES = ('threads', 'asyncio')
+BURST_CHAT = 5000
+
+
+def proc_status(field: str) -> int:
+    """A kB field of /proc/self/status, e.g. VmRSS"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds() -> float:
+    times = os.times()
+    return times.user + times.system
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def burst(api: FakeTelegramAPI, name: str, chats: int) -> Dict[str, float]:
+    """is_online from chats distinct chats at once, returns the latencies and throughput"""
+    match = lambda params: int(params.get('chat_id', 0)) >= BURST_CHAT
+    since = len(api.calls)
+    sent = {}
+    t_start = time.perf_counter()
+    for i in range(chats):
+        sent[BURST_CHAT + i] = time.perf_counter()
+        api.push_update(command_update(f'/is_online {name}', BURST_CHAT + i))
+    calls = api.wait_calls('sendMessage', chats, since, timeout=60, match=match)
+    if len(calls) < chats:
+        raise RuntimeError(f"Only {len(calls)} of {chats} commands were answered")
+    latencies = [t_answer - sent[int(params['chat_id'])] for t_answer, _, params in calls]
+    return {
+        'burst_p50_ms': percentile(latencies, 0.5) * 1000,
+        'burst_p99_ms': percentile(latencies, 0.99) * 1000,
+        'burst_per_s': chats / (calls[-1][0] - t_start),
+    }
+
+
+def child(runtime: str, args) -> dict:
+    """Run one runtime in this process and measure it"""
+    logging.basicConfig(level=logging.ERROR)
+
+    api = FakeTelegramAPI().start()
+    fakes = [FakeHost(boot_time=args.boot_time, hold_threshold=args.hold_time / 2).start()
+             for _ in range(args.hosts)]
+    host_configs = [{
+        'name': f'pc{i}', 'host_ip': '127.0.0.1', 'host_username': 'user',
+        'host_password': 'password', 'power_pin': fake.power_pin, 'reset_pin': fake.reset_pin,
+        'windows_entry_id': 1, 'ssh_port': fake.ssh.port,
+        'pulse_time': args.pulse_time, 'hold_time': args.hold_time,
+        'probe_interval': 0.02, 'monitor_interval': 0.5, 'monitor_max_interval': 2, 'monitor_ttl': 5,
+        'pin_factory': fake.pin_factory,
+    } for i, fake in enumerate(fakes)]
+    for config, fake in zip(host_configs, fakes):
+        if runtime == 'asyncio':
+            config['async_prober'] = fake.async_prober(timeout=0.05)
+        else:
+            config['prober'] = fake.prober(timeout=0.05)
+    common = dict(notify_host_changes=False, base_url=api.base_url,
+                  # Keep the public ip lookup off the internet
+                  network={'providers': [f'{api.base_url}/ip'], 'timeout': 0.1})
+
+    time.sleep(0.5)
+    rss_base = proc_status('VmRSS')
+    threads_base = threading.active_count()
+    result = {'runtime': runtime}
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        t_cpu = cpu_seconds()
+        if runtime == 'asyncio':
+            from bot.async_bot import AsyncSuckerfishBot
+            bot = AsyncSuckerfishBot(TOKEN, host_configs, state_dir=state_dir,
+                                     max_pending=args.burst * 2, **common)
+        else:
+            from bot.suckerfish_bot import SuckerfishBot
+            bot = SuckerfishBot(TOKEN, host_configs, state_dir=state_dir,
+                                lanes={'instant': {'queue': args.burst}}, **common)
+        bot.start()
+        time.sleep(1)
+        result['start_cpu_s'] = cpu_seconds() - t_cpu
+        result['rss_mb'] = (proc_status('VmRSS') - rss_base) / 1024
+        result['threads'] = threading.active_count() - threads_base
+
+        t_cpu = cpu_seconds()
+        time.sleep(args.idle)
+        result['idle_cpu_pct'] = (cpu_seconds() - t_cpu) / args.idle * 100
+
+        t_cpu = cpu_seconds()
+        result.update(burst(api, 'pc0', args.burst))
+
+        latencies = Latencies()
+        users = [User(api, bot, f'pc{i}', 1000 + i, latencies) for i in range(args.hosts)]
+        threads = [threading.Thread(target=user.run, args=(args.rounds,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        errors = [f"{user.name}: {user.error}" for user in users if user.error is not None]
+        if errors:
+            result['errors'] = errors
+        for step in ('is_online', 'boot Ubuntu', 'force shutdown'):
+            if latencies.steps.get(step):
+                result[f'{step} p50 ms'] = percentile(latencies.steps[step], 0.5) * 1000
+        result['work_cpu_s'] = cpu_seconds() - t_cpu
+        result['peak_rss_mb'] = (proc_status('VmHWM') - rss_base) / 1024
+        result['threads_peak'] = threading.active_count() - threads_base
+
+        if runtime == 'asyncio':
+            bot.stop()
+        else:
+            bot.updater.stop()
+            bot.fleet.stop()
+            bot.ssh_pool.close_all()
+    for fake in fakes:
+        fake.stop()
+    api.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runtimes", nargs='+', choices=RUNTIMES, default=list(RUNTIMES), help="Runtimes to compare.")
+    parser.add_argument("--hosts", type=int, default=4, help="Simulated hosts.")
+    parser.add_argument("--burst", type=int, default=200, help="Distinct chats sending is_online at once.")
+    parser.add_argument("--rounds", type=int, default=2, help="Boot and shutdown rounds per host.")
+    parser.add_argument("--idle", type=float, default=5, help="Seconds the idle CPU is measured over.")
+    parser.add_argument("--boot-time", type=float, default=0.2, help="Seconds a simulated host takes to boot.")
+    parser.add_argument("--pulse-time", type=float, default=0.02, help="Seconds the switches are pressed.")
+    parser.add_argument("--hold-time", type=float, default=0.2, help="Seconds the power switch is held.")
+    parser.add_argument("--child", choices=RUNTIMES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.child, args)))
+        return
+
+    results = []
+    for runtime in args.runtimes:
+        command = [sys.executable, os.path.abspath(__file__), '--child', runtime] + sys.argv[1:]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{args.hosts} hosts, burst of {args.burst} chats, {args.rounds} rounds per host\n")
+    keys = [key for key in results[0] if key not in ('runtime', 'errors')]
+    print(f"{'':<20}" + ''.join(f"{result['runtime']:>12}" for result in results))
+    for key in keys:
+        print(f"{key:<20}" + ''.join(f"{result.get(key, float('nan')):>12.2f}" for result in results))
+    for result in results:
+        for error in result.get('errors', []):
+            print(f"{result['runtime']} failed {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Cold start timings of the bot, eager versus --fast-start.
+
+Every mode runs in a fresh interpreter against a local fake Bot API, with
+gpiozero mock pins and a throwaway ssh key, and reports per phase timings:
+imports, bot construction, start(), the first command answered, and the
+moment the background warm-up has claimed the pins and loaded the key.
+
+Usage:
+    python3 benchmarks/bench_startup.py --hosts 1 --runs 3
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PHASES = ['import telegram', 'import bot', 'construct', 'start', 'first reply', 'warm']
+
+
+def child(mode: str, hosts: int, key_file: str, state_dir: str) -> None:
+    """Start the bot and print the phase timings as json"""
+    timings = {}
+    t_start = time.perf_counter()
+
+    def mark(phase):
+        timings[phase] = time.perf_counter() - t_start
+
+    import telegram.ext  # noqa: F401
+    mark('import telegram')
+
+    from benchmarks.fake_telegram import FakeTelegramAPI, command_update
+    from bot.suckerfish_bot import SuckerfishBot
+    mark('import bot')
+
+    api = FakeTelegramAPI().start()
+    host_configs = [{
+        'name': f'pc{i}', 'host_ip': f'10.0.0.{i + 1}', 'host_username': 'user',
+        'host_password': 'password', 'power_pin': 2 * i + 2, 'reset_pin': 2 * i + 3,
+        'windows_entry_id': 1, 'ssh_key': key_file,
+    } for i in range(hosts)]
+    bot = SuckerfishBot('123456:fake-token', host_configs,
+                        state_dir=state_dir,
+                        lazy_init=(mode == 'fast'),
+                        base_url=api.base_url,
+                        network={'providers': [f'{api.base_url}/ip'], 'timeout': 0.1})
+    mark('construct')
+
+    bot.start()
+    mark('start')
+
+    api.push_update(command_update('/get_chat_id'))
+    api.wait_call('sendMessage')
+    mark('first reply')
+
+    while not all(host._pulses is not None and host.ssh.pkey is not None for host in bot.fleet):
+        time.sleep(0.001)
+    mark('warm')
+
+    print(json.dumps(timings))
+    bot.updater.stop()
+    bot.fleet.stop()
+    api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, default=1, help="Hosts in the fleet.")
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts per mode.")
+    parser.add_argument("--child", choices=['eager', 'fast'], help=argparse.SUPPRESS)
+    parser.add_argument("--key-file", help=argparse.SUPPRESS)
+    parser.add_argument("--state-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.hosts, args.key_file, args.state_dir)
+        return
+
+    import paramiko
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        key_file = os.path.join(tmp_dir, 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_file)
+        env = dict(os.environ, GPIOZERO_PIN_FACTORY='mock')
+
+        print(f"{'mode':>6} " + ' '.join(f'{phase:>16}' for phase in PHASES))
+        for mode in ('eager', 'fast'):
+            runs = []
+            for _ in range(args.runs):
+                output = subprocess.check_output(
+                    [sys.executable, __file__, '--child', mode, '--hosts', str(args.hosts),
+                     '--key-file', key_file, '--state-dir', tmp_dir],
+                    env=env, cwd=ROOT)
+                runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+            medians = [statistics.median(run[phase] for run in runs) for phase in PHASES]
+            print(f"{mode:>6} " + ' '.join(f'{value * 1000:>13.0f} ms' for value in medians))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Memory and CPU cost of the telemetry store, and of reading a host.
+
+Fills a TelemetryStore with a week of samples at the sampler interval and
+reports the bytes held, the time to add a sample, to build the /telemetry
+summary of every tier, and to save and load the file. The same week kept
+as a list of (time, dict) samples, the obvious alternative, is measured
+for comparison with tracemalloc.
+
+Then reads a simulated host (see fake_host.py) over ssh with
+Host.read_telemetry, the single command the sampler runs every interval.
+
+Usage:
+    python3 benchmarks/bench_telemetry.py
+    python3 benchmarks/bench_telemetry.py --interval 10 --reads 50
+"""
+import argparse
+import logging
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_host import FakeHost  # noqa: E402
+from bot.host import Host  # noqa: E402
+from bot.telemetry import FIELDS, TIERS, TelemetryStore  # noqa: E402
+
+WEEK = 7 * 24 * 3600
+
+
+def synthetic_sample(t: float, rng: random.Random) -> dict:
+    """A host warming up in the evenings"""
+    evening = max(0.0, math.sin(2 * math.pi * t / 86400))
+    return {
+        'cpu_temp': 40 + 30 * evening + rng.gauss(0, 2),
+        'gpu_temp': 35 + 40 * evening + rng.gauss(0, 2),
+        'load': 0.3 + 4 * evening * rng.random(),
+        'mem_used': 30 + 20 * evening + rng.gauss(0, 1),
+    }
+
+
+def timed(fn, repeat: int) -> float:
+    """Mean seconds per call"""
+    t_start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t_start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--interval", type=float, default=30, help="Seconds between samples.")
+    parser.add_argument("--reads", type=int, default=20, help="Reads of the simulated host.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic samples.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    rng = random.Random(args.seed)
+    t_end = time.time()
+    times = [t_end - WEEK + i * args.interval for i in range(int(WEEK / args.interval))]
+    samples = [synthetic_sample(t, rng) for t in times]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state_file = os.path.join(tmp_dir, 'telemetry.bin')
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        store = TelemetryStore(state_file)
+        for t, values in zip(times, samples):
+            store.add(values, t)
+        store_memory = tracemalloc.get_traced_memory()[0] - before
+
+        before = tracemalloc.get_traced_memory()[0]
+        naive = [(t, dict(values)) for t, values in zip(times, samples)]
+        naive_memory = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        store = TelemetryStore(state_file)
+        t_start = time.perf_counter()
+        for t, values in zip(times, samples):
+            store.add(values, t)
+        add_time = (time.perf_counter() - t_start) / len(times)
+
+        print(f"a week of {len(times)} samples every {args.interval:g} s, {len(FIELDS)} fields")
+        print(f"  ring buffers      {store_memory / 1024:8.1f} kB traced, {store.nbytes() / 1024:.1f} kB of arrays "
+              f"({', '.join(f'{tier.name} {tier.slots}x{tier.step:g} s' for tier in TIERS)})")
+        print(f"  list of samples   {naive_memory / 1024:8.1f} kB traced")
+        print(f"  add a sample      {add_time * 1e6:8.1f} us")
+        for tier in TIERS:
+            summary_time = timed(lambda: store.summary(tier.name, now=t_end), 20)
+            print(f"  summary {tier.name:<9} {summary_time * 1000:8.2f} ms")
+
+        save_time = timed(store.save, 5)
+        load_time = timed(lambda: TelemetryStore(state_file), 5)
+        print(f"  save              {save_time * 1000:8.2f} ms, {os.path.getsize(state_file) / 1024:.1f} kB file")
+        print(f"  load              {load_time * 1000:8.2f} ms")
+        loaded = TelemetryStore(state_file)
+        same = loaded.summary('week', now=t_end).keys() == store.summary('week', now=t_end).keys()
+        print(f"  reloaded week summary has the same fields: {same}")
+        del naive
+
+        # The command of the sampler against a simulated host
+        fake = FakeHost().start()
+        fake._power_on()
+        time.sleep(fake.boot_time + 0.1)
+        host = Host('pc', '127.0.0.1', 'user', 'password', ssh_port=fake.ssh.port, state_dir=tmp_dir,
+                    prober=fake.prober(), pin_factory=fake.pin_factory, telemetry_interval=None)
+        host.connect_ssh()
+        latencies = []
+        for _ in range(args.reads):
+            t_start = time.perf_counter()
+            values = host.read_telemetry()
+            latencies.append(time.perf_counter() - t_start)
+            if values is None:
+                raise RuntimeError('Could not read the simulated host')
+        host.stop()
+        fake.stop()
+        print(f"read_telemetry over ssh: p50 {statistics.median(latencies) * 1000:.1f} ms, "
+              f"max {max(latencies) * 1000:.1f} ms, {values}")
+
+
+if __name__ == "__main__":
+    main()
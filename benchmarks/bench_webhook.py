@@ -0,0 +1,99 @@
+"""Command round-trip latency of webhook delivery versus long polling.
+
+Both modes run against a local fake Bot API. A command handler replies with
+sendMessage, and the round trip is measured from the moment the update is
+handed to Telegram (queued for getUpdates, or POSTed to the webhook) until
+the fake API receives the reply.
+
+Usage:
+    python3 benchmarks/bench_webhook.py --rounds 50
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import CommandHandler, Updater  # noqa: E402
+
+from benchmarks.fake_telegram import FakeTelegramAPI, command_update  # noqa: E402
+from bot.webhook import WebhookServer  # noqa: E402
+
+TOKEN = '123456:fake-token'
+
+
+def reply(update, context):
+    update.message.reply_text('The host is online')
+
+
+def report(name: str, latencies) -> None:
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:>8}: p50 {statistics.median(latencies) * 1000:7.2f} ms  "
+          f"p99 {p99 * 1000:7.2f} ms  max {latencies[-1] * 1000:7.2f} ms")
+
+
+def bench_polling(rounds: int, poll_interval: float):
+    api = FakeTelegramAPI().start()
+    updater = Updater(TOKEN, base_url=api.base_url, use_context=True)
+    updater.dispatcher.add_handler(CommandHandler('is_online', reply))
+    updater.start_polling(poll_interval=poll_interval, timeout=10)
+
+    latencies = []
+    for _ in range(rounds):
+        since = len(api.calls)
+        t_start = time.perf_counter()
+        api.push_update(command_update('/is_online'))
+        t_reply, _, _ = api.wait_call('sendMessage', since)
+        latencies.append(t_reply - t_start)
+
+    updater.stop()
+    api.stop()
+    return latencies
+
+
+def bench_webhook(rounds: int):
+    api = FakeTelegramAPI().start()
+    updater = Updater(TOKEN, base_url=api.base_url, use_context=True)
+    updater.dispatcher.add_handler(CommandHandler('is_online', reply))
+    server = WebhookServer(updater.dispatcher, port=0, secret='s3cret')
+    server.start()
+    threading.Thread(target=updater.dispatcher.start, daemon=True).start()
+
+    connection = http.client.HTTPConnection('127.0.0.1', server.port)
+    latencies = []
+    for i in range(rounds):
+        since = len(api.calls)
+        body = json.dumps(command_update('/is_online', update_id=i + 1))
+        t_start = time.perf_counter()
+        connection.request('POST', '/s3cret', body, {'Content-Type': 'application/json'})
+        connection.getresponse().read()
+        t_reply, _, _ = api.wait_call('sendMessage', since)
+        latencies.append(t_reply - t_start)
+
+    connection.close()
+    updater.dispatcher.stop()
+    server.stop()
+    api.stop()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=50, help="Commands per mode.")
+    parser.add_argument("--poll-interval", type=float, default=0.0,
+                        help="poll_interval given to start_polling.")
+    args = parser.parse_args()
+
+    report('polling', bench_polling(args.rounds, args.poll_interval))
+    report('webhook', bench_webhook(args.rounds))
+
+
+if __name__ == "__main__":
+    main()
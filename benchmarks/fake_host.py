@@ -0,0 +1,274 @@
+"""Simulated PC wired to mock relays, used by the benchmarks.
+
+The power and reset relays are gpiozero mock pins whose changes drive a
+small power state machine: a short power press boots the host, holding it
+turns the host off and the reset switch reboots it. A booted host serves
+ssh (only when it runs Ubuntu) with a generated grub.cfg (including an
+advanced options submenu, so the entry numbers are not the OS positions)
+and working ``grub-editenv`` and ``grub-reboot`` commands, so the whole boot
+sequence of the bot runs against it unchanged. The /proc files, a thermal
+zone and ``nvidia-smi`` report the values of ``telemetry`` for the sampler. ``FakeHostProber`` probes it over TCP while it is up and costs
+the probe timeout while it is down, like a real host that does not answer,
+and ``FakeAsyncHostProber`` does the same on an event loop.
+"""
+import asyncio
+import fnmatch
+import hashlib
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from gpiozero.pins.mock import MockFactory, MockPin
+
+from benchmarks.fake_ssh import CommandResult, FakeSSHServer
+from bot.async_host import AsyncHostProber
+from bot.probe import HostProber, ProbeResult
+
+GRUB_CFG = '/boot/grub/grub.cfg'
+
+
+def make_grub_cfg(entries: List[str], kernels: int) -> Tuple[str, Dict[str, str]]:
+    """A grub.cfg like update-grub writes, the first OS being the Linux one
+
+    Returns:
+        tuple: (the grub.cfg, the OS booted by each path, id and title grub-reboot takes)
+    """
+    lines = ['set default="0"']
+    targets: Dict[str, str] = {}
+
+    def menuentry(path: str, title: str, entry_id: str, os_name: str, indent: str = '') -> None:
+        lines.append(f"{indent}menuentry '{title}' --class os $menuentry_id_option '{entry_id}' {{")
+        lines.append(f"{indent}\tlinux /boot/vmlinuz")
+        lines.append(f"{indent}}}")
+        targets.update({path: os_name, title: os_name, entry_id: os_name})
+
+    position = 0
+    for i, os_name in enumerate(entries):
+        if os_name == 'Windows':
+            title, entry_id = 'Windows Boot Manager (on /dev/nvme0n1p1)', 'osprober-efi-FAKE'
+        else:
+            title, entry_id = os_name, f'gnulinux-simple-{os_name.lower()}'
+        menuentry(str(position), title, entry_id, os_name)
+        position += 1
+        if i == 0:
+            lines.append(f"submenu 'Advanced options for {os_name}' $menuentry_id_option 'gnulinux-advanced' {{")
+            for k in range(kernels):
+                version = f'5.15.0-{90 + k}-generic'
+                menuentry(f'{position}>{k}', f'{os_name}, with Linux {version}',
+                          f'gnulinux-{version}-advanced', os_name, indent='\t')
+            lines.append('}')
+            position += 1
+    return '\n'.join(lines) + '\n', targets
+
+
+class RelayPin(MockPin):
+    """Mock pin calling a listener with every state change"""
+
+    listener = None
+
+    def _change_state(self, value):
+        changed = super()._change_state(value)
+        if changed and self.listener is not None:
+            self.listener(value)
+        return changed
+
+
+class FakeHost:
+    """A PC booting into the grub entries over mock relays"""
+
+    def __init__(self,
+                 username: str = 'user',
+                 password: str = 'password',
+                 power_pin: int = 21,
+                 reset_pin: int = 20,
+                 boot_time: float = 0.2,
+                 hold_threshold: float = 0.1,
+                 entries: List[str] = ('Ubuntu', 'Windows'),
+                 default_entry: int = 0,
+                 kernels: int = 2):
+        """Initialize the host, powered off
+
+        Args:
+            boot_time (float, optional): Seconds from power on to online. Defaults to 0.2.
+            hold_threshold (float, optional): Power presses at least this long turn the
+                host off. Defaults to 0.1.
+            entries (List[str], optional): OS of each top level grub entry. Defaults to Ubuntu, Windows.
+            default_entry (int, optional): OS booted when none is armed. Defaults to 0.
+            kernels (int, optional): Kernels in the advanced options submenu. Defaults to 2.
+        """
+        self.boot_time = boot_time
+        self.hold_threshold = hold_threshold
+        self.entries = list(entries)
+        self.default_entry = default_entry
+
+        self.powered = False
+        self.online = False
+        self.os_name: Optional[str] = None
+        self.kernels = kernels
+        self.grub_cfg, self.grub_targets = make_grub_cfg(self.entries, kernels)
+        self.next_entry: Optional[str] = None
+        self.boots = 0
+        self.presses = {'power': 0, 'reset': 0}
+        self.telemetry = {'cpu_temp': 45.0, 'gpu_temp': 40.0, 'load': 0.5, 'mem_used': 40.0}
+
+        self._lock = threading.Lock()
+        self._boot_timer: Optional[threading.Timer] = None
+        self._pressed_at = {}
+
+        # Each host gets its own factory, a MockFactory only has the pins of one Pi
+        self.pin_factory = MockFactory(pin_class=RelayPin)
+        self.power_pin = power_pin
+        self.reset_pin = reset_pin
+        self.pin_factory.pin(power_pin).listener = lambda value: self._relay('power', value)
+        self.pin_factory.pin(reset_pin).listener = lambda value: self._relay('reset', value)
+
+        self.ssh = FakeSSHServer(username, password,
+                                 commands={'grub-editenv': self._grub_editenv,
+                                           'grub-reboot': self._grub_reboot,
+                                           'cat': self._cat,
+                                           'echo': lambda args: (0, ' '.join(args[1:]) + '\n', ''),
+                                           'nvidia-smi': self._nvidia_smi,
+                                           'sha256sum': self._sha256sum},
+                                 available=lambda: self.online and self.os_name == 'Ubuntu')
+
+    def start(self) -> 'FakeHost':
+        self.ssh.start()
+        return self
+
+    def stop(self) -> None:
+        self._power_off()
+        self.ssh.stop()
+
+    def prober(self, timeout: float = 0.05) -> 'FakeHostProber':
+        return FakeHostProber(self, timeout)
+
+    def async_prober(self, timeout: float = 0.05) -> 'FakeAsyncHostProber':
+        return FakeAsyncHostProber(FakeHostProber(self, timeout))
+
+    def add_kernel(self) -> None:
+        """Install a kernel, which changes the grub.cfg like update-grub does"""
+        with self._lock:
+            self.kernels += 1
+            self.grub_cfg, self.grub_targets = make_grub_cfg(self.entries, self.kernels)
+
+    def _relay(self, switch: str, closed: bool) -> None:
+        if closed:
+            self._pressed_at[switch] = time.monotonic()
+            return
+        held = time.monotonic() - self._pressed_at.pop(switch, time.monotonic())
+        self.presses[switch] += 1
+        if switch == 'power':
+            if held >= self.hold_threshold:
+                self._power_off()
+            elif not self.powered:
+                self._power_on()
+            # A short press on a running host would ask the OS to shut down, ignored
+        elif self.powered:
+            self._power_off()
+            self._power_on()
+
+    def _power_on(self) -> None:
+        with self._lock:
+            self.powered = True
+            self._boot_timer = threading.Timer(self.boot_time, self._booted)
+            self._boot_timer.daemon = True
+            self._boot_timer.start()
+
+    def _power_off(self) -> None:
+        with self._lock:
+            if self._boot_timer is not None:
+                self._boot_timer.cancel()
+                self._boot_timer = None
+            self.powered = False
+            self.online = False
+            self.os_name = None
+        self.ssh.drop_connections()
+
+    def _booted(self) -> None:
+        with self._lock:
+            if not self.powered:
+                return
+            # grub-reboot only lasts for one boot
+            if self.next_entry is None:
+                self.os_name = self.entries[self.default_entry]
+            else:
+                self.os_name = self.grub_targets.get(self.next_entry, self.entries[self.default_entry])
+            self.next_entry = None
+            self.online = True
+            self.boots += 1
+
+    def _grub_editenv(self, args: List[str]) -> CommandResult:
+        command = args[2:]
+        if command == ['list']:
+            return 0, '' if self.next_entry is None else f'next_entry={self.next_entry}\n', ''
+        if command == ['create']:
+            return 0, '', ''
+        if command == ['unset', 'next_entry']:
+            self.next_entry = None
+            return 0, '', ''
+        return 1, '', f'grub-editenv: error: unknown command {" ".join(command)}\n'
+
+    def _grub_reboot(self, args: List[str]) -> CommandResult:
+        # Unlike the real one, which arms anything and falls back to the default at boot
+        if len(args) != 2 or args[1] not in self.grub_targets:
+            return 1, '', f'grub-reboot: error: invalid entry\n'
+        self.next_entry = args[1]
+        return 0, '', ''
+
+    def _files(self) -> Dict[str, str]:
+        total = 8000000
+        available = int(total * (1 - self.telemetry['mem_used'] / 100))
+        return {
+            GRUB_CFG: self.grub_cfg,
+            '/proc/loadavg': f"{self.telemetry['load']:.2f} 0.40 0.30 1/300 4242\n",
+            '/proc/meminfo': f"MemTotal: {total} kB\nMemFree: {available // 2} kB\nMemAvailable: {available} kB\n",
+            '/sys/class/thermal/thermal_zone0/temp': f"{self.telemetry['cpu_temp'] * 1000:.0f}\n",
+        }
+
+    def _cat(self, args: List[str]) -> CommandResult:
+        files = self._files()
+        status, stdout, stderr = 0, '', ''
+        for pattern in args[1:]:
+            # The shell would expand the globs
+            paths = sorted(path for path in files if fnmatch.fnmatch(path, pattern))
+            if not paths:
+                status = 1
+                stderr += f'cat: {pattern}: No such file or directory\n'
+            stdout += ''.join(files[path] for path in paths)
+        return status, stdout, stderr
+
+    def _nvidia_smi(self, args: List[str]) -> CommandResult:
+        return 0, f"{self.telemetry['gpu_temp']:.0f}\n", ''
+
+    def _sha256sum(self, args: List[str]) -> CommandResult:
+        if args[1:] != [GRUB_CFG]:
+            return 1, '', f'sha256sum: {" ".join(args[1:])}: No such file or directory\n'
+        return 0, f'{hashlib.sha256(self.grub_cfg.encode()).hexdigest()}  {GRUB_CFG}\n', ''
+
+
+class FakeHostProber(HostProber):
+    """TCP prober of a fake host, an offline host costs the full timeout"""
+
+    def __init__(self, fake_host: FakeHost, timeout: float = 0.05):
+        super().__init__('127.0.0.1', timeout=timeout, tcp_ports=(fake_host.ssh.port,), use_icmp=False)
+        self.fake_host = fake_host
+
+    def probe(self, timeout: Optional[float] = None) -> ProbeResult:
+        if not self.fake_host.online:
+            time.sleep(self.timeout if timeout is None else timeout)
+            return ProbeResult(False, None, 'none')
+        return super().probe(timeout)
+
+
+class FakeAsyncHostProber(AsyncHostProber):
+    """FakeHostProber for the asyncio runtime"""
+
+    def __init__(self, prober: FakeHostProber):
+        super().__init__(prober)
+        self.fake_host = prober.fake_host
+
+    async def probe(self, timeout: Optional[float] = None) -> ProbeResult:
+        if not self.fake_host.online:
+            await asyncio.sleep(self.timeout if timeout is None else timeout)
+            return ProbeResult(False, None, 'none')
+        return await super().probe(timeout)
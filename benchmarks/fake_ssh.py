@@ -0,0 +1,209 @@
+"""Local stand-in for the ssh server of a host, used by the benchmarks.
+
+A paramiko server accepting the host password (and any public key) and
+answering exec requests from a table of command handlers. ``sudo -S -p ''``
+is emulated: the password is read from stdin and checked before the wrapped
+command runs, like the real sudo does for ``Host.run_sudo_command``. So is
+``sh -c`` with a list of commands joined by ``&&`` and ``||``, each may
+discard its output with ``> /dev/null``.
+"""
+import logging
+import shlex
+import socket
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import paramiko
+
+# (exit status, stdout, stderr)
+CommandResult = Tuple[int, str, str]
+CommandHandler = Callable[[List[str]], CommandResult]
+
+# The TCP probes connect and hang up before the banner, which the server
+# transport would log as an error every time
+logging.getLogger('paramiko.transport').setLevel(logging.CRITICAL)
+
+_host_key: Optional[paramiko.PKey] = None
+_host_key_lock = threading.Lock()
+
+
+def host_key() -> paramiko.PKey:
+    """Server key shared by every fake server, generating one is slow"""
+    global _host_key
+    with _host_key_lock:
+        if _host_key is None:
+            _host_key = paramiko.RSAKey.generate(2048)
+        return _host_key
+
+
+class FakeSSHServer:
+    """SSH server answering exec requests from a table of handlers.
+
+    Handlers are looked up by the program name (the first word after any
+    ``sudo``) and get the full argument list. Unknown programs exit with 127.
+    ``available`` decides if new connections are served at all, so a host can
+    look like it is up but not running sshd (e.g. booted into Windows).
+    """
+
+    def __init__(self,
+                 username: str,
+                 password: str,
+                 commands: Optional[Dict[str, CommandHandler]] = None,
+                 listen: str = '127.0.0.1',
+                 port: int = 0,
+                 available: Callable[[], bool] = lambda: True):
+        self.username = username
+        self.password = password
+        self.commands: Dict[str, CommandHandler] = dict(commands or {})
+        self.available = available
+        self.executed: List[str] = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((listen, port))
+        self.sock.listen(16)
+        self._transports: List[paramiko.Transport] = []
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = threading.Thread(target=self._serve, name='fake_ssh', daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.sock.getsockname()[1]
+
+    def start(self) -> 'FakeSSHServer':
+        self._running = True
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._running = False
+        self.sock.close()
+        self.drop_connections()
+
+    def drop_connections(self) -> None:
+        """Close every open transport, like a host going down does"""
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
+
+    def _serve(self) -> None:
+        while self._running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            if not self.available():
+                conn.close()
+                continue
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(host_key())
+            try:
+                transport.start_server(server=_Interface(self))
+            except (paramiko.SSHException, EOFError, OSError):
+                transport.close()
+                continue
+            with self._lock:
+                self._transports.append(transport)
+
+    def run(self, command: str, channel: paramiko.Channel) -> CommandResult:
+        """Run a command line, reading the sudo password from the channel"""
+        self.executed.append(command)
+        args = shlex.split(command)
+        while args and args[0] == 'sudo':
+            prompt = '-S' in args
+            # Drop sudo and its options
+            args = args[1:]
+            while args and args[0].startswith('-'):
+                args = args[2:] if args[0] == '-p' else args[1:]
+            if prompt and _read_line(channel) != self.password:
+                return 1, '', 'Sorry, try again.\n'
+        if not args:
+            return 1, '', 'usage: sudo command\n'
+        if args[:2] == ['sh', '-c'] and len(args) == 3:
+            return self._run_script(args[2])
+        return self._run_args(args)
+
+    def _run_args(self, args: List[str]) -> CommandResult:
+        handler = self.commands.get(args[0])
+        if handler is None:
+            return 127, '', f'{args[0]}: command not found\n'
+        return handler(args)
+
+    def _run_script(self, script: str) -> CommandResult:
+        """Run 'a || b && c; d' left to right like sh, each command after the first
+        runs if the status so far passes its operator, always after ';'"""
+        lexer = shlex.shlex(script, posix=True, punctuation_chars=True)
+        lexer.whitespace_split = True
+        commands = [(';', [])]
+        for word in lexer:
+            if word in ('&&', '||', ';'):
+                commands.append((word, []))
+            else:
+                commands[-1][1].append(word)
+        status, stdout, stderr = 0, '', ''
+        for operator, args in commands:
+            if operator != ';' and (operator == '&&') != (status == 0):
+                continue
+            quiet = args[-2:] == ['>', '/dev/null']
+            if quiet:
+                args = args[:-2]
+            status, out, err = self._run_args(args) if args else (2, '', 'sh: syntax error\n')
+            stdout += '' if quiet else out
+            stderr += err
+        return status, stdout, stderr
+
+    def _exec(self, channel: paramiko.Channel, command: str) -> None:
+        try:
+            status, stdout, stderr = self.run(command, channel)
+            if stdout:
+                channel.sendall(stdout.encode())
+            if stderr:
+                channel.sendall_stderr(stderr.encode())
+            channel.send_exit_status(status)
+        except (paramiko.SSHException, EOFError, OSError):
+            pass
+        finally:
+            channel.close()
+
+
+def _read_line(channel: paramiko.Channel) -> str:
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = channel.recv(1)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode().rstrip('\n')
+
+
+class _Interface(paramiko.ServerInterface):
+
+    def __init__(self, server: FakeSSHServer):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        if username == self.server.username and password == self.server.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username, key):
+        if username == self.server.username:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        # The transport thread must not block on the sudo password
+        threading.Thread(target=self.server._exec, args=(channel, command.decode()),
+                         name='fake_ssh_exec', daemon=True).start()
+        return True
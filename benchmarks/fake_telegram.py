@@ -0,0 +1,175 @@
+"""Local stand-in for the Telegram Bot API used by the benchmarks.
+
+Point a bot at it with ``Updater(token, base_url=api.base_url)``. Updates are
+pushed with ``push_update`` and served through long polling ``getUpdates``,
+and every call the bot makes is recorded in ``calls``.
+"""
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional, Tuple
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Suckerfish', 'username': 'suckerfish_bot'}
+
+
+def command_update(text: str, chat_id: int = 1000, update_id: int = 0, message_id: int = 1) -> dict:
+    """A recorded update of a user sending a command"""
+    command = text.split()[0]
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'User'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        },
+    }
+
+
+def callback_update(data: str, chat_id: int = 1000, update_id: int = 0, message_id: int = 1) -> dict:
+    """A recorded update of a user pressing an inline keyboard button"""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(chat_id),
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private', 'first_name': 'User'},
+                'from': BOT_USER,
+                'text': 'Which OS do you want to boot?',
+            },
+        },
+    }
+
+
+class FakeTelegramAPI:
+    """Bot API server answering getMe, getUpdates and the message methods"""
+
+    def __init__(self, listen: str = '127.0.0.1', port: int = 0):
+        self.updates: List[dict] = []
+        self.calls: List[Tuple[float, str, dict]] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self._cond = threading.Condition()
+
+        self.httpd = ThreadingHTTPServer((listen, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake_telegram', daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self) -> 'FakeTelegramAPI':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def push_update(self, update: dict) -> int:
+        """Queue an update for getUpdates, returns its update_id"""
+        with self._cond:
+            update = dict(update, update_id=next(self._update_ids))
+            self.updates.append(update)
+            self._cond.notify_all()
+        return update['update_id']
+
+    def wait_calls(self, method: str, count: int = 1, since: int = 0, timeout: float = 10,
+                   match: Optional[Callable[[dict], bool]] = None) -> List[Tuple[float, str, dict]]:
+        """Wait for count calls to method made after the first since calls, whose params match
+
+        Returns the matching calls, fewer than count if the timeout expired.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                found = [call for call in self.calls[since:]
+                         if call[1] == method and (match is None or match(call[2]))]
+                remaining = deadline - time.monotonic()
+                if len(found) >= count or remaining <= 0:
+                    return found[:count]
+                self._cond.wait(remaining)
+
+    def wait_call(self, method: str, since: int = 0, timeout: float = 10,
+                  match: Optional[Callable[[dict], bool]] = None) -> Optional[Tuple[float, str, dict]]:
+        """Wait for a call to method made after the first since calls, whose params match"""
+        found = self.wait_calls(method, 1, since, timeout, match)
+        return found[0] if found else None
+
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self._cond:
+            # Confirmed updates are forgotten, like the real API does
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self.updates)
+
+    def _message(self, params: dict) -> dict:
+        return {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+
+    def call(self, method: str, params: dict):
+        """Answer an API call"""
+        if method == 'getUpdates':
+            return self._get_updates(params)
+
+        with self._cond:
+            self.calls.append((time.perf_counter(), method, params))
+            self._cond.notify_all()
+
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            return self._message(params)
+        return True
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are separate writes, don't let Nagle delay the body
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                try:
+                    params = json.loads(body) if body else {}
+                except ValueError:
+                    # Multipart uploads, the content is not needed
+                    params = {}
+                payload = json.dumps({'ok': True, 'result': api.call(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
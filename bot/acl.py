@@ -0,0 +1,61 @@
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+# Reply to a chat outside the ACL
+DENIED_TEXT = 'Only owner allowed'
+
+ChatId = Union[int, str]
+
+
+def chat_key(chat_id) -> ChatId:
+    """The chat id as Telegram sends it, an int, or the text for @usernames"""
+    text = str(chat_id).strip()
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+class ChatACL:
+    """The chats allowed to use the restricted commands.
+
+    Compiled once from allowed_chats into a frozenset keyed like the chat
+    ids of the updates, so every check is a single hash lookup whether the
+    update carries a message or a callback query. None allows every chat,
+    an empty list none.
+    """
+
+    def __init__(self, chats: Optional[Iterable] = None):
+        """Compile the ACL
+
+        Args:
+            chats (Iterable, optional): Chat ids as in the config, numbers or numeric strings.
+                Defaults to None, every chat.
+
+        Raises:
+            ValueError: If chats is a single value instead of a list of them.
+        """
+        if isinstance(chats, (str, bytes, int)):
+            raise ValueError(f"allowed_chats must be a list, not {chats!r}")
+        self.open = chats is None
+        # In the config order, for the notifications
+        self.chats: Tuple[ChatId, ...] = () if chats is None else tuple(dict.fromkeys(map(chat_key, chats)))
+        self._allowed = frozenset(self.chats)
+
+    def allows(self, chat_id: Optional[int]) -> bool:
+        """Whether the chat may use the restricted commands, no chat never may"""
+        if chat_id is None:
+            return False
+        return self.open or chat_id in self._allowed
+
+    def __iter__(self) -> Iterator[ChatId]:
+        """The chats to notify, none when every chat is allowed"""
+        return iter(self.chats)
+
+    def __bool__(self) -> bool:
+        return bool(self.chats)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ChatACL) and (self.open, self._allowed) == (other.open, other._allowed)
+
+    def __repr__(self) -> str:
+        return 'ChatACL(None)' if self.open else f'ChatACL({list(self.chats)})'
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Hashable, NamedTuple, Optional, Set
+
+from utils.metrics import REGISTRY
+
+# Actions on a host, only one of them runs at a time
+BOOT = 'boot'
+FORCE_SHUTDOWN = 'force_shutdown'
+POWER_SWITCH = 'power_switch'
+RESET_SWITCH = 'reset_switch'
+ARM = 'arm'
+
+DESCRIPTIONS = {
+    BOOT: 'booting {key}',
+    FORCE_SHUTDOWN: 'forcing a shutdown',
+    POWER_SWITCH: 'pressing the power switch',
+    RESET_SWITCH: 'pressing the reset switch',
+    ARM: 'arming {key} for the next boot',
+}
+
+# Outcomes of a request
+STARTED = 'started'
+JOINED = 'joined'  # The same action was already running, nothing was started
+REPEATED = 'repeated'  # Joined again by the same requester, e.g. a second tap on one button
+CONFLICT = 'conflict'  # Another action is running, nothing was started
+
+ACTIONS = REGISTRY.counter('suckerfish_actions', 'Action requests by outcome', ('action', 'outcome'))
+
+
+class Action:
+    """An action running on a host"""
+
+    def __init__(self, kind: str, key: Optional[str] = None):
+        self.kind = kind
+        self.key = key
+        self.future = Future()
+        self.started_at = time.monotonic()
+        self.requests = 1
+        self.requesters: Set[Hashable] = set()
+
+    @property
+    def description(self) -> str:
+        return DESCRIPTIONS.get(self.kind, self.kind).format(key=self.key)
+
+    def _complete(self, inner: Future) -> None:
+        """Resolve with the outcome of the future doing the work"""
+        if inner.cancelled():
+            self.future.cancel()
+        elif inner.exception() is not None:
+            self.future.set_exception(inner.exception())
+        else:
+            self.future.set_result(inner.result())
+
+
+def busy_text(label: str, action: Action, outcome: str) -> str:
+    """Reply to a request that did not start an action, label names the host"""
+    if outcome != CONFLICT:
+        return f"{label} is already {action.description}"
+    text = f"{label} is busy {action.description}"
+    return text + (", send /cancel to stop it" if action.kind == BOOT else ", try again when it is done")
+
+
+class ActionRequest(NamedTuple):
+    """What became of a request, the action is the one running in any case"""
+    outcome: str
+    action: Action
+
+
+class ActionCoordinator:
+    """Runs the actions of a host one at a time, coalescing duplicates.
+
+    A request for the action already running (same kind and key, e.g. a
+    second tap on the same boot button) joins it instead of starting it
+    again, a request for any other action is turned down. Neither waits:
+    the lock is only held to look at the running action, so a burst of
+    taps costs a dictionary lookup each and never presses a relay twice.
+    """
+
+    def __init__(self, name: str = '', logger=None):
+        """Initialize the coordinator
+
+        Args:
+            name (str, optional): Name of the host, used in the logs. Defaults to ''.
+        """
+        self.name = name
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._current: Optional[Action] = None
+        self._lock = threading.Lock()
+
+    @property
+    def current(self) -> Optional[Action]:
+        """The running action, None when idle"""
+        return self._current
+
+    def request(self, kind: str, start: Callable[[], Optional[Future]], key: Optional[str] = None,
+                requester: Optional[Hashable] = None) -> ActionRequest:
+        """Start an action unless it, or another one, is already running
+
+        Args:
+            kind (str): The action, e.g. BOOT.
+            start (Callable[[], Future]): Starts the work, called only if the action is started.
+                The action ends when the returned future resolves, at once if it returns None.
+            key (str, optional): What the action is done with, e.g. the OS to boot. Defaults to None.
+            requester (Hashable, optional): Who asks, e.g. the (chat_id, message_id) of a button,
+                to tell a repeated request from a new one. Defaults to None.
+
+        Returns:
+            ActionRequest: STARTED, JOINED, REPEATED or CONFLICT with the running action.
+        """
+        with self._lock:
+            current = self._current
+            if current is not None:
+                if current.kind == kind and current.key == key:
+                    current.requests += 1
+                    outcome = REPEATED if requester is not None and requester in current.requesters else JOINED
+                    if requester is not None:
+                        current.requesters.add(requester)
+                else:
+                    outcome = CONFLICT
+                ACTIONS.labels(kind, outcome).inc()
+                return ActionRequest(outcome, current)
+            action = Action(kind, key)
+            if requester is not None:
+                action.requesters.add(requester)
+            self._current = action
+        ACTIONS.labels(kind, STARTED).inc()
+        action.future.add_done_callback(lambda _: self._finished(action))
+
+        try:
+            inner = start()
+        except Exception as e:
+            action.future.set_exception(e)
+            raise
+        if inner is None:
+            action.future.set_result(None)
+        else:
+            inner.add_done_callback(action._complete)
+        return ActionRequest(STARTED, action)
+
+    def _finished(self, action: Action) -> None:
+        with self._lock:
+            if self._current is action:
+                self._current = None
+        if action.requests > 1:
+            self.logger.info(f"{self.name}: {action.description} served {action.requests} requests")
@@ -0,0 +1,510 @@
+#!/usr/bin/python3
+
+import asyncio
+import functools
+import html
+import ipaddress
+import logging
+import os
+import shlex
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from bot.acl import ChatACL
+from bot.async_host import AsyncHost
+from bot.async_telegram import (AsyncHTTPClient, AsyncLiveMessage, AsyncTelegramClient, BlockingTelegramClient,
+                                Message, TelegramAPIError, Update, inline_keyboard)
+from bot.fleet import Fleet, host_changes
+from bot.handlers import BotHandlers
+from bot.host import Host
+from bot.host_monitor import HostState
+from bot.lanes import BUSY_TEXT
+from bot.network_identity import LOOKUPS, NetworkIdentity, local_addresses
+from bot.remote_exec import RemoteCommand
+from bot.ssh_pool import SSHPool
+from bot.steps import Steps, drive_async, wait_event
+from utils.metrics import REGISTRY, MetricsServer
+from utils.profiling import CPUProfiler, MemoryProfiler, handler_codes
+
+HANDLER_SECONDS = REGISTRY.histogram('suckerfish_handler_seconds', 'Time spent in each handler', ('handler',))
+HANDLER_ERRORS = REGISTRY.counter('suckerfish_handler_errors', 'Handlers that raised an exception', ('handler',))
+PENDING = REGISTRY.gauge('suckerfish_async_pending', 'Handlers running on the event loop')
+SHED = REGISTRY.counter('suckerfish_async_shed', 'Updates refused because max_pending handlers were running')
+
+# Handler of each command, the same as the ones of SuckerfishBot
+COMMANDS = {
+    'current_ip': 'current_ip',
+    'power_switch': 'press_power_switch',
+    'reset_switch': 'press_reset_switch',
+    'get_chat_id': 'send_user_chat_id',
+    'is_online': 'check_host_online',
+    'force_shutdown': 'force_shutdown',
+    'power_on': 'power_on',
+    'cancel': 'cancel_boot',
+    'run': 'run_command',
+    'next_boot': 'next_boot',
+    'telemetry': 'send_telemetry',
+    'stats': 'send_stats',
+    'profile': 'profile',
+    'memprofile': 'memprofile',
+}
+# Handler of the inline keyboard buttons, by the prefix of their callback data
+CALLBACKS = (
+    ('force_shutdown_', 'check_force_shutdown'),
+    ('power_on_', 'select_os'),
+)
+
+
+class AsyncSuckerfishBot(BotHandlers):
+    """SuckerfishBot on a single asyncio event loop.
+
+    The commands and replies are those of bot.suckerfish_bot.SuckerfishBot,
+    the handlers of bot.handlers.BotHandlers, but the updates are long polled
+    with AsyncTelegramClient and every handler, probe, relay pulse and wait
+    runs on one event loop thread, instead of the dispatcher, the handler
+    lanes and the monitor, telemetry and boot threads of every host. Paramiko
+    only blocks, so the ssh commands run on ssh_workers threads, and each /run
+    streams from a thread of its own. Updates arriving while max_pending
+    handlers run are answered busy. python-telegram-bot is not imported at
+    all. The updates are only polled, there is no webhook.
+    """
+
+    def __init__(self,
+                 bot_token: str,
+                 hosts: List[dict],
+                 allowed_chats: List[str] = None,
+                 logger=None,
+                 state_dir: str = '.',
+                 notify_host_changes: bool = True,
+                 lazy_init: bool = False,
+                 base_url: Optional[str] = None,
+                 metrics: Optional[dict] = None,
+                 run_commands: Optional[Dict[str, str]] = None,
+                 network: Optional[dict] = None,
+                 ssh_workers: int = 2,
+                 max_pending: int = 100,
+                 poll_timeout: float = 10):
+        """Initialize the bot, see SuckerfishBot for the arguments they share
+
+        Args:
+            hosts (List[dict]): Keyword arguments of each bot.host.Host, as given by get_config.
+                An async_prober (bot.async_host.AsyncHostProber) replaces the prober of the host.
+            ssh_workers (int, optional): Threads running the ssh commands of all the hosts. Defaults to 2.
+            max_pending (int, optional): Handlers running at once before answering busy. Defaults to 100.
+            poll_timeout (float, optional): Seconds each getUpdates waits for updates. Defaults to 10.
+        """
+        self.bot_token = bot_token
+        self.base_url = base_url
+        self.acl = ChatACL(allowed_chats)
+        self.notify_host_changes = notify_host_changes
+        self.lazy_init = lazy_init
+        self.run_commands = dict(run_commands or {})
+        self.max_pending = max_pending
+        self.poll_timeout = poll_timeout
+
+        # Running /run commands by host name, None while they start
+        self.runs: Dict[str, Optional[RemoteCommand]] = {}
+        self._runs_lock = threading.Lock()
+
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+
+        self.telegram = AsyncTelegramClient(self.bot_token, base_url, logger=self.logger)
+        # The public ip providers, one at a time
+        self.http = AsyncHTTPClient(max_connections=1)
+
+        # The hosts share one ssh pool and its workers, everything else runs on the loop
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self.ssh_pool = SSHPool(logger=self.logger)
+        self.ssh_executor = ThreadPoolExecutor(max_workers=ssh_workers, thread_name_prefix='ssh')
+        self.fleet = Fleet([self.make_host(host_config) for host_config in hosts])
+        if not self.lazy_init:
+            self.warm_up()
+
+        # Config of the running hosts and of the configured ones, they differ while a host is busy
+        self.host_configs = {host_config['name']: host_config for host_config in hosts}
+        self._wanted_hosts = dict(self.host_configs)
+        self._hosts_retry: Optional[asyncio.TimerHandle] = None
+
+        # Local and public ips of the bot, refreshed by a task for /current_ip
+        network = dict(network or {})
+        self.notify_ip_changes = network.pop('notify', True)
+        self.network = NetworkIdentity(os.path.join(state_dir, 'network.json'),
+                                       on_change=self.notify_public_ip,
+                                       logger=self.logger,
+                                       **network)
+
+        self.metrics_config = metrics
+        self.metrics_server: Optional[MetricsServer] = None
+
+        # Idle until /profile and /memprofile, nothing wraps the handlers
+        handlers = list(COMMANDS.values()) + [name for _, name in CALLBACKS]
+        self.cpu_profiler = CPUProfiler(handlers=handler_codes(getattr(self, name) for name in handlers),
+                                        logger=self.logger)
+        self.memory_profiler = MemoryProfiler()
+
+        # Created here so threads can queue calls on it before start(), e.g. the dev chat logger
+        self.loop = asyncio.new_event_loop()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = asyncio.Event()
+        self._network_wakeup = asyncio.Event()
+        self._tasks = set()
+        self._pending = 0
+        PENDING.set_function(lambda: self._pending)
+
+    def make_host(self, host_config: dict) -> AsyncHost:
+        """A host of the fleet from its config"""
+        host_config = dict(host_config)
+        prober = host_config.pop('async_prober', None)
+        host = Host(ssh_pool=self.ssh_pool,
+                    state_dir=self.state_dir,
+                    on_change=self.notify_host_state,
+                    logger=self.logger,
+                    **host_config)
+        return AsyncHost(host, self.ssh_executor, self.telegram, prober=prober, logger=self.logger)
+
+    def reload_config(self, bot_config: dict) -> None:
+        """Apply a config from get_config while running, see SuckerfishBot.reload_config
+
+        Safe to call from any thread, it is applied on the loop.
+        """
+        self.spawn_threadsafe(self._reload_config(bot_config))
+
+    async def _reload_config(self, bot_config: dict) -> None:
+        acl = ChatACL(bot_config['allowed_chats'])
+        if acl != self.acl:
+            self.logger.info(f"Allowed chats are now {acl}")
+        self.acl = acl
+        self.notify_host_changes = bot_config['notify_host_changes']
+        self.run_commands = dict(bot_config['run_commands'])
+        network = dict(bot_config['network'])
+        self.notify_ip_changes = network.pop('notify', True)
+        providers, ttl = self.network.providers, self.network.ttl
+        self.network.configure(**network)
+        if self.network.providers != providers or self.network.ttl < ttl:
+            # Not waiting out the old ttl, as NetworkIdentity does
+            self._network_wakeup.set()
+
+        self._wanted_hosts = {host_config['name']: host_config for host_config in bot_config['hosts']}
+        await self.apply_hosts()
+
+    def host_busy(self, host: AsyncHost) -> bool:
+        """Whether the host runs something a reconfiguration would cut short"""
+        return host.actions.current is not None or host.boot.busy or host.name in self.runs
+
+    async def apply_hosts(self) -> None:
+        """Retire and start hosts to match the configured ones, retried later while some are busy"""
+        if self._hosts_retry is not None:
+            self._hosts_retry.cancel()
+            self._hosts_retry = None
+        changes = host_changes(self.host_configs, self._wanted_hosts,
+                               [host.name for host in self.fleet if self.host_busy(host)])
+        for name in changes.retire:
+            host = self.fleet.get(name)
+            # Gone from the commands before its pins are released
+            if name not in self._wanted_hosts:
+                self.fleet.remove(name)
+            await host.stop()
+            await host.call(host.host.release_pins)
+            await host.call(self.ssh_pool.discard, host.host.ssh)
+            del self.host_configs[name]
+            self.logger.info(f"{name} {'reconfigured' if name in self._wanted_hosts else 'removed'}")
+        for host_config in changes.create:
+            host = self.make_host(host_config)
+            self.fleet.put(host)
+            self.host_configs[host.name] = host_config
+            if not self.lazy_init:
+                try:
+                    await host.call(host.host.warm_up)
+                except Exception as e:
+                    # Retried on first use, where the error reaches the user
+                    self.logger.error(f"Could not initialize {host.name}: {e}")
+            host.start()
+        if changes.deferred:
+            self.logger.info(f"{', '.join(changes.deferred)} will be reconfigured once idle")
+            self._hosts_retry = self.loop.call_later(5, lambda: self.spawn(self.apply_hosts()))
+
+    def spawn(self, coro) -> asyncio.Task:
+        """Run a coroutine as a task of the loop, keeping a reference until it is done"""
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def spawn_threadsafe(self, coro) -> None:
+        """spawn from any thread, queued until the loop runs and dropped once it is closed"""
+        if self.loop.is_closed():
+            coro.close()
+            return
+        self.loop.call_soon_threadsafe(self.spawn, coro)
+
+    def notify_host_state(self, host: Host, state: HostState) -> None:
+        """Tell the allowed chats a host went online or offline"""
+        if not self.notify_host_changes or not self.acl:
+            return
+        self.spawn_threadsafe(self._send_allowed_chats(
+            f"{self.host_label(host)} is now {'online' if state.online else 'offline'}"))
+
+    def notify_public_ip(self, old: Optional[str], new: str) -> None:
+        """Tell the allowed chats the public ip of the bot changed"""
+        if not self.notify_ip_changes or not self.acl:
+            return
+        self.spawn_threadsafe(self._send_allowed_chats(f"Public ip changed from {old} to {new}"))
+
+    async def _send_allowed_chats(self, text: str) -> None:
+        for chat_id in self.acl:
+            try:
+                await self.telegram.send_message(chat_id, text)
+            except Exception as e:
+                self.logger.warning(f"Could not notify chat {chat_id}: {e}")
+
+    def start(self, webhook: Optional[dict] = None):
+        """Start the bot on an event loop in a background thread
+
+        Args:
+            webhook (dict, optional): Not supported, the updates are polled. Defaults to None.
+        """
+        if webhook is not None:
+            raise ValueError('The asyncio runtime polls for updates, it has no webhook')
+        self._thread = threading.Thread(target=self._run_loop, name='asyncio_loop', daemon=True)
+        self._thread.start()
+
+        if self.metrics_config is not None:
+            self.metrics_server = MetricsServer(REGISTRY, logger=self.logger, **self.metrics_config)
+            self.metrics_server.start()
+
+    def dev_chat_client(self, token: str) -> BlockingTelegramClient:
+        """A client for DevChatLogger.use_client on the connections of the bot, running on its loop"""
+        client = self.telegram
+        if token != self.bot_token:
+            client = AsyncTelegramClient(token, self.base_url, http=self.telegram.http, logger=self.logger)
+        return BlockingTelegramClient(client, self.loop)
+
+    def warm_up(self):
+        """Claim the GPIO pins and load the ssh keys of every host"""
+        t_start = time.monotonic()
+        for host in self.fleet:
+            try:
+                host.warm_up()
+            except Exception as e:
+                if not self.lazy_init:
+                    raise
+                # Retried on first use, where the error reaches the user
+                self.logger.error(f"Could not initialize {host.name}: {e}")
+        self.logger.info(f"Hosts initialized in {time.monotonic() - t_start:.2f} s")
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.run())
+        finally:
+            self.loop.close()
+
+    async def run(self) -> None:
+        """Poll and handle the updates until stop()"""
+        try:
+            await self.telegram.get_me()
+        except Exception as e:
+            # Commands addressed to any bot are taken until it is known
+            self.logger.warning(f"Could not get the bot user: {e}")
+
+        # Start the monitors and pick up boots interrupted by a restart
+        for host in self.fleet:
+            host.start()
+        workers = [self.spawn(self._poll()), self.spawn(self._refresh_network())]
+        if self.lazy_init:
+            # Already answering, load the slow subsystems in the background
+            self.loop.run_in_executor(self.ssh_executor, self.warm_up)
+
+        await self._stopped.wait()
+        if self._hosts_retry is not None:
+            self._hosts_retry.cancel()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await asyncio.gather(*(host.stop() for host in self.fleet), return_exceptions=True)
+        # Whatever is still running, e.g. a handler waiting on the API
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.telegram.close()
+        self.http.close()
+
+    def stop(self) -> None:
+        """Stop polling and the hosts' tasks, wait for the loop to finish"""
+        if self._thread is not None and self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self._stopped.set)
+            self._thread.join()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.ssh_executor.shutdown(wait=False)
+        self.ssh_pool.close_all()
+
+    def idle(self, stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT)) -> None:
+        """Run the bot until one of the stop signals is received, then stop it"""
+        received = threading.Event()
+        for signum in stop_signals:
+            signal.signal(signum, lambda signum, frame: received.set())
+        while not received.wait(1):
+            if self._thread is None or not self._thread.is_alive():
+                break
+        self.stop()
+
+    async def _poll(self) -> None:
+        offset = None
+        delay = 1
+        while True:
+            try:
+                updates = await self.telegram.get_updates(offset, self.poll_timeout)
+            except (TelegramAPIError, OSError, asyncio.TimeoutError, ValueError) as e:
+                self.logger.warning(f"Could not get the updates, retrying in {delay} s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = 1
+            for data in updates:
+                offset = data['update_id'] + 1
+                self.dispatch(Update(self.telegram, data))
+
+    def route(self, update: Update) -> Optional[Tuple[str, List[str]]]:
+        """The (handler name, arguments) of an update, None if no handler takes it"""
+        if update.callback_query is not None:
+            for prefix, name in CALLBACKS:
+                if update.callback_query.data.startswith(prefix):
+                    return name, []
+            return None
+        command = update.command(self.telegram.username)
+        if command is None or command[0] not in COMMANDS:
+            return None
+        return COMMANDS[command[0]], command[1]
+
+    def dispatch(self, update: Update) -> None:
+        """Run the handler of an update as a task, answering busy if max_pending are running"""
+        route = self.route(update)
+        if route is None:
+            return
+        name, args = route
+        if self._pending >= self.max_pending:
+            SHED.inc()
+            self.logger.warning(f"{self._pending} handlers running, refused {name}")
+            self.spawn(self.reply_busy(update))
+            return
+        self._pending += 1
+        self.spawn(self._handle(name, update, args))
+
+    async def _handle(self, name: str, update: Update, args: List[str]) -> None:
+        """Run a handler, recording its latency and errors"""
+        t_start = time.perf_counter()
+        try:
+            await drive_async(getattr(self, name)(update, args))
+        except Exception as e:
+            HANDLER_ERRORS.labels(name).inc()
+            tb_string = ''.join(traceback.format_exception(None, e, e.__traceback__))
+            self.logger.error(f"Exception while handling an update in {name}:\n<pre>{html.escape(tb_string)}</pre>")
+        finally:
+            self._pending -= 1
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - t_start)
+
+    async def reply_busy(self, update: Update) -> None:
+        """Tell the user a command was refused"""
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(text=BUSY_TEXT)
+            elif update.effective_message is not None:
+                await update.effective_message.reply_text(BUSY_TEXT)
+        except Exception as e:
+            self.logger.warning(f"Could not send the busy reply: {e}")
+
+    async def _refresh_network(self) -> None:
+        """NetworkIdentity's refresh loop, with the lookups on the event loop"""
+        while True:
+            t_start = time.time()
+            try:
+                state = self.network.apply(local_addresses(), *await self.lookup_public_ip())
+                answered = state.checked_at is not None and state.checked_at >= t_start
+            except Exception as e:
+                self.logger.error(f"Network identity refresh failed: {e}")
+                answered = False
+            ttl = self.network.ttl
+            await wait_event(self._network_wakeup, ttl if answered else min(ttl, self.network.retry_interval))
+            self._network_wakeup.clear()
+
+    async def lookup_public_ip(self) -> Tuple[Optional[str], Optional[str]]:
+        """Ask the providers in order until one answers, see NetworkIdentity.lookup_public_ip"""
+        for provider in self.network.providers:
+            t_start = time.monotonic()
+            try:
+                response = await self.http.request('GET', provider, headers={'User-Agent': 'suckerfish-bot'},
+                                                   timeout=self.network.timeout)
+                if response.status >= 400:
+                    raise ValueError(f"HTTP {response.status}")
+                public_ip = str(ipaddress.ip_address(response.body.decode().strip()))
+            except Exception as e:
+                LOOKUPS.labels(provider, 'error').observe(time.monotonic() - t_start)
+                self.logger.debug(f"Public ip lookup at {provider} failed: {e}")
+                continue
+            LOOKUPS.labels(provider, 'ok').observe(time.monotonic() - t_start)
+            return public_ip, provider
+        self.logger.warning(f"Could not get the public ip from any of {len(self.network.providers)} providers")
+        return None, None
+
+    # Runtime hooks of BotHandlers
+    def update_chat_id(self, update: Update) -> Optional[int]:
+        return update.effective_chat_id
+
+    def keyboard(self, rows: Sequence[Sequence[Tuple[str, str]]]) -> dict:
+        return inline_keyboard(rows)
+
+    def blocking(self, func: Callable, *args) -> asyncio.Future:
+        # Off the loop, on the default executor
+        return self.loop.run_in_executor(None, functools.partial(func, *args))
+
+    def ssh_call(self, host: AsyncHost, func: Callable, *args):
+        return host.call(func, *args)
+
+    async def map_hosts(self, steps_of: Callable[[AsyncHost], Steps],
+                        hosts: List[AsyncHost]) -> List[Tuple[AsyncHost, object]]:
+        results = await asyncio.gather(*(drive_async(steps_of(host)) for host in hosts), return_exceptions=True)
+        return list(zip(hosts, results))
+
+    def on_done(self, future: asyncio.Future, func: Callable, *args) -> None:
+        future.add_done_callback(lambda _: self.spawn_threadsafe(func(*args)))
+
+    def refresh_network_soon(self) -> None:
+        self._network_wakeup.set()
+
+    def start_run(self, host: AsyncHost, name: str, message: Message) -> None:
+        self.spawn(self._run_remote(host, name, message))
+
+    def start_arming(self, host: AsyncHost, name: str, message: Message) -> asyncio.Task:
+        return self.spawn(drive_async(self._arm_next_boot(host, name, message)))
+
+    async def _run_remote(self, host: AsyncHost, name: str, message: Message) -> None:
+        """Stream a /run command into its message"""
+        live = AsyncLiveMessage(message, f"{name} on {host.name}", logger=self.logger)
+        loop = asyncio.get_running_loop()
+
+        def stream() -> Optional[int]:
+            remote = host.stream_sudo_command(f"sh -c {shlex.quote(self.run_commands[name])}")
+            loop.call_soon_threadsafe(self.runs.__setitem__, host.name, remote)
+            for _, line in remote:
+                loop.call_soon_threadsafe(live.append, line)
+            return remote.exit_status
+
+        try:
+            # Commands may run for minutes, on a thread of the default executor rather than an ssh worker
+            exit_status = await loop.run_in_executor(None, stream)
+            status = 'Stopped' if exit_status is None else f"Exited with status {exit_status}"
+        except Exception as e:
+            self.logger.error(f"Could not run {name} on {host.name}: {e}")
+            status = f"Failed: {e}"
+        finally:
+            self.runs.pop(host.name, None)
+        await live.finish(status)
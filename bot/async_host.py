@@ -0,0 +1,391 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import Executor
+from typing import Callable, Optional, Tuple
+
+from bot.actions import BOOT
+from bot.boot_flow import BootJob, BootOrchestrator
+from bot.fingerprint import (CLOSED, FILTERED, OPEN, SSH, Fingerprint, OSFingerprinter, make_fingerprint,
+                             settled, ssh_banner)
+from bot.gpio_scheduler import PULSE_SECONDS
+from bot.host import Host
+from bot.host_monitor import HostState
+from bot.probe import HostProber, ProbeResult
+from bot.steps import drive_async, wait_event
+
+
+class AsyncHostProber(HostProber):
+    """The probes of a HostProber as coroutines.
+
+    The ICMP reply and the TCP connect are waited for on the event loop, so
+    probing every host at once takes no thread at all. The fallback order and
+    the waits are the ones of HostProber.
+    """
+
+    def __init__(self, prober: HostProber):
+        """Initialize the prober
+
+        Args:
+            prober (HostProber): The prober whose ip, ports and timeout are used.
+        """
+        super().__init__(prober.host_ip, prober.timeout, prober.tcp_ports, prober.use_icmp)
+
+    async def probe(self, timeout: Optional[float] = None) -> ProbeResult:
+        """Probe the host once, ICMP first and then each TCP port"""
+        return await drive_async(self._probe_steps(timeout))
+
+    async def is_online(self, timeout: Optional[float] = None) -> bool:
+        """Return True if the host answers a probe"""
+        return (await self.probe(timeout)).online
+
+    async def wait_online(self,
+                          timeout: float,
+                          interval: float = 0.5,
+                          probe_timeout: Optional[float] = None,
+                          stop_event: Optional[asyncio.Event] = None) -> ProbeResult:
+        """Probe until the host answers or the timeout expires, see HostProber.wait_online"""
+        return await drive_async(self._wait_online_steps(timeout, interval, probe_timeout, stop_event))
+
+    async def probe_icmp(self, timeout: float) -> Optional[float]:
+        """Send one ICMP echo request, return the rtt or None if no reply"""
+        sock, is_raw = self.open_icmp_socket()
+        if sock is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+        seq, packet = self.echo_request()
+        sock.setblocking(False)
+        try:
+            t_sent = time.monotonic()
+            sock.sendto(packet, (self.host_ip, 0))
+            deadline = t_sent + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                readable = loop.create_future()
+                loop.add_reader(sock.fileno(), lambda: readable.done() or readable.set_result(None))
+                try:
+                    await asyncio.wait_for(readable, remaining)
+                except asyncio.TimeoutError:
+                    return None
+                finally:
+                    loop.remove_reader(sock.fileno())
+                try:
+                    data, addr = sock.recvfrom(1024)
+                except BlockingIOError:
+                    continue
+                if self.is_echo_reply(data, addr, seq, is_raw):
+                    return time.monotonic() - t_sent
+        except OSError:
+            return None
+        finally:
+            sock.close()
+
+    async def probe_tcp(self, port: int, timeout: float, open_only: bool = False) -> Optional[float]:
+        """Try a TCP connection to the port, see HostProber.probe_tcp"""
+        t_start = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host_ip, port), timeout)
+            writer.close()
+        except ConnectionRefusedError:
+            # A RST means the host is up even if nothing listens on the port
+            if open_only:
+                return None
+        except (OSError, asyncio.TimeoutError):
+            return None
+        return time.monotonic() - t_start
+
+
+class AsyncFingerprinter:
+    """The fingerprint of an OSFingerprinter as a coroutine, every port a task of the loop"""
+
+    def __init__(self, fingerprinter: OSFingerprinter):
+        self.host_ip = fingerprinter.host_ip
+        self.ports = fingerprinter.ports
+        self.timeout = fingerprinter.timeout
+
+    async def fingerprint(self, timeout: Optional[float] = None) -> Fingerprint:
+        """Connect to every service at once and tell the OS from the answers, see OSFingerprinter"""
+        t_start = time.monotonic()
+        deadline = t_start + (self.timeout if timeout is None else timeout)
+        tasks = {asyncio.ensure_future(self._check(service, port, deadline)): service
+                 for service, port in self.ports.items()}
+        ports, banner = {}, None
+        pending = set(tasks)
+        try:
+            while pending and not settled(ports, banner):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    ports[tasks[task]], answer = task.result()
+                    banner = banner or answer
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return make_fingerprint(ports, banner, t_start)
+
+    async def _check(self, service: str, port: int, deadline: float) -> Tuple[str, Optional[str]]:
+        """State of a port, and the banner if it is the ssh server"""
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host_ip, port),
+                                                    max(0.0, deadline - time.monotonic()))
+        except ConnectionRefusedError:
+            return CLOSED, None
+        except (OSError, asyncio.TimeoutError):
+            return FILTERED, None
+        try:
+            if service != SSH:
+                return OPEN, None
+            data = b''
+            while ssh_banner(data) is None and len(data) <= 1024:
+                chunk = await asyncio.wait_for(reader.read(256), max(0.0, deadline - time.monotonic()))
+                if not chunk:
+                    break
+                data += chunk
+            return OPEN, ssh_banner(data)
+        except (OSError, asyncio.TimeoutError):
+            return OPEN, None
+        finally:
+            writer.close()
+
+
+class AsyncHost:
+    """A Host driven from the event loop.
+
+    Wraps a bot.host.Host, whose grub menu, boot history, telemetry store,
+    monitor state and action coordinator are used as they are, and takes the
+    place of its threads: the probes, relay pulses and waits are coroutines,
+    the monitor and telemetry loops are tasks, and the boots run on an
+    AsyncBootOrchestrator. Paramiko only blocks, so the ssh commands go to
+    ssh_executor, shared by the hosts. Anything not defined here is the Host's.
+    """
+
+    def __init__(self, host: Host, ssh_executor: Executor, telegram=None,
+                 prober: Optional[AsyncHostProber] = None, logger=None):
+        """Initialize the host, nothing runs until start()
+
+        Args:
+            host (Host): The host, its start() is never called.
+            ssh_executor (Executor): Runs the blocking ssh commands.
+            telegram (AsyncTelegramClient, optional): Client used to report boot progress. Defaults to None.
+            prober (AsyncHostProber, optional): Prober to use instead of the one of the host.
+        """
+        self.host = host
+        self.ssh_executor = ssh_executor
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+        self.prober = AsyncHostProber(host.prober) if prober is None else prober
+        self.fingerprinter = AsyncFingerprinter(host.fingerprinter)
+
+        # The host checks it to tell a boot of the bot from one by hand
+        self.boot = AsyncBootOrchestrator(self, telegram, journal_file=host.boot.journal_file, logger=self.logger)
+        host.boot = self.boot
+
+        self._pin_locks = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks = []
+
+    def __getattr__(self, name: str):
+        return getattr(self.host, name)
+
+    async def call(self, func: Callable, *args):
+        """Run a blocking Host method, e.g. one running ssh commands, on the ssh executor"""
+        return await asyncio.get_running_loop().run_in_executor(self.ssh_executor, functools.partial(func, *args))
+
+    def start(self) -> None:
+        """Start the monitor and telemetry tasks and resume an interrupted boot, from the loop"""
+        self._wakeup = asyncio.Event()
+        self._tasks.append(asyncio.ensure_future(self._monitor()))
+        if self.host.telemetry_sampler is not None:
+            self._tasks.append(asyncio.ensure_future(self._sample_telemetry()))
+        resumed = self.boot.resume()
+        if resumed is not None:
+            # Taps on the boot button join it instead of being turned down
+            self.actions.request(BOOT, lambda: resumed, key=getattr(self.boot.job, 'os_name', None))
+
+    async def stop(self) -> None:
+        """Stop the tasks, a running boot stays in the journal"""
+        self.boot.shutdown()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        await self.call(self.telemetry.save)
+        await self.call(self.ssh.close)
+
+    # Relays
+    def _device(self, pin: str):
+        # Claimed on first use, like the pulses of the host
+        self.host.pulses
+        return self.host.power_switch if pin == 'power' else self.host.reset_switch
+
+    async def pulse(self, pin: str, duration: float) -> float:
+        """Close the relay of pin ('power' or 'reset') for duration seconds
+
+        Pulses on the same relay run one after the other. The relay is opened
+        again if the task is cancelled.
+
+        Returns:
+            float: The measured pulse length.
+        """
+        device = self._device(pin)
+        lock = self._pin_locks.get(pin)
+        if lock is None:
+            lock = self._pin_locks[pin] = asyncio.Lock()
+        async with lock:
+            device.on()
+            t_start = time.monotonic()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                device.off()
+            elapsed = time.monotonic() - t_start
+        self.logger.debug(f"Pin {pin} released after {elapsed:.3f} s")
+        PULSE_SECONDS.labels(pin).observe(elapsed)
+        return elapsed
+
+    def power_switch_action(self) -> asyncio.Future:
+        """Press the power switch for pulse_time, the future resolves on release"""
+        return asyncio.ensure_future(self.pulse('power', self.pulse_time))
+
+    def reset_switch_action(self) -> asyncio.Future:
+        """Press the reset switch for pulse_time, the future resolves on release"""
+        return asyncio.ensure_future(self.pulse('reset', self.pulse_time))
+
+    def power_switch_hold(self) -> asyncio.Future:
+        """Hold the power switch for hold_time, the future resolves on release"""
+        return asyncio.ensure_future(self.pulse('power', self.hold_time))
+
+    def force_shutdown(self) -> asyncio.Future:
+        """Hold the power switch, arming arm_at_shutdown first if set"""
+        return asyncio.ensure_future(self._force_shutdown())
+
+    async def _force_shutdown(self) -> float:
+        if self.arm_at_shutdown is not None:
+            # Fails when the host doesn't run the default OS, the shutdown goes on
+            try:
+                await self.call(self.host.arm_next_boot, self.arm_at_shutdown)
+            except Exception as e:
+                self.logger.error(f"Could not arm {self.arm_at_shutdown} before the shutdown of {self.name}: {e}")
+        return await self.pulse('power', self.hold_time)
+
+    # Liveness
+    async def current(self, max_age: Optional[float] = None) -> HostState:
+        """The cached state of the monitor, probing first if it is older than max_age (its ttl by default)"""
+        max_age = self.monitor.ttl if max_age is None else max_age
+        state = self.monitor.state
+        if state is None or time.monotonic() - state.checked_at > max_age:
+            state = self.monitor.record(await self.prober.probe())
+        return state
+
+    async def is_online(self, max_age: Optional[float] = None) -> bool:
+        """Check if the host pc is online, answered from the monitor cache when fresh"""
+        return (await self.current(max_age)).online
+
+    async def os_fingerprint(self, max_age: Optional[float] = None) -> Fingerprint:
+        """The cached fingerprint of the running OS, taken again if it is stale, see Host.cached_fingerprint"""
+        fingerprint = self.host.cached_fingerprint(max_age)
+        if fingerprint is None:
+            fingerprint = self.host.record_fingerprint(await self.fingerprinter.fingerprint())
+        return fingerprint
+
+    def expect_transition(self, duration: float = 120) -> None:
+        """Probe densely for the next duration seconds, e.g. during a boot"""
+        self.monitor.expect_transition(duration)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _monitor(self) -> None:
+        while True:
+            try:
+                self.monitor.record(await self.prober.probe())
+            except Exception as e:
+                self.logger.error(f"Host monitor probe failed: {e}")
+            await wait_event(self._wakeup, self.monitor.next_interval())
+            self._wakeup.clear()
+
+    async def _sample_telemetry(self) -> None:
+        sampler = self.host.telemetry_sampler
+        next_save = time.monotonic() + sampler.save_interval
+        while True:
+            await asyncio.sleep(sampler.interval)
+            try:
+                await self.call(sampler.sample)
+            except Exception as e:
+                self.logger.error(f"Telemetry of {self.name} failed: {e}")
+            if time.monotonic() >= next_save:
+                await self.call(self.telemetry.save)
+                next_save = time.monotonic() + sampler.save_interval
+
+    async def wait_for_host_online(self,
+                                   timeout: Optional[float] = None,
+                                   cancel: Optional[asyncio.Event] = None,
+                                   os_name: Optional[str] = None,
+                                   progress: Optional[Callable[[Optional[float]], None]] = None) -> bool:
+        """Wait for the host to come online, stops early if cancel is set, see Host.wait_for_host_online"""
+        return await drive_async(self.host.wait_online_steps(self.prober, timeout, cancel, os_name, progress))
+
+    async def default_os_running(self, cancel: Optional[asyncio.Event] = None) -> bool:
+        """Whether the default OS came up, see Host.default_os_running"""
+        return await drive_async(self.host.default_os_steps(self.prober,
+                                                            lambda timeout: self.call(self.host.connect_ssh, timeout),
+                                                            cancel))
+
+
+class AsyncBootOrchestrator(BootOrchestrator):
+    """BootOrchestrator whose steps are driven on the event loop.
+
+    The steps, the journal, the resume rules and the progress texts are the
+    ones of BootOrchestrator, only what the steps wait for and the message
+    edits are awaited instead of blocking the boot worker. Edits of a boot
+    are sent in order, one at a time.
+    """
+
+    def __init__(self, host: AsyncHost, telegram=None, journal_file: str = 'boot_journal.json',
+                 resume_window: float = 120, logger=None):
+        """Initialize the orchestrator, see BootOrchestrator
+
+        Args:
+            host (AsyncHost): The host whose switches, probes and ssh are used.
+            telegram (AsyncTelegramClient, optional): Client used to edit the progress messages.
+        """
+        super().__init__(host, telegram, journal_file, resume_window, logger)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._cancelled: Optional[asyncio.Event] = None
+        self._edits: Optional[asyncio.Lock] = None
+
+    def _submit(self, job: BootJob) -> asyncio.Future:
+        self._loop = asyncio.get_running_loop()
+        self._cancelled = asyncio.Event()
+        return asyncio.ensure_future(drive_async(self._run_steps(job)))
+
+    def cancel(self) -> bool:
+        if not super().cancel():
+            return False
+        if self._cancelled is not None:
+            # Also called by shutdown, from outside the loop
+            self._loop.call_soon_threadsafe(self._cancelled.set)
+        return True
+
+    def _cancel_event(self, job: BootJob) -> asyncio.Event:
+        return self._cancelled
+
+    def _call(self, func: Callable, *args):
+        return self.host.call(func, *args)
+
+    def _edit(self, job: BootJob, chat_id: int, message_id: int, text: str) -> None:
+        if self.telegram_bot is None:
+            return
+        if self._edits is None:
+            self._edits = asyncio.Lock()
+        asyncio.ensure_future(self._edit_async(job, chat_id, message_id, text))
+
+    async def _edit_async(self, job: BootJob, chat_id: int, message_id: int, text: str) -> None:
+        # The lock is fair, so the edits go out in the order they were made
+        async with self._edits:
+            try:
+                await self.telegram_bot.edit_message_text(chat_id, message_id, text)
+            except Exception as e:
+                self.logger.warning(f"Boot {job.job_id}: could not edit the progress message: {e}")
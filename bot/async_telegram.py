@@ -0,0 +1,462 @@
+import asyncio
+import concurrent.futures
+import copy
+import json
+import os
+import logging
+import ssl
+import time
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+from utils.metrics import REGISTRY
+from utils.text import render_output
+
+DEFAULT_BASE_URL = 'https://api.telegram.org/bot'
+
+API_SECONDS = REGISTRY.histogram('suckerfish_bot_api_seconds', 'Time of the Bot API calls of the asyncio runtime',
+                                 ('method', 'result'))
+
+
+class TelegramAPIError(Exception):
+    """The Bot API answered a call with an error"""
+
+    def __init__(self, description: str, retry_after: Optional[float] = None):
+        super().__init__(description)
+        self.retry_after = retry_after  # Seconds to wait when rate limited
+
+
+class BadRequest(TelegramAPIError):
+    """The API refused the call as invalid, e.g. markup that does not parse"""
+
+
+class RetryAfter(TelegramAPIError):
+    """The API rate limited the call, retry after retry_after seconds"""
+
+
+class HTTPResponse(NamedTuple):
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+
+class AsyncHTTPClient:
+    """Minimal HTTP/1.1 client on asyncio streams.
+
+    Just enough for the Bot API and the public ip providers: one request per
+    connection at a time, the connections of each origin are kept open and
+    reused, at most max_connections of them. Requests go out in a single
+    write. A request failing on a reused connection before any answer is
+    sent again on a new one, as the server may have closed it while idle.
+    """
+
+    def __init__(self, max_connections: int = 4):
+        """Initialize the client, connections are opened on first use
+
+        Args:
+            max_connections (int, optional): Connections open at once to each origin. Defaults to 4.
+        """
+        self.max_connections = max_connections
+        self._idle: Dict[Tuple[str, str, int], List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+        self._slots: Dict[Tuple[str, str, int], asyncio.Semaphore] = {}
+        self._ssl: Optional[ssl.SSLContext] = None
+
+    async def request(self, method: str, url: str, body: bytes = b'',
+                      headers: Optional[Dict[str, str]] = None, timeout: float = 10) -> HTTPResponse:
+        """Send a request and read the whole answer
+
+        Raises:
+            OSError: If the server could not be reached or closed the connection.
+            asyncio.TimeoutError: If the answer took longer than timeout seconds.
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        origin = (scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        head = [f'{method} {target} HTTP/1.1', f'Host: {parts.netloc}', 'Connection: keep-alive',
+                f'Content-Length: {len(body)}']
+        head += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        data = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+        slots = self._slots.get(origin)
+        if slots is None:
+            slots = self._slots[origin] = asyncio.Semaphore(self.max_connections)
+        async with slots:
+            idle = self._idle.setdefault(origin, [])
+            while True:
+                reused = bool(idle)
+                reader, writer = idle.pop() if reused else await asyncio.wait_for(self._connect(origin), timeout)
+                try:
+                    response, keep_alive = await asyncio.wait_for(self._exchange(reader, writer, data), timeout)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    if reused and not getattr(e, 'partial', b''):
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+                return response
+
+    async def _connect(self, origin: Tuple[str, str, int]):
+        scheme, host, port = origin
+        if scheme != 'https':
+            return await asyncio.open_connection(host, port)
+        if self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        return await asyncio.open_connection(host, port, ssl=self._ssl, server_hostname=host)
+
+    async def _exchange(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes):
+        """Write the request and read the answer, returns (response, whether the connection can be reused)"""
+        writer.write(data)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b'', None)
+        version, status, _ = status_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return HTTPResponse(int(status), headers, body), keep_alive
+
+    def close(self) -> None:
+        """Close the idle connections"""
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncTelegramClient:
+    """Bot API client for the asyncio runtime, sending json over AsyncHTTPClient"""
+
+    def __init__(self, token: str, base_url: Optional[str] = None, http: Optional[AsyncHTTPClient] = None,
+                 timeout: float = 10, logger=None):
+        """Initialize the client
+
+        Args:
+            token (str): The bot token.
+            base_url (str, optional): Bot API server url, the token is appended to it.
+                Defaults to Telegram's.
+            http (AsyncHTTPClient, optional): Client to send the calls with. Defaults to a new one.
+            timeout (float, optional): Seconds to wait for the answer of a call. Defaults to 10.
+        """
+        self.url = f"{base_url or DEFAULT_BASE_URL}{token}/"
+        self.http = AsyncHTTPClient() if http is None else http
+        self.timeout = timeout
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+        self.username: Optional[str] = None
+
+    async def call(self, method: str, params: Optional[dict] = None, timeout: Optional[float] = None,
+                   files: Optional[Dict[str, Tuple[str, bytes]]] = None):
+        """Call a Bot API method, parameters set to None are left out
+
+        Args:
+            files (Dict[str, Tuple[str, bytes]], optional): Files to upload by parameter, as
+                (filename, content), sent as multipart/form-data instead of json. Defaults to None.
+
+        Returns:
+            The result of the call.
+
+        Raises:
+            TelegramAPIError: If the API answered with an error, RetryAfter or BadRequest when it
+                is one of those.
+        """
+        params = {name: value for name, value in (params or {}).items() if value is not None}
+        if isinstance(params.get('reply_markup'), dict):
+            # Sent as a string, like python-telegram-bot does
+            params['reply_markup'] = json.dumps(params['reply_markup'])
+        if files:
+            body, content_type = multipart(params, files)
+        else:
+            body, content_type = json.dumps(params).encode(), 'application/json'
+        t_start = time.monotonic()
+        result = 'error'
+        try:
+            response = await self.http.request('POST', self.url + method, body, {'Content-Type': content_type},
+                                               timeout=self.timeout if timeout is None else timeout)
+            try:
+                answer = json.loads(response.body)
+            except ValueError:
+                raise TelegramAPIError(f"{method} answered with HTTP {response.status}")
+            if not answer.get('ok'):
+                description = answer.get('description') or f"{method} failed"
+                retry_after = (answer.get('parameters') or {}).get('retry_after')
+                if retry_after:
+                    raise RetryAfter(description, retry_after)
+                if answer.get('error_code') == 400:
+                    raise BadRequest(description)
+                raise TelegramAPIError(description)
+            result = 'ok'
+            return answer['result']
+        finally:
+            API_SECONDS.labels(method, result).observe(time.monotonic() - t_start)
+
+    async def get_me(self) -> dict:
+        me = await self.call('getMe')
+        self.username = me.get('username')
+        return me
+
+    async def get_updates(self, offset: Optional[int] = None, timeout: float = 10) -> List[dict]:
+        """Long poll for updates, waiting up to timeout seconds for one"""
+        params = {'offset': offset, 'timeout': timeout, 'allowed_updates': ['message', 'callback_query']}
+        return await self.call('getUpdates', params, timeout=self.timeout + timeout)
+
+    async def send_message(self, chat_id, text: str, reply_markup: Optional[dict] = None,
+                           parse_mode: Optional[str] = None) -> dict:
+        return await self.call('sendMessage', {'chat_id': chat_id, 'text': text, 'reply_markup': reply_markup,
+                                               'parse_mode': parse_mode})
+
+    async def edit_message_text(self, chat_id, message_id: int, text: str, reply_markup: Optional[dict] = None,
+                                parse_mode: Optional[str] = None):
+        return await self.call('editMessageText', {'chat_id': chat_id, 'message_id': message_id, 'text': text,
+                                                   'reply_markup': reply_markup, 'parse_mode': parse_mode})
+
+    async def answer_callback_query(self, callback_query_id: str, text: Optional[str] = None):
+        return await self.call('answerCallbackQuery', {'callback_query_id': callback_query_id, 'text': text})
+
+    async def send_document(self, chat_id, filename: str, content: bytes, caption: Optional[str] = None) -> dict:
+        return await self.call('sendDocument', {'chat_id': chat_id, 'caption': caption},
+                               files={'document': (filename, content)})
+
+    def close(self) -> None:
+        self.http.close()
+
+
+def multipart(params: dict, files: Dict[str, Tuple[str, bytes]]) -> Tuple[bytes, str]:
+    """multipart/form-data body and content type of the parameters and files of a call"""
+    boundary = os.urandom(16).hex()
+    parts = []
+    for name, value in params.items():
+        value = value if isinstance(value, str) else json.dumps(value)
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode()
+                     + value.encode() + b'\r\n')
+    for name, (filename, content) in files.items():
+        filename = filename.replace('"', '')
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class BlockingTelegramClient:
+    """An AsyncTelegramClient for threads, e.g. the sender of the dev chat logger.
+
+    The calls run on the event loop of the client, queued until it runs,
+    and the calling thread waits for them. Once the loop is closed they run
+    on a loop of their own. Has the send_message and send_document of
+    telegram.Bot that the logger uses, and its errors, network errors
+    included, so python-telegram-bot need not be imported.
+    """
+
+    # The RetryAfter, BadRequest and base error classes, as ChatSender expects them
+    errors = (RetryAfter, BadRequest, TelegramAPIError)
+
+    def __init__(self, client: AsyncTelegramClient, loop: asyncio.AbstractEventLoop, timeout: float = 30):
+        """Initialize the client
+
+        Args:
+            client (AsyncTelegramClient): Client doing the calls.
+            loop (asyncio.AbstractEventLoop): Loop of the client, the calls wait for it to run.
+            timeout (float, optional): Seconds to wait for a call. Defaults to 30.
+        """
+        self.client = client
+        self.loop = loop
+        self.timeout = timeout
+
+    def _call(self, method: str, *args, **kwargs):
+        if self.loop.is_closed():
+            future = None
+            call = lambda: asyncio.run(self._call_alone(method, *args, **kwargs))
+        else:
+            future = asyncio.run_coroutine_threadsafe(getattr(self.client, method)(*args, **kwargs), self.loop)
+            call = lambda: future.result(self.timeout)
+        try:
+            return call()
+        except concurrent.futures.TimeoutError as e:
+            if future is None or future.done():
+                raise TelegramAPIError(f'{method} timed out') from e
+            # e.g. the loop stopped, the call would never run
+            future.cancel()
+            raise TelegramAPIError(f'No answer from the event loop in {self.timeout:g} s') from e
+        except (OSError, asyncio.IncompleteReadError) as e:
+            # Network errors are TelegramErrors in telegram.Bot too
+            raise TelegramAPIError(f'{method} failed: {e!r}') from e
+
+    async def _call_alone(self, method: str, *args, **kwargs):
+        """A call once the loop is closed, e.g. the last messages of the logger, on a connection of its own"""
+        client = copy.copy(self.client)
+        client.http = AsyncHTTPClient(max_connections=1)
+        try:
+            return await getattr(client, method)(*args, **kwargs)
+        finally:
+            client.close()
+
+    def send_message(self, chat_id, text: str, parse_mode: Optional[str] = None) -> dict:
+        return self._call('send_message', chat_id, text, parse_mode=parse_mode)
+
+    def send_document(self, chat_id, document, filename: str, caption: Optional[str] = None) -> dict:
+        content = document.read() if hasattr(document, 'read') else document
+        return self._call('send_document', chat_id, filename, content, caption)
+
+
+def inline_keyboard(rows: Sequence[Sequence[Tuple[str, str]]]) -> dict:
+    """Reply markup of an inline keyboard from rows of (text, callback data)"""
+    return {'inline_keyboard': [[{'text': text, 'callback_data': data} for text, data in row] for row in rows]}
+
+
+class Message:
+    """A message of an update, answered through the client"""
+
+    def __init__(self, client: AsyncTelegramClient, data: dict):
+        self.client = client
+        self.message_id: int = data['message_id']
+        self.chat_id: int = data['chat']['id']
+        self.text: str = data.get('text') or ''
+
+    async def reply_text(self, text: str, reply_markup: Optional[dict] = None) -> 'Message':
+        """Send a message to the same chat"""
+        return Message(self.client, await self.client.send_message(self.chat_id, text, reply_markup))
+
+    async def edit_text(self, text: str, reply_markup: Optional[dict] = None) -> None:
+        await self.client.edit_message_text(self.chat_id, self.message_id, text, reply_markup)
+
+
+class CallbackQuery:
+    """A press on an inline keyboard button"""
+
+    def __init__(self, client: AsyncTelegramClient, data: dict):
+        self.client = client
+        self.id: str = data['id']
+        self.data: str = data.get('data') or ''
+        self.message = Message(client, data['message']) if data.get('message') else None
+
+    async def answer(self, text: Optional[str] = None) -> None:
+        await self.client.answer_callback_query(self.id, text)
+
+    async def edit_message_text(self, text: str) -> None:
+        await self.message.edit_text(text)
+
+
+class Update:
+    """An update from getUpdates, a message or a callback query"""
+
+    def __init__(self, client: AsyncTelegramClient, data: dict):
+        self.update_id: int = data['update_id']
+        self.message = Message(client, data['message']) if data.get('message') else None
+        self.callback_query = CallbackQuery(client, data['callback_query']) if data.get('callback_query') else None
+
+    @property
+    def effective_message(self) -> Optional[Message]:
+        if self.message is not None:
+            return self.message
+        return None if self.callback_query is None else self.callback_query.message
+
+    @property
+    def effective_chat_id(self) -> Optional[int]:
+        message = self.effective_message
+        return None if message is None else message.chat_id
+
+    def command(self, username: Optional[str] = None) -> Optional[Tuple[str, List[str]]]:
+        """The (command, arguments) of a command message, None for anything else
+
+        Commands addressed to another bot, as in /power_on@other_bot, are None too.
+        """
+        if self.message is None or not self.message.text.startswith('/'):
+            return None
+        words = self.message.text.split()
+        command, _, addressee = words[0][1:].partition('@')
+        if addressee and username is not None and addressee.lower() != username.lower():
+            return None
+        return command, words[1:]
+
+
+class AsyncLiveMessage:
+    """LiveMessage for the asyncio runtime: the last lines of a growing output, edits throttled"""
+
+    def __init__(self, message: Message, title: str, max_lines: int = 30, min_interval: float = 3.0,
+                 logger=None):
+        """Initialize the message
+
+        Args:
+            message (Message): The message to edit.
+            title (str): Shown above the output.
+            max_lines (int, optional): Output lines shown. Defaults to 30.
+            min_interval (float, optional): Seconds between edits. Defaults to 3.0.
+        """
+        self.message = message
+        self.title = title
+        self.min_interval = min_interval
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self.lines: Deque[str] = deque(maxlen=max_lines)
+        self.edits = 0
+        self._next_edit = 0.0
+        self._pending: Optional[asyncio.Task] = None
+
+    def append(self, line: str) -> None:
+        """Add an output line, the message is edited when the throttle allows"""
+        self.lines.append(line)
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._flush_later())
+
+    async def finish(self, status: str) -> None:
+        """Show the whole output with a final status, waiting for the throttle if needed"""
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        # The final status must get through, even after a rate limit
+        for _ in range(3):
+            await asyncio.sleep(max(0.0, self._next_edit - time.monotonic()))
+            if await self._flush(status):
+                return
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(max(0.0, self._next_edit - time.monotonic()))
+        self._pending = None
+        await self._flush()
+
+    async def _flush(self, status: str = '') -> bool:
+        """Edit the message now, returns False if Telegram asked to retry later"""
+        self._next_edit = time.monotonic() + self.min_interval
+        try:
+            await self.message.client.edit_message_text(self.message.chat_id, self.message.message_id,
+                                                        render_output(self.title, self.lines, status),
+                                                        parse_mode='HTML')
+            self.edits += 1
+        except TelegramAPIError as e:
+            if e.retry_after is not None:
+                self._next_edit = time.monotonic() + e.retry_after
+                self.logger.warning(f"Live message throttled by Telegram for {e.retry_after} s")
+                return False
+            # Nothing new since the last edit
+            if 'not modified' not in str(e).lower():
+                self.logger.warning(f"Could not edit the live message: {e}")
+        except (OSError, asyncio.TimeoutError) as e:
+            self.logger.warning(f"Could not edit the live message: {e}")
+        return True
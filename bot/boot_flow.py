@@ -0,0 +1,464 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from bot.steps import Steps, drive
+from utils.metrics import REGISTRY
+
+# Boot states, each one is a step of the boot sequence
+POWER_PULSE = 'power_pulse'
+WAIT_BOOT = 'wait_boot'
+WAIT_ARMED = 'wait_armed'
+CHECK_ARMED = 'check_armed'
+CONNECT_SSH = 'connect_ssh'
+ARM_ENTRY = 'arm_entry'
+RESET = 'reset'
+WAIT_REBOOT = 'wait_reboot'
+SECOND_RESET = 'second_reset'
+
+# Final states
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+ABORTED = 'aborted'
+
+BOOT_SECONDS = REGISTRY.histogram('suckerfish_boot_seconds', 'Time from the boot request to its final state',
+                                  ('os', 'result'))
+
+
+class BootStep(NamedTuple):
+    """A state of the boot sequence"""
+    state: str
+    description: str
+    presses_relay: bool
+
+
+STEPS: Dict[str, BootStep] = {
+    POWER_PULSE: BootStep(POWER_PULSE, 'pressing the power switch', True),
+    WAIT_BOOT: BootStep(WAIT_BOOT, 'waiting for the host to come online', False),
+    WAIT_ARMED: BootStep(WAIT_ARMED, 'waiting for the host to boot the armed entry', False),
+    CHECK_ARMED: BootStep(CHECK_ARMED, 'checking the armed entry was booted', False),
+    CONNECT_SSH: BootStep(CONNECT_SSH, 'connecting over ssh', False),
+    ARM_ENTRY: BootStep(ARM_ENTRY, 'setting the next boot entry', False),
+    RESET: BootStep(RESET, 'pressing the reset switch', True),
+    WAIT_REBOOT: BootStep(WAIT_REBOOT, 'waiting for the host to reboot', False),
+    SECOND_RESET: BootStep(SECOND_RESET, 'pressing the reset switch again', True),
+}
+
+# Sequence of states to boot the default grub entry
+DEFAULT_SEQUENCE = [POWER_PULSE, WAIT_BOOT]
+
+# Any other entry: the PC boots the default entry (Ubuntu) first and is then
+# rebooted into the target with grub-reboot
+# TODO Somehow a second reset switch is needed to boot Windows
+ARMED_SEQUENCE = [POWER_PULSE, WAIT_BOOT, CONNECT_SSH, ARM_ENTRY, RESET, WAIT_REBOOT, SECOND_RESET]
+
+# The entry was armed with /next_boot or at shutdown, a single power pulse
+# boots it. If the default OS comes up instead, the armed boot goes on from there
+PRE_ARMED_SEQUENCE = [POWER_PULSE, WAIT_ARMED, CHECK_ARMED]
+PRE_ARMED_FALLBACK = ARMED_SEQUENCE[2:]
+
+# The host already runs the default OS, the target is armed and reset into from there
+SWITCH_SEQUENCE = ARMED_SEQUENCE[2:]
+
+# Journals written before the boot targets came from the grub menu
+LEGACY_SEQUENCES: Dict[str, List[str]] = {'Windows': ARMED_SEQUENCE, 'Ubuntu': DEFAULT_SEQUENCE}
+LEGACY_STATES = {'arm_windows': ARM_ENTRY}
+
+
+class BootFailed(Exception):
+    """Raised by a step when the boot can't continue"""
+
+
+class BootCancelled(Exception):
+    """Raised by a step when the user cancelled the boot"""
+
+
+class BootJob:
+    """State of one boot, serialized to the journal after every transition"""
+
+    def __init__(self,
+                 os_name: str,
+                 chat_id: int,
+                 message_id: int,
+                 job_id: Optional[str] = None,
+                 sequence: Optional[List[str]] = None,
+                 armed_os: Optional[str] = None,
+                 watchers: Optional[List[List[int]]] = None,
+                 step: int = 0,
+                 phase: str = 'pending',
+                 state: Optional[str] = None,
+                 started_at: Optional[float] = None,
+                 updated_at: Optional[float] = None):
+        self.os_name = os_name
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.job_id = job_id or uuid.uuid4().hex[:8]
+        self.sequence = list(sequence or LEGACY_SEQUENCES.get(os_name, ARMED_SEQUENCE))
+        self.armed_os = armed_os  # OS armed before the power pulse, if any
+        self.watchers = [list(watcher) for watcher in watchers or []]  # Other [chat_id, message_id] to update
+        self.step = step
+        self.phase = phase  # 'pending' before the step runs, 'running' while it does
+        self.state = LEGACY_STATES.get(state, state) or self.sequence[0]
+        self.started_at = started_at or time.time()
+        self.updated_at = updated_at or self.started_at
+
+        self.cancel_event = threading.Event()
+        self.last_text: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {
+            'os_name': self.os_name,
+            'chat_id': self.chat_id,
+            'message_id': self.message_id,
+            'job_id': self.job_id,
+            'sequence': self.sequence,
+            'armed_os': self.armed_os,
+            'watchers': self.watchers,
+            'step': self.step,
+            'phase': self.phase,
+            'state': self.state,
+            'started_at': self.started_at,
+            'updated_at': self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BootJob':
+        return cls(**data)
+
+
+class BootOrchestrator:
+    """Runs the boot sequences as a state machine on a background thread.
+
+    The boot handler only starts the job and returns, progress is reported by
+    editing the Telegram message of the OS selection. Every transition is
+    written to a journal so that, after a restart, a boot that was in flight
+    can be resumed when it is safe, or aborted instead of repeating a relay press.
+    """
+
+    def __init__(self, host, telegram_bot=None, journal_file: str = 'boot_journal.json',
+                 resume_window: float = 120, logger=None):
+        """Initialize the orchestrator
+
+        Args:
+            host (Host): The host whose switches, probes and ssh are used.
+            telegram_bot (telegram.Bot, optional): Bot used to edit the progress messages. Defaults to None.
+            journal_file (str, optional): Where to journal the running boot. Defaults to 'boot_journal.json'.
+            resume_window (float, optional): Max seconds since the last transition to resume
+                a boot whose next step presses a relay. Defaults to 120.
+        """
+        self.host = host
+        self.telegram_bot = telegram_bot
+        self.journal_file = journal_file
+        self.resume_window = resume_window
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'boot_{host.name}')
+        self.job: Optional[BootJob] = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    @property
+    def busy(self) -> bool:
+        """True while a boot is running"""
+        return self.job is not None
+
+    def start(self, os_name: str, chat_id: int, message_id: int, from_default_os: bool = False) -> Optional[Future]:
+        """Start booting the given OS in the background
+
+        The default grub entry boots straight away, any other one is armed
+        with grub-reboot from the default OS. If an entry was armed while the
+        host was up, the power pulse boots it: straight into the OS if it is
+        the one asked for, otherwise the host is reset once it is up.
+
+        Args:
+            from_default_os (bool, optional): The host is up in the default OS, the target is
+                armed and reset into without powering it on. Defaults to False.
+
+        Returns:
+            Future: Resolves with the final state, None if a boot is already running.
+        """
+        entry = self.host.boot_target(os_name)
+        if entry is None:
+            raise ValueError(f"Unknown OS {os_name}")
+        default = self.host.boot_target(self.host.default_os())
+        if from_default_os and entry == default:
+            raise ValueError(f"{os_name} is already running")
+        sequence = DEFAULT_SEQUENCE if entry == default else ARMED_SEQUENCE
+
+        with self._lock:
+            if self.job is not None:
+                return None
+            if from_default_os:
+                # No power pulse, an entry armed for it stays armed until it is replaced
+                self.job = BootJob(os_name, chat_id, message_id, sequence=SWITCH_SEQUENCE)
+                self._write_journal(self.job)
+                return self._submit(self.job)
+            # The power pulse uses up the armed entry, whatever happens next
+            armed = self.host.next_boot.clear()
+            armed_os = None if armed is None else armed.os_name
+            if armed is not None and armed.target == entry.target:
+                sequence = PRE_ARMED_SEQUENCE
+            elif armed is not None:
+                sequence = [POWER_PULSE, WAIT_ARMED, RESET] + sequence[1:]
+            self.job = BootJob(os_name, chat_id, message_id, sequence=sequence, armed_os=armed_os)
+            self._write_journal(self.job)
+        return self._submit(self.job)
+
+    def watch(self, chat_id: int, message_id: int) -> bool:
+        """Also show the progress of the running boot in another message
+
+        Returns:
+            bool: False if no boot is running.
+        """
+        with self._lock:
+            job = self.job
+            if job is None:
+                return False
+            watcher = [chat_id, message_id]
+            if watcher == [job.chat_id, job.message_id] or watcher in job.watchers:
+                return True
+            # Journaled with the next transition
+            job.watchers.append(watcher)
+            text = job.last_text
+        if text is not None:
+            self._edit(job, chat_id, message_id, text)
+        return True
+
+    def cancel(self) -> bool:
+        """Cancel the running boot after its current step, returns False if there is none"""
+        job = self.job
+        if job is None:
+            return False
+        job.cancel_event.set()
+        return True
+
+    def resume(self) -> Optional[Future]:
+        """Resume or abort the boot left in the journal by a previous run"""
+        job = self._read_journal()
+        if job is None:
+            return None
+
+        step = STEPS[job.state]
+        elapsed = time.time() - job.updated_at
+        if job.phase == 'running' and step.presses_relay:
+            reason = f"it was interrupted while {step.description}"
+        elif step.presses_relay and elapsed > self.resume_window:
+            reason = f"the next step was {step.description} {elapsed:.0f} s ago"
+        else:
+            reason = None
+
+        if reason is not None:
+            self.logger.warning(f"Boot {job.job_id}: aborting after restart, {reason}")
+            self._notify(job, f"Boot of {job.os_name} aborted by a restart, {reason}. "
+                              f"Please check the host before retrying.")
+            self._remove_journal()
+            return None
+
+        self.logger.info(f"Boot {job.job_id}: resuming at {job.state}")
+        with self._lock:
+            job.phase = 'pending'
+            self.job = job
+        return self._submit(job)
+
+    def shutdown(self) -> None:
+        """Stop the worker, a running boot stays in the journal"""
+        self._stopping.set()
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+    def _submit(self, job: BootJob) -> Future:
+        """Run the job on the worker"""
+        return self.executor.submit(self._run, job)
+
+    def _run(self, job: BootJob) -> str:
+        """Run the remaining steps of a job"""
+        return drive(self._run_steps(job))
+
+    def _run_steps(self, job: BootJob) -> Steps:
+        """Steps of _run, the steps of the sequence one after the other"""
+        try:
+            while job.step < len(job.sequence):
+                self._check_cancelled(job)
+
+                job.state = job.sequence[job.step]
+                job.phase = 'running'
+                self._transition(job)
+
+                yield from getattr(self, f'_step_{job.state}')(job)
+
+                job.step += 1
+                if job.step < len(job.sequence):
+                    job.state = job.sequence[job.step]
+                job.phase = 'pending'
+                self._write_journal(job)
+
+            final_state = DONE
+            self._notify(job, f"{job.os_name} booted")
+        except BootCancelled:
+            if self._stopping.is_set():
+                # Keep the journal so the boot is picked up on the next start
+                self.logger.info(f"Boot {job.job_id}: interrupted by shutdown at {job.state}")
+                self.job = None
+                return ABORTED
+            final_state = CANCELLED
+            self._notify(job, f"Boot of {job.os_name} cancelled")
+        except BootFailed as e:
+            final_state = FAILED
+            self._notify(job, str(e))
+        except Exception as e:
+            final_state = FAILED
+            self.logger.error(f"Boot {job.job_id}: unexpected error in {job.state}: {e}")
+            self._notify(job, f"Boot of {job.os_name} failed")
+
+        elapsed = time.time() - job.started_at
+        BOOT_SECONDS.labels(job.os_name, final_state).observe(elapsed)
+        self.logger.info(f"Boot {job.job_id}: finished as {final_state} after {elapsed:.0f} s")
+        with self._lock:
+            self._remove_journal()
+            self.job = None
+        return final_state
+
+    def _check_cancelled(self, job: BootJob) -> None:
+        if job.cancel_event.is_set():
+            raise BootCancelled()
+
+    def _cancel_event(self, job: BootJob):
+        """The event the waits of the job stop on"""
+        return job.cancel_event
+
+    def _call(self, func: Callable, *args):
+        """Run a blocking Host method for a step"""
+        return func(*args)
+
+    def _transition(self, job: BootJob) -> None:
+        """Journal the new state and show it to the user"""
+        self._write_journal(job)
+        self.logger.info(f"Boot {job.job_id}: {job.state}")
+        self._notify(job, self._progress_text(job))
+
+    def _progress_text(self, job: BootJob, status: str = '') -> str:
+        """Progress message of the current step, with an optional status after the description"""
+        step = STEPS[job.state]
+        status = f", {status}" if status else ''
+        return (f"Booting {job.os_name}: {step.description}{status} "
+                f"({job.step + 1}/{len(job.sequence)})\nSend /cancel to stop")
+
+    def _booting_os(self, job: BootJob) -> str:
+        """The OS coming up at the current step, the default one until the target is armed"""
+        if job.state == WAIT_ARMED and job.armed_os is not None:
+            return job.armed_os
+        if ARM_ENTRY in job.sequence[job.step:]:
+            return self.host.default_os()
+        return job.os_name
+
+    def _wait_online(self, job: BootJob) -> bool:
+        """Wait for the booting OS, showing the expected time left"""
+        def progress(remaining: Optional[float]) -> None:
+            if remaining is None:
+                status = 'taking longer than usual'
+            else:
+                status = f'about {max(remaining, 1):.0f} s left'
+            self._notify(job, self._progress_text(job, status))
+
+        return self.host.wait_for_host_online(cancel=self._cancel_event(job),
+                                              os_name=self._booting_os(job),
+                                              progress=progress)
+
+    def _notify(self, job: BootJob, text: str) -> None:
+        """Edit the progress message, and those of the requests that joined the boot"""
+        job.last_text = text
+        self._edit(job, job.chat_id, job.message_id, text)
+        for chat_id, message_id in list(job.watchers):
+            self._edit(job, chat_id, message_id, text)
+
+    def _edit(self, job: BootJob, chat_id: int, message_id: int, text: str) -> None:
+        if self.telegram_bot is None:
+            return
+        try:
+            self.telegram_bot.edit_message_text(text=text,
+                                                chat_id=chat_id,
+                                                message_id=message_id)
+        except Exception as e:
+            self.logger.warning(f"Boot {job.job_id}: could not edit the progress message: {e}")
+
+    # Steps, yielding what they wait for, see bot.steps
+    def _step_power_pulse(self, job: BootJob) -> Steps:
+        yield self.host.power_switch_action()
+
+    def _step_wait_boot(self, job: BootJob) -> Steps:
+        if not (yield self._wait_online(job)):
+            self._check_cancelled(job)
+            raise BootFailed(f"Could not boot {job.os_name}")
+
+    def _step_wait_armed(self, job: BootJob) -> Steps:
+        # Hosts may not answer the probes from the armed OS (e.g. Windows' firewall)
+        if not (yield self._wait_online(job)):
+            self._check_cancelled(job)
+            self.logger.warning(f"Boot {job.job_id}: the armed {job.armed_os} was not seen online")
+
+    def _step_check_armed(self, job: BootJob) -> Steps:
+        if (yield self.host.default_os_running(cancel=self._cancel_event(job))):
+            # The armed entry was lost, e.g. the host was booted by hand in between
+            self.logger.warning(f"Boot {job.job_id}: the default OS came up, arming {job.os_name} now")
+            job.sequence = job.sequence[:job.step + 1] + PRE_ARMED_FALLBACK
+        else:
+            self._check_cancelled(job)
+
+    def _step_connect_ssh(self, job: BootJob) -> Steps:
+        if not (yield self._call(self.host.connect_ssh)):
+            self.logger.error("SSH connection failed in power_on->select_os")
+            raise BootFailed("SSH connection failed")
+        self.logger.info("SSH connection successful")
+
+    def _step_arm_entry(self, job: BootJob) -> Steps:
+        if not (yield self._call(self.host.arm_boot_target, job.os_name)):
+            self.logger.error(f"Could not make {job.os_name} next")
+            raise BootFailed(f"Failed to set {job.os_name} on reboot")
+
+    def _step_reset(self, job: BootJob) -> Steps:
+        yield self.host.reset_switch_action()
+
+    def _step_wait_reboot(self, job: BootJob) -> Steps:
+        # The second reset is needed whether or not the reboot is seen
+        yield self._wait_online(job)
+        self._check_cancelled(job)
+
+    def _step_second_reset(self, job: BootJob) -> Steps:
+        yield self.host.reset_switch_action()
+
+    # Journal
+    def _write_journal(self, job: BootJob) -> None:
+        """Atomically replace the journal with the job state"""
+        job.updated_at = time.time()
+        tmp_file = self.journal_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(job.to_dict(), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.journal_file)
+        except OSError as e:
+            self.logger.error(f"Boot {job.job_id}: could not write the journal: {e}")
+
+    def _read_journal(self) -> Optional[BootJob]:
+        try:
+            with open(self.journal_file) as f:
+                return BootJob.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            self.logger.error(f"Discarding unreadable boot journal: {e}")
+            self._remove_journal()
+            return None
+
+    def _remove_journal(self) -> None:
+        try:
+            os.remove(self.journal_file)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import statistics
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+
+class WaitPhase(NamedTuple):
+    """Part of the wait for a host, probing at a fixed pace"""
+    until: float  # Seconds since the wait started
+    interval: float  # Seconds between probe starts
+    probe_timeout: Optional[float]  # Per probe timeout, None for the prober's own
+
+
+class BootEstimate(NamedTuple):
+    """Boot duration of a host and OS learned from its history"""
+    samples: int
+    expected: float  # Median boot time in seconds
+    earliest: float  # Before this the host is not expected to answer
+    latest: float  # After this the boot is slower than usual
+    timeout: float  # Time to give up
+
+
+class BootHistory:
+    """Recent boot durations of a host per OS, kept in a small json file.
+
+    Only the last max_samples durations of each OS are kept, in tenths of a
+    second, so the file stays a few hundred bytes however long the bot runs.
+    """
+
+    def __init__(self,
+                 history_file: str,
+                 max_samples: int = 32,
+                 min_samples: int = 3,
+                 logger=None):
+        """Initialize the history, loading the file if it exists
+
+        Args:
+            history_file (str): The json file of the history.
+            max_samples (int, optional): Durations kept per OS. Defaults to 32.
+            min_samples (int, optional): Durations needed before estimating. Defaults to 3.
+        """
+        self.history_file = history_file
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._lock = threading.Lock()
+        self._durations: Dict[str, List[int]] = self._load()
+
+    def _load(self) -> Dict[str, List[int]]:
+        try:
+            with open(self.history_file) as f:
+                history = json.load(f)
+            return {str(os_name): [int(d) for d in durations] for os_name, durations in history.items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            self.logger.error(f"Discarding unreadable boot history: {e}")
+            return {}
+
+    def _save(self) -> None:
+        """Atomically replace the file, must hold the lock"""
+        tmp_file = self.history_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self._durations, f, separators=(',', ':'))
+            os.replace(tmp_file, self.history_file)
+        except OSError as e:
+            self.logger.error(f"Could not write the boot history: {e}")
+
+    def durations(self, os_name: str) -> List[float]:
+        """Recorded boot durations of an OS in seconds, oldest first"""
+        with self._lock:
+            return [d / 10 for d in self._durations.get(os_name, [])]
+
+    def record(self, os_name: str, duration: float) -> None:
+        """Add the duration of a successful boot"""
+        with self._lock:
+            durations = self._durations.setdefault(os_name, [])
+            durations.append(round(duration * 10))
+            del durations[:-self.max_samples]
+            self._save()
+
+    def estimate(self,
+                 os_name: str,
+                 min_timeout: float = 30,
+                 max_timeout: float = 600) -> Optional[BootEstimate]:
+        """Estimate the next boot from the history, None until there are min_samples
+
+        The host is expected between 0.8 times the fastest boot seen and 1.2
+        times the 90th percentile, so the odd long boot (e.g. Windows updates)
+        doesn't stretch the window. The timeout is twice the slowest boot, so
+        those still get the time they need, within min_timeout and max_timeout.
+        """
+        durations = self.durations(os_name)
+        if len(durations) < self.min_samples:
+            return None
+        slowest = max(durations)
+        return BootEstimate(samples=len(durations),
+                            expected=statistics.median(durations),
+                            earliest=0.8 * min(durations),
+                            latest=1.2 * statistics.quantiles(durations, n=10)[-1],
+                            timeout=min(max(2 * slowest, min_timeout), max_timeout))
+
+
+def wait_phases(estimate: Optional[BootEstimate],
+                timeout: float,
+                interval: float,
+                sparse_interval: float,
+                probe_timeout: float) -> List[WaitPhase]:
+    """Plan the probes of a wait for a host to boot
+
+    Without an estimate the host is probed every interval until the timeout.
+    With one, it is probed every sparse_interval until the earliest expected
+    time, densely until the latest one with probes no longer than the
+    interval, so a late answer never delays the next probe, and every
+    interval with full probes after that.
+
+    Args:
+        estimate (BootEstimate): The boot estimate, None if unknown.
+        timeout (float): Total time to wait in seconds.
+        interval (float): Seconds between probes when probing densely.
+        sparse_interval (float): Seconds between probes before the host is expected.
+        probe_timeout (float): The prober's timeout.
+
+    Returns:
+        List[WaitPhase]: The phases of the wait, ending at the timeout.
+    """
+    if estimate is None:
+        return [WaitPhase(timeout, interval, None)]
+
+    phases = []
+    if estimate.earliest > sparse_interval:
+        phases.append(WaitPhase(min(estimate.earliest, timeout), sparse_interval, None))
+    if estimate.latest < timeout:
+        phases.append(WaitPhase(estimate.latest, interval, min(probe_timeout, interval)))
+        phases.append(WaitPhase(timeout, interval, None))
+    else:
+        phases.append(WaitPhase(timeout, interval, min(probe_timeout, interval)))
+    return phases
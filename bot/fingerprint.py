@@ -0,0 +1,163 @@
+import errno
+import select
+import socket
+import time
+from typing import Dict, NamedTuple, Optional
+
+from utils.metrics import REGISTRY
+
+# Services told apart by their ports
+SSH = 'ssh'
+RDP = 'rdp'
+GAMESTREAM = 'gamestream'
+GAMESTREAM_TLS = 'gamestream_tls'
+DEFAULT_PORTS = {SSH: 22, RDP: 3389, GAMESTREAM: 47989, GAMESTREAM_TLS: 47984}
+
+# Port states, a refused connection still means the host is up
+OPEN = 'open'
+CLOSED = 'closed'
+FILTERED = 'filtered'
+
+LINUX = 'linux'
+WINDOWS = 'windows'
+
+FINGERPRINTS = REGISTRY.counter('suckerfish_fingerprints', 'OS fingerprints by detected OS family, unknown if none',
+                                ('family',))
+FINGERPRINT_SECONDS = REGISTRY.histogram('suckerfish_fingerprint_seconds', 'Time to fingerprint the OS of a host',
+                                         ('family',))
+
+
+class Fingerprint(NamedTuple):
+    """The OS a host seems to run, from the services it answers on"""
+    family: Optional[str]  # LINUX, WINDOWS or None if no service tells
+    ports: Dict[str, str]  # State of each service checked to the end, OPEN, CLOSED or FILTERED
+    banner: Optional[str]  # Version line of the ssh server
+    elapsed: float
+    checked_at: float  # time.monotonic() of the fingerprint
+
+    @property
+    def reachable(self) -> bool:
+        """Whether any port answered, accepting or refusing the connection"""
+        return any(state != FILTERED for state in self.ports.values())
+
+
+def classify(ports: Dict[str, str], banner: Optional[str]) -> Optional[str]:
+    """The OS family told by the services, None if they don't tell
+
+    The ssh banner decides, OpenSSH for Windows names itself and any other
+    server is taken for the Linux the bot logs into. Otherwise RDP, or a
+    GameStream host (GeForce Experience only runs on Windows), means Windows.
+    """
+    if banner is not None:
+        return WINDOWS if 'windows' in banner.lower() else LINUX
+    if ports.get(RDP) == OPEN or OPEN in (ports.get(GAMESTREAM), ports.get(GAMESTREAM_TLS)):
+        return WINDOWS
+    return None
+
+
+def settled(ports: Dict[str, str], banner: Optional[str]) -> bool:
+    """Whether the answers so far tell the OS whatever the other ports say"""
+    return banner is not None or ports.get(RDP) == OPEN
+
+
+def make_fingerprint(ports: Dict[str, str], banner: Optional[str], t_start: float) -> Fingerprint:
+    """The fingerprint of the answers, recorded in the metrics"""
+    now = time.monotonic()
+    fingerprint = Fingerprint(classify(ports, banner), ports, banner, now - t_start, now)
+    family = fingerprint.family or 'unknown'
+    FINGERPRINTS.labels(family).inc()
+    FINGERPRINT_SECONDS.labels(family).observe(fingerprint.elapsed)
+    return fingerprint
+
+
+def ssh_banner(data: bytes) -> Optional[str]:
+    """The version line of an ssh server, which may send other lines first, None until it is complete"""
+    for line in data.split(b'\n')[:-1]:
+        if line.startswith(b'SSH-'):
+            return line.rstrip(b'\r').decode(errors='replace')
+    return None
+
+
+class OSFingerprinter:
+    """Tells the OS a host runs from the services it answers on.
+
+    Every port is connected to at once on non-blocking sockets waited on
+    with a single select, so a fingerprint takes one round trip when the
+    services answer and at most the timeout when they are filtered, on the
+    calling thread alone. It stops as soon as the answers settle the OS,
+    e.g. on the banner of the ssh server, which is sent before the client
+    says anything.
+    """
+
+    def __init__(self,
+                 host_ip: str,
+                 ports: Optional[Dict[str, int]] = None,
+                 timeout: float = 0.5):
+        """Initialize the fingerprinter
+
+        Args:
+            host_ip (str): The ip of the host.
+            ports (Dict[str, int], optional): Port of each service. Defaults to DEFAULT_PORTS.
+            timeout (float, optional): Seconds to wait for the answers. Defaults to 0.5.
+        """
+        self.host_ip = host_ip
+        self.ports = dict(DEFAULT_PORTS if ports is None else ports)
+        self.timeout = timeout
+
+    def fingerprint(self, timeout: Optional[float] = None) -> Fingerprint:
+        """Connect to every service at once and tell the OS from the answers"""
+        t_start = time.monotonic()
+        deadline = t_start + (self.timeout if timeout is None else timeout)
+        ports: Dict[str, str] = {}
+        banner = None
+        connecting: Dict[socket.socket, str] = {}
+        reading: Dict[socket.socket, bytes] = {}
+        try:
+            family, _, _, _, address = socket.getaddrinfo(self.host_ip, None, type=socket.SOCK_STREAM)[0]
+            for service, port in self.ports.items():
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                error = sock.connect_ex((address[0], port, *address[2:]))
+                if error in (0, errno.EINPROGRESS):
+                    connecting[sock] = service
+                else:
+                    ports[service] = CLOSED if error == errno.ECONNREFUSED else FILTERED
+                    sock.close()
+
+            while (connecting or reading) and not settled(ports, banner):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                readable, writable, _ = select.select(list(reading), list(connecting), [], remaining)
+                for sock in writable:
+                    service = connecting.pop(sock)
+                    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error:
+                        ports[service] = CLOSED if error == errno.ECONNREFUSED else FILTERED
+                        sock.close()
+                        continue
+                    ports[service] = OPEN
+                    if service == SSH:
+                        reading[sock] = b''
+                    else:
+                        sock.close()
+                for sock in readable:
+                    try:
+                        data = sock.recv(256)
+                    except OSError:
+                        data = b''
+                    reading[sock] += data
+                    banner = ssh_banner(reading[sock])
+                    if banner is not None or not data or len(reading[sock]) > 1024:
+                        del reading[sock]
+                        sock.close()
+        except OSError:
+            # E.g. the name of the host does not resolve, nothing answered
+            pass
+        finally:
+            for sock in [*connecting, *reading]:
+                sock.close()
+        if not settled(ports, banner):
+            # Neither accepted nor refused before the deadline, the ones left when it settled early are unknown
+            ports.update({service: FILTERED for service in self.ports if service not in ports})
+        return make_fingerprint(ports, banner, t_start)
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from bot.host import Host
+
+PINS = ('power_pin', 'reset_pin')
+
+
+class HostChanges(NamedTuple):
+    """How to go from the running hosts to the configured ones"""
+    retire: List[str]  # Running hosts to stop, changed or removed
+    create: List[dict]  # Configs of the hosts to start, changed or added
+    deferred: List[str]  # Changes left for later, the host is busy or its pins are
+
+
+def host_changes(current: Dict[str, dict], wanted: Dict[str, dict], busy: Iterable[str]) -> HostChanges:
+    """Plan the hosts to retire and start to match the config, sparing the busy ones
+
+    A busy host keeps running with its old config, and so does a host that
+    needs a pin a busy one still holds, until they can all be swapped.
+
+    Args:
+        current (Dict[str, dict]): Config of the running hosts by name.
+        wanted (Dict[str, dict]): Config of the configured hosts by name.
+        busy (Iterable[str]): Names of the hosts running an action.
+    """
+    busy = set(busy)
+    deferred = [name for name, config in current.items() if config != wanted.get(name) and name in busy]
+    held = {current[name][pin] for name in deferred for pin in PINS}
+    retire, create = [], []
+    for name in dict.fromkeys([*current, *wanted]):
+        old, new = current.get(name), wanted.get(name)
+        if old == new or name in deferred:
+            continue
+        if new is not None and held.intersection(new[pin] for pin in PINS):
+            deferred.append(name)
+            continue
+        if old is not None:
+            retire.append(name)
+        if new is not None:
+            create.append(new)
+    return HostChanges(retire, create, deferred)
+
+
+class Fleet:
+    """The set of hosts driven by the bot.
+
+    Fleet wide queries are fanned out on a pool with one thread per host, so
+    their latency is that of the slowest host rather than the sum of them.
+    """
+
+    def __init__(self, hosts: List[Host]):
+        self.hosts: Dict[str, Host] = {}
+        for host in hosts:
+            if host.name in self.hosts:
+                raise ValueError(f"Duplicated host name {host.name}")
+            self.hosts[host.name] = host
+
+        self.executor = self._make_executor()
+
+    def _make_executor(self) -> ThreadPoolExecutor:
+        self._workers = max(1, len(self.hosts))
+        return ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='fleet')
+
+    def __len__(self) -> int:
+        return len(self.hosts)
+
+    def __iter__(self) -> Iterator[Host]:
+        return iter(self.hosts.values())
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.hosts)
+
+    def get(self, name: str) -> Optional[Host]:
+        """The host with the given name, None if there is none"""
+        return self.hosts.get(name)
+
+    def put(self, host: Host) -> None:
+        """Add a host, or swap the one of the same name keeping its place"""
+        # Copied, so readers iterating the hosts are never disturbed
+        hosts = dict(self.hosts)
+        hosts[host.name] = host
+        self.hosts = hosts
+        if len(hosts) > self._workers:
+            executor, self.executor = self.executor, self._make_executor()
+            # The queries already on it still finish
+            executor.shutdown(wait=False)
+
+    def remove(self, name: str) -> Optional[Host]:
+        """Take a host out of the fleet, returns it or None if there was none"""
+        hosts = dict(self.hosts)
+        host = hosts.pop(name, None)
+        self.hosts = hosts
+        return host
+
+    def map(self, func: Callable[[Host], object],
+            hosts: Optional[List[Host]] = None) -> List[Tuple[Host, object]]:
+        """Call func on every host concurrently
+
+        Returns:
+            list: (host, result) pairs in fleet order, the result is the raised
+                exception if the call failed.
+        """
+        hosts = list(self) if hosts is None else hosts
+        if len(hosts) == 1:
+            # Skip the pool hop for the common single host case
+            futures = None
+        else:
+            futures = [self.executor.submit(func, host) for host in hosts]
+
+        results = []
+        for i, host in enumerate(hosts):
+            try:
+                result = func(host) if futures is None else futures[i].result()
+            except Exception as e:
+                result = e
+            results.append((host, result))
+        return results
+
+    def start(self) -> None:
+        """Start the background workers of every host"""
+        for host in self:
+            host.start()
+
+    def stop(self) -> None:
+        """Stop the background workers of every host"""
+        for host in self:
+            host.stop()
+        self.executor.shutdown(wait=False)
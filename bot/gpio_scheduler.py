@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Deque, Dict, Optional, Tuple
+
+from utils.metrics import REGISTRY
+
+PULSE_SECONDS = REGISTRY.histogram('suckerfish_gpio_pulse_seconds', 'Measured length of the relay pulses', ('pin',))
+
+
+class PinActuator:
+    """Timer driven pulses on a single output pin.
+
+    Pulses are queued and run one after the other, so two pulses on the same
+    relay never overlap. Turning the pin off is done from a ``threading.Timer``
+    so no thread sleeps while the relay is closed.
+    """
+
+    def __init__(self, device, name: str = '', logger=None):
+        """Initialize the actuator
+
+        Args:
+            device: A gpiozero output device (e.g. ``LED``) with on() and off().
+            name (str, optional): Name used in the logs. Defaults to ''.
+        """
+        self.device = device
+        self.name = name
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._queue: Deque[Tuple[float, Future]] = deque()
+        self._lock = threading.Lock()
+        self._busy = False
+        self._timer: Optional[threading.Timer] = None
+
+    @property
+    def pending(self) -> int:
+        """Number of queued pulses, including the one running"""
+        with self._lock:
+            return len(self._queue) + self._busy
+
+    def pulse(self, duration: float) -> Future:
+        """Queue a pulse of the given duration
+
+        Returns:
+            Future: Resolves with the measured pulse length once the pin is released.
+        """
+        future = Future()
+        with self._lock:
+            self._queue.append((duration, future))
+            if self._busy:
+                return future
+            self._busy = True
+        self._start_next()
+        return future
+
+    def _start_next(self) -> None:
+        """Close the relay for the next queued pulse, skipping the cancelled and failed ones"""
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._busy = False
+                    return
+                duration, future = self._queue.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                # Cancelled while queued
+                continue
+            try:
+                self.device.on()
+            except Exception as e:
+                self.logger.error(f"Could not close the relay of pin {self.name}: {e}")
+                future.set_exception(e)
+                continue
+            break
+
+        t_start = time.monotonic()
+        self._timer = threading.Timer(duration, self._finish, args=(future, t_start))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _finish(self, future: Future, t_start: float) -> None:
+        """Open the relay and resolve the pulse future"""
+        try:
+            self.device.off()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            elapsed = time.monotonic() - t_start
+            self.logger.debug(f"Pin {self.name} released after {elapsed:.3f} s")
+            PULSE_SECONDS.labels(self.name).observe(elapsed)
+            future.set_result(elapsed)
+        self._start_next()
+
+    def cancel_pending(self) -> int:
+        """Drop the queued pulses that have not started yet"""
+        with self._lock:
+            dropped = list(self._queue)
+            self._queue.clear()
+        for _, future in dropped:
+            future.cancel()
+        return len(dropped)
+
+
+class PulseScheduler:
+    """Pulse scheduler for a set of named pins"""
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self._pins: Dict[str, PinActuator] = {}
+
+    def add_pin(self, name: str, device) -> PinActuator:
+        """Register an output device under a name"""
+        self._pins[name] = PinActuator(device, name, logger=self.logger)
+        return self._pins[name]
+
+    def pulse(self, name: str, duration: float) -> Future:
+        """Queue a pulse on the named pin, see PinActuator.pulse"""
+        return self._pins[name].pulse(duration)
+
+    def pending(self, name: str) -> int:
+        """Number of queued pulses on the named pin"""
+        return self._pins[name].pending
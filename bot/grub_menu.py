@@ -0,0 +1,263 @@
+import json
+import logging
+import os
+import re
+import shlex
+import threading
+import time
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+# Entries that are not an OS to boot into
+HIDDEN_ENTRY_IDS = ('uefi-firmware',)
+
+
+class GrubEntry(NamedTuple):
+    """A bootable entry of the grub menu"""
+    path: str  # Position in the menu, '2' or '1>0' inside a submenu
+    title: str
+    entry_id: Optional[str] = None  # $menuentry_id_option, stable across kernel updates
+
+    @property
+    def top_level(self) -> bool:
+        return '>' not in self.path
+
+    @property
+    def label(self) -> str:
+        """Title without the disk os-prober appends, e.g. ' (on /dev/sda1)'"""
+        return re.sub(r'\s*\(on /dev/[^)]*\)$', '', self.title)
+
+    @property
+    def target(self) -> str:
+        """What grub-reboot is given, the id when there is one"""
+        return self.entry_id or self.path
+
+
+def parse_grub_cfg(lines: Iterable[str]) -> Tuple[List[GrubEntry], Optional[str]]:
+    """Parse the menu of a grub.cfg
+
+    Only the menuentry and submenu blocks are followed, everything else
+    between braces (functions, entry bodies) is skipped. Works line by line,
+    so the file can be parsed while it is being read.
+
+    Args:
+        lines (Iterable[str]): The lines of the grub.cfg.
+
+    Returns:
+        tuple: (the menu entries in order, the literal default entry or None)
+    """
+    entries: List[GrubEntry] = []
+    default = None
+    # One frame per open brace: the path prefix of a submenu, None for other blocks
+    menus: List[Optional[str]] = []
+    position = [0]
+    for line in lines:
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError:
+            continue
+        if not words:
+            continue
+        if words[0] == '}':
+            if menus and menus.pop() is not None:
+                position.pop()
+            continue
+        in_menu = not menus or menus[-1] is not None
+        if words[0] in ('menuentry', 'submenu') and len(words) > 1 and in_menu:
+            parent = menus[-1] if menus else ''
+            path = f'{parent}{position[-1]}'
+            position[-1] += 1
+            if words[0] == 'submenu':
+                menus.append(path + '>')
+                position.append(0)
+            else:
+                entries.append(GrubEntry(path, words[1], _entry_id(words)))
+                menus.append(None)
+            continue
+        if words[0] == 'set' and len(words) > 1 and words[1].startswith('default='):
+            value = words[1][len('default='):]
+            if value and not value.startswith('$'):
+                default = value
+        if words[-1] == '{':
+            menus.append(None)
+    return entries, default
+
+
+def _entry_id(words: List[str]) -> Optional[str]:
+    for option in ('$menuentry_id_option', '--id'):
+        if option in words[:-1]:
+            return words[words.index(option) + 1]
+    return None
+
+
+class GrubMenu:
+    """The grub menu of a host, cached in a json file with the hash of its grub.cfg.
+
+    The menu is only fetched again when the hash reported by the host no
+    longer matches, so booting an entry resolves it locally. Until a menu is
+    cached the fallback entries are used.
+    """
+
+    def __init__(self, cache_file: str, fallback: Iterable[GrubEntry] = (), logger=None):
+        """Initialize the menu, loading the cache if it exists
+
+        Args:
+            cache_file (str): The json file of the cache.
+            fallback (Iterable[GrubEntry], optional): Entries used while nothing is cached.
+        """
+        self.cache_file = cache_file
+        self.fallback = list(fallback)
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._lock = threading.Lock()
+        self.digest: Optional[str] = None
+        self._entries: List[GrubEntry] = []
+        self._default: Optional[str] = None
+        self._load()
+
+    @property
+    def cached(self) -> bool:
+        return self.digest is not None
+
+    @property
+    def entries(self) -> List[GrubEntry]:
+        with self._lock:
+            return list(self._entries) if self.digest is not None else list(self.fallback)
+
+    def _load(self) -> None:
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            self._entries = [GrubEntry(str(path), str(title), entry_id)
+                             for path, title, entry_id in cache['entries']]
+            self._default = cache.get('default')
+            self.digest = str(cache['digest'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            self.logger.error(f"Discarding unreadable grub menu cache: {e}")
+
+    def _save(self) -> None:
+        """Atomically replace the cache, must hold the lock"""
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'digest': self.digest,
+                           'default': self._default,
+                           'entries': [list(entry) for entry in self._entries]}, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            self.logger.error(f"Could not write the grub menu cache: {e}")
+
+    def update(self, digest: str, lines: Iterable[str]) -> bool:
+        """Parse the grub.cfg with the given hash, returns False if it has no entries"""
+        entries, default = parse_grub_cfg(lines)
+        if not entries:
+            return False
+        with self._lock:
+            self.digest = digest
+            self._entries = entries
+            self._default = default
+            self._save()
+        return True
+
+    @property
+    def default(self) -> Optional[GrubEntry]:
+        """Entry booted when none is armed"""
+        entries = self.entries
+        with self._lock:
+            default = self._default if self.digest is not None else None
+        return (self._find(entries, default) if default else None) or (entries[0] if entries else None)
+
+    def targets(self) -> List[GrubEntry]:
+        """Top level entries to offer for booting"""
+        return [entry for entry in self.entries
+                if entry.top_level and entry.entry_id not in HIDDEN_ENTRY_IDS]
+
+    def resolve(self, name: str) -> Optional[GrubEntry]:
+        """Entry by path, id, title or label, else the first title containing name"""
+        entries = self.entries
+        entry = self._find(entries, name)
+        if entry is None:
+            # Top level entries first, e.g. 'Ubuntu' before its advanced options
+            lowered = name.lower()
+            matches = [entry for entry in entries if lowered in entry.title.lower()]
+            matches.sort(key=lambda entry: not entry.top_level)
+            entry = matches[0] if matches else None
+        return entry
+
+    @staticmethod
+    def _find(entries: List[GrubEntry], name: str) -> Optional[GrubEntry]:
+        lowered = name.lower()
+        for entry in entries:
+            if name in (entry.path, entry.entry_id) or lowered in (entry.title.lower(), entry.label.lower()):
+                return entry
+        return None
+
+
+class ArmedEntry(NamedTuple):
+    """An entry armed with grub-reboot, booted by the next power on"""
+    os_name: str
+    target: str
+    armed_at: float
+
+
+class NextBoot:
+    """The entry armed for the next boot of a host, kept in a small json file.
+
+    grub-reboot only lasts for one boot, so the record is dropped as soon as
+    the host boots, whoever powered it on.
+    """
+
+    def __init__(self, state_file: str, logger=None):
+        """Initialize the record, loading the file if it exists
+
+        Args:
+            state_file (str): The json file of the record.
+        """
+        self.state_file = state_file
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._lock = threading.Lock()
+        self._armed: Optional[ArmedEntry] = self._load()
+
+    @property
+    def armed(self) -> Optional[ArmedEntry]:
+        return self._armed
+
+    def _load(self) -> Optional[ArmedEntry]:
+        try:
+            with open(self.state_file) as f:
+                armed = json.load(f)
+            return ArmedEntry(str(armed['os_name']), str(armed['target']), float(armed['armed_at']))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            self.logger.error(f"Discarding unreadable next boot record: {e}")
+            return None
+
+    def record(self, os_name: str, target: str) -> ArmedEntry:
+        """Remember the entry just armed"""
+        armed = ArmedEntry(os_name, target, time.time())
+        with self._lock:
+            self._armed = armed
+            tmp_file = self.state_file + '.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(armed._asdict(), f)
+                os.replace(tmp_file, self.state_file)
+            except OSError as e:
+                self.logger.error(f"Could not write the next boot record: {e}")
+        return armed
+
+    def clear(self) -> Optional[ArmedEntry]:
+        """Forget the armed entry, returns it"""
+        with self._lock:
+            armed, self._armed = self._armed, None
+            if armed is not None:
+                try:
+                    os.remove(self.state_file)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.logger.error(f"Could not remove the next boot record: {e}")
+        return armed
@@ -0,0 +1,499 @@
+import functools
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from bot.acl import DENIED_TEXT
+from bot.actions import (ARM, BOOT, CONFLICT, FORCE_SHUTDOWN, JOINED,
+                         POWER_SWITCH, RESET_SWITCH, STARTED, Action, busy_text)
+from bot.steps import Steps
+from bot.telemetry import FIELD_LABELS, TIERS
+from utils.metrics import REGISTRY
+from utils.profiling import ProfileReport
+from utils.text import split_message
+
+
+def only_allowed_chats(func):
+    """Decorator for handlers which are only allowed to the chats of the ACL, commands and buttons alike"""
+    @functools.wraps(func)
+    def wrapped(self, update, args: List[str]) -> Steps:
+        chat_id = self.update_chat_id(update)
+        if self.acl.allows(chat_id):
+            return (yield from func(self, update, args))
+        self.logger.info(f"User {chat_id} tried to access a restricted command")
+        if update.callback_query is not None:
+            yield update.callback_query.answer(text=DENIED_TEXT)
+        elif update.effective_message is not None:
+            yield update.effective_message.reply_text(DENIED_TEXT)
+    return wrapped
+
+
+def only_dev_chat(func):
+    """Decorator for the developer commands, ignored outside the dev chat of the logger"""
+    @functools.wraps(func)
+    def wrapped(self, update, args: List[str]) -> Steps:
+        chat_id = self.update_chat_id(update)
+        dev_chat_id = getattr(self.logger, 'dev_chat_id', None)
+        if dev_chat_id is not None and str(chat_id) == str(dev_chat_id):
+            return (yield from func(self, update, args))
+        self.logger.info(f"Chat {chat_id} tried to use a developer command")
+    return wrapped
+
+
+def callback_host(data: str, prefix: str) -> Tuple[str, str]:
+    """The (host name, choice) of the callback data of a button, the host name has no ':' but the choice may"""
+    name, _, choice = data.replace(prefix, '', 1).partition(':')
+    return name, choice
+
+
+class BotHandlers:
+    """The commands and buttons of the bot, shared by both runtimes.
+
+    Each handler takes the update and the command arguments and is written
+    once as steps, see bot.steps: SuckerfishBot drives them in its lanes and
+    AsyncSuckerfishBot on its event loop. The replies are those of the
+    update of either runtime, and what differs between them goes through the
+    methods below that raise NotImplementedError. The bot provides acl,
+    fleet, logger, network, run_commands, runs and _runs_lock, and the
+    profilers.
+    """
+
+    # Runtime hooks
+    def update_chat_id(self, update) -> Optional[int]:
+        """The chat an update comes from"""
+        raise NotImplementedError
+
+    def keyboard(self, rows: Sequence[Sequence[Tuple[str, str]]]):
+        """Reply markup of an inline keyboard from rows of (text, callback data)"""
+        raise NotImplementedError
+
+    def blocking(self, func, *args):
+        """Run a blocking call that is not an ssh command"""
+        raise NotImplementedError
+
+    def ssh_call(self, host, func, *args):
+        """Run a blocking Host method running ssh commands"""
+        raise NotImplementedError
+
+    def map_hosts(self, steps_of, hosts: list):
+        """Drive steps_of(host) for every host at once, the (host, result or exception) pairs in order"""
+        raise NotImplementedError
+
+    def on_done(self, future, func, *args) -> None:
+        """Call func(*args) once the future resolves, from any thread"""
+        raise NotImplementedError
+
+    def refresh_network_soon(self) -> None:
+        """Look up the public ip now rather than when it expires"""
+        raise NotImplementedError
+
+    def start_run(self, host, name: str, message) -> None:
+        """Stream the /run command name of host into message, runs holds the host until it ends"""
+        raise NotImplementedError
+
+    def start_arming(self, host, name: str, message):
+        """Run the steps of _arm_next_boot in the background, the future or task of the ARM action"""
+        raise NotImplementedError
+
+    # Helpers
+    def host_label(self, host) -> str:
+        """How the host is called in the replies"""
+        return 'The host' if len(self.fleet) == 1 else host.name
+
+    def action_busy_text(self, host, action: Action, outcome: str) -> str:
+        """Reply to a request that did not start an action"""
+        return busy_text(self.host_label(host), action, outcome)
+
+    def select_hosts(self, update, args: List[str], allow_all: bool = False) -> Steps:
+        """Hosts named in the arguments
+
+        With a single host the name is optional. Commands that allow it take
+        'all', which is also the default for them. Replies with the usage and
+        returns an empty list if no host could be selected.
+        """
+        name = args[0] if args else None
+        if name is None and (len(self.fleet) == 1 or allow_all):
+            return list(self.fleet)
+        if name == 'all' and allow_all:
+            return list(self.fleet)
+
+        host = self.fleet.get(name) if name is not None else None
+        if host is None:
+            choices = ', '.join(self.fleet.names + (['all'] if allow_all else []))
+            yield update.message.reply_text(f"Please choose a host: {choices}")
+            return []
+        return [host]
+
+    def os_keyboard(self, host, tag: str, exclude: Optional[str] = None):
+        """Buttons of the OSes of the cached grub menu, two per row"""
+        buttons = []
+        for label in host.boot_targets():
+            if label == exclude:
+                continue
+            data = tag + label
+            if len(data.encode()) > 64:
+                # Telegram limits the callback data to 64 bytes
+                data = tag + host.boot_target(label).path
+            buttons.append((label, data))
+        return self.keyboard([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+
+    def send_report(self, title: str, kind: str, report: ProfileReport) -> Steps:
+        """Send a profile to the dev chat, the logger blocks on the upload"""
+        filename = f"{kind}-profile-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        yield self.blocking(self.logger.send_report, title, report.summary, filename, report.dump)
+
+    # Handlers
+    def send_user_chat_id(self, update, args: List[str]) -> Steps:
+        """Send the chat id of the user asking for it"""
+        yield update.message.reply_text(f"Your chat id is {update.message.chat_id}")
+
+    def current_ip(self, update, args: List[str]) -> Steps:
+        """Send the current local and public ips of the pizero machine, from the cache"""
+        state = self.network.state
+        lines = [f"local ip = {', '.join(ips)} ({name})" for name, ips in state.local.items()]
+        if not lines:
+            lines.append("local ip = unknown")
+        if state.public_ip is None:
+            self.refresh_network_soon()
+            lines.append("public ip = unknown, looking it up")
+        elif state.checked_at is None:
+            # Only known from before a restart
+            lines.append(f"public ip = {state.public_ip} (not checked yet)")
+        else:
+            lines.append(f"public ip = {state.public_ip} (checked {time.time() - state.checked_at:.0f} s ago)")
+        yield update.message.reply_text('\n'.join(lines))
+
+    @only_allowed_chats
+    def press_power_switch(self, update, args: List[str]) -> Steps:
+        """Short the power switch on the computer"""
+        for host in (yield from self.select_hosts(update, args)):
+            # A press already running covers this one
+            request = host.actions.request(POWER_SWITCH, host.power_switch_action)
+            if request.outcome == CONFLICT:
+                yield update.message.reply_text(self.action_busy_text(host, request.action, request.outcome))
+
+    @only_allowed_chats
+    def press_reset_switch(self, update, args: List[str]) -> Steps:
+        """Short the reset switch on the computer"""
+        for host in (yield from self.select_hosts(update, args)):
+            request = host.actions.request(RESET_SWITCH, host.reset_switch_action)
+            if request.outcome == CONFLICT:
+                yield update.message.reply_text(self.action_busy_text(host, request.action, request.outcome))
+
+    @only_allowed_chats
+    def force_shutdown(self, update, args: List[str]) -> Steps:
+        """Ask the user if he wants to forcefully shutdown the computer"""
+        hosts = yield from self.select_hosts(update, args)
+        if not hosts:
+            return
+        host = hosts[0]
+
+        # Add tag to prevent query from being handled by the wrong callbacks
+        tag = f"force_shutdown_{host.name}:"
+        keyboard = self.keyboard([[("Yes", tag + "yes"), ("No", tag + "no")]])
+        target = 'the computer' if len(self.fleet) == 1 else host.name
+        yield update.message.reply_text(f'This will abruptly shutdown {target}\n Are you sure?:',
+                                        reply_markup=keyboard)
+
+    @only_allowed_chats
+    def check_force_shutdown(self, update, args: List[str]) -> Steps:
+        """Callback for the force_shutdown button, if yes hold the powerbutton"""
+        query = update.callback_query
+
+        # CallbackQueries need to be answered, even if no notification to the user is needed
+        # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
+        yield query.answer()
+
+        name, data = callback_host(query.data, "force_shutdown_")
+        host = self.fleet.get(name)
+        if host is None:
+            self.logger.error(f"(check_force_shutdown) Unknown host: {name}")
+            return
+
+        if data == 'yes':
+            message = query.message
+            request = host.actions.request(FORCE_SHUTDOWN, host.force_shutdown,
+                                           requester=(message.chat_id, message.message_id))
+            if request.outcome == CONFLICT:
+                yield query.edit_message_text(text=self.action_busy_text(host, request.action, request.outcome))
+            elif request.outcome in (STARTED, JOINED):
+                # Every confirmation shows the progress of the one shutdown
+                yield query.edit_message_text(text="Holding the power switch")
+                if request.outcome == STARTED:
+                    host.expect_transition()
+                self.on_done(request.action.future, query.edit_message_text, "Done")
+        elif data == 'no':
+            yield query.edit_message_text(text="Shutdown canceled")
+        else:
+            self.logger.error(f"(check_force_shutdown) Unknown callback data: {data}")
+
+    @only_allowed_chats
+    def power_on(self, update, args: List[str]) -> Steps:
+        """Power on the computer into the selected OS"""
+        hosts = yield from self.select_hosts(update, args)
+        if not hosts:
+            return
+        host = hosts[0]
+
+        # Add tag to prevent query from being handled by the wrong callbacks
+        tag = f"power_on_{host.name}:"
+
+        action = host.actions.current
+        if action is not None and action.kind == BOOT:
+            # Show the progress of the running boot instead of starting another one
+            message = yield update.message.reply_text(self.action_busy_text(host, action, JOINED))
+            host.boot.watch(message.chat_id, message.message_id)
+        elif not (yield host.is_online()):
+            # Ask the user which OS he wants to boot, from the cached grub menu
+            yield update.message.reply_text('Which OS do you want to boot?', reply_markup=self.os_keyboard(host, tag))
+        else:
+            running = host.running_os((yield host.os_fingerprint()))
+            if running is not None and running == host.default_os() and len(host.boot_targets()) > 1:
+                # Armed and reset into from the running OS, without powering off first
+                yield update.message.reply_text(
+                    f'{self.host_label(host)} is running {running}, which OS do you want to switch to?',
+                    reply_markup=self.os_keyboard(host, tag, exclude=running))
+            elif running is not None:
+                yield update.message.reply_text(
+                    f'{self.host_label(host)} is already running {running}, please power off first')
+            else:
+                yield update.message.reply_text(f'{self.host_label(host)} is already online, please power off first')
+
+    @only_allowed_chats
+    def select_os(self, update, args: List[str]) -> Steps:
+        """Callback for the power_on button, boot the selected OS"""
+        query = update.callback_query
+        yield query.answer()
+
+        name, data = callback_host(query.data, "power_on_")
+        host = self.fleet.get(name)
+
+        entry = None if host is None else host.boot_target(data)
+        if entry is None:
+            self.logger.error(f"(select_os) Unknown callback data: {query.data}")
+            return
+
+        # The host came up since the keyboard was sent, or it offered a switch from the running OS
+        from_default_os = False
+        if host.actions.current is None and (yield host.is_online()):
+            running = host.running_os((yield host.os_fingerprint()))
+            if running == entry.label:
+                yield query.edit_message_text(text=f"{self.host_label(host)} is already running {running}")
+                return
+            if running is None or running != host.default_os():
+                yield query.edit_message_text(
+                    text=f"{self.host_label(host)} is already online, please power off first")
+                return
+            from_default_os = True
+
+        # The boot sequence runs in the background and edits this message with its progress
+        message = query.message
+        request = host.actions.request(BOOT,
+                                       lambda: host.boot.start(entry.label, message.chat_id, message.message_id,
+                                                               from_default_os=from_default_os),
+                                       key=entry.label,
+                                       requester=(message.chat_id, message.message_id))
+        if request.outcome == STARTED:
+            if request.action.future.done() and request.action.future.result() is None:
+                yield query.edit_message_text(text="Another boot is already running, send /cancel to stop it")
+            else:
+                host.expect_transition()
+        elif request.outcome == JOINED:
+            # Tapped on another keyboard, that message shows the progress too
+            host.boot.watch(message.chat_id, message.message_id)
+        elif request.outcome == CONFLICT:
+            yield query.edit_message_text(text=self.action_busy_text(host, request.action, request.outcome))
+
+    @only_allowed_chats
+    def cancel_boot(self, update, args: List[str]) -> Steps:
+        """Cancel the running boot sequence or /run command"""
+        for host in (yield from self.select_hosts(update, args)):
+            with self._runs_lock:
+                remote = self.runs.get(host.name)
+            if host.boot.cancel():
+                yield update.message.reply_text('Cancelling the boot after the current step')
+            elif remote is not None:
+                remote.cancel()
+                yield update.message.reply_text('Stopping the command')
+            else:
+                yield update.message.reply_text('No boot in progress')
+
+    @only_allowed_chats
+    def run_command(self, update, args: List[str]) -> Steps:
+        """Run an allowed command on a host, its output is shown live in the reply"""
+        name = args[0] if args else None
+        if name not in self.run_commands:
+            choices = ', '.join(self.run_commands) or 'none configured'
+            yield update.message.reply_text(f"Usage: /run <command> [host]\nCommands: {choices}")
+            return
+        hosts = yield from self.select_hosts(update, args[1:])
+        if not hosts:
+            return
+        host = hosts[0]
+
+        with self._runs_lock:
+            running = host.name in self.runs
+            if not running:
+                self.runs[host.name] = None
+        if running:
+            yield update.message.reply_text(f"A command is already running on {host.name}, /cancel it first")
+            return
+        try:
+            message = yield update.message.reply_text(f"Running {name} on {host.name}")
+        except BaseException:
+            with self._runs_lock:
+                self.runs.pop(host.name, None)
+            raise
+        self.start_run(host, name, message)
+
+    @only_allowed_chats
+    def next_boot(self, update, args: List[str]) -> Steps:
+        """Arm the OS booted by the next power on while the host is up, 'none' for the default"""
+        args = list(args)
+        host_args = [args.pop()] if args and self.fleet.get(args[-1]) is not None else []
+        hosts = yield from self.select_hosts(update, host_args)
+        if not hosts:
+            return
+        host = hosts[0]
+
+        name = ' '.join(args)
+        if not name:
+            armed = host.next_boot.armed
+            current = f"{host.default_os()} (default)" if armed is None else f"{armed.os_name} (armed)"
+            yield update.message.reply_text(f"Next boot of {host.name}: {current}\n"
+                                            f"Usage: /next_boot <{'|'.join(host.boot_targets())}|none> [host]")
+            return
+        if name.lower() != 'none' and host.boot_target(name) is None:
+            yield update.message.reply_text(f"Unknown OS, choose one of: {', '.join(host.boot_targets())}")
+            return
+        if not (yield host.is_online()):
+            yield update.message.reply_text(
+                f"{self.host_label(host)} is offline, the next boot can only be set while it is up")
+            return
+
+        request = host.actions.request(ARM, lambda: self.start_arming(host, name, update.message), key=name.lower())
+        if request.outcome != STARTED:
+            yield update.message.reply_text(self.action_busy_text(host, request.action, request.outcome))
+
+    def _arm_next_boot(self, host, name: str, message) -> Steps:
+        reply = yield message.reply_text(f"Setting the next boot of {host.name}")
+        if name.lower() == 'none':
+            done = yield self.ssh_call(host, host.disarm_next_boot)
+            text = f"{host.name} boots {host.default_os()} next" if done else "Could not reset the next boot"
+        else:
+            entry = yield self.ssh_call(host, host.arm_next_boot, name)
+            if entry is None:
+                text = f"Could not arm {name}, is {host.name} running {host.default_os()}?"
+            else:
+                text = f"{entry.label} armed, the next /power_on into it is a single power pulse"
+        try:
+            yield reply.edit_text(text)
+        except Exception as e:
+            self.logger.warning(f"Could not edit the next boot message: {e}")
+
+    def check_host_online(self, update, args: List[str]) -> Steps:
+        """Reply if the hosts are online, probing every host at once for 'all'"""
+        hosts = yield from self.select_hosts(update, args, allow_all=True)
+        if not hosts:
+            return
+
+        lines = []
+        for host, fingerprint in (yield self.map_hosts(self._check_host, hosts)):
+            if isinstance(fingerprint, Exception):
+                self.logger.error(f"Could not check {host.name}: {fingerprint}")
+                lines.append(f"{self.host_label(host)} is unknown")
+            elif fingerprint is None:
+                lines.append(f"{self.host_label(host)} is offline")
+            else:
+                os_name = host.os_label(fingerprint)
+                lines.append(f"{self.host_label(host)} is online" + (f", running {os_name}" if os_name else ''))
+        yield update.message.reply_text('\n'.join(lines))
+
+    def _check_host(self, host) -> Steps:
+        # Only the hosts that are up are fingerprinted, all at once
+        if not (yield host.is_online()):
+            return None
+        return (yield host.os_fingerprint())
+
+    @only_allowed_chats
+    def send_telemetry(self, update, args: List[str]) -> Steps:
+        """Reply with the recorded temperatures, load and memory of a host, without asking it"""
+        args = list(args)
+        spans = [tier.name for tier in TIERS]
+        span = args.pop(0) if args and args[0] in spans else spans[0]
+        hosts = yield from self.select_hosts(update, args)
+        if not hosts:
+            return
+        host = hosts[0]
+
+        summaries = host.telemetry.summary(span)
+        if not summaries:
+            yield update.message.reply_text(f"No telemetry of {host.name} in the last {span}\n"
+                                            f"Usage: /telemetry [{'|'.join(spans)}] [host]")
+            return
+        last = host.telemetry.last
+        updated = '' if last is None else f", updated {time.time() - last[0]:.0f} s ago"
+        lines = [f"{host.name}, last {span}{updated}"]
+        for field, summary in summaries.items():
+            label, unit = FIELD_LABELS[field]
+            lines.append(f"{label}: {summary.last:.1f}{unit} now, mean {summary.mean:.1f}, max {summary.max:.1f}")
+            lines.append(summary.spark)
+        yield update.message.reply_text('\n'.join(lines))
+
+    @only_dev_chat
+    def send_stats(self, update, args: List[str]) -> Steps:
+        """Send the metrics summary to the dev chat"""
+        for chunk in split_message(REGISTRY.summary()):
+            yield update.message.reply_text(chunk)
+
+    @only_dev_chat
+    def profile(self, update, args: List[str]) -> Steps:
+        """Start or stop sampling the stacks of all the threads, the results go to the dev chat"""
+        action = args[0] if args else None
+        if action == 'start':
+            try:
+                interval = float(args[1]) / 1000 if len(args) > 1 else None
+                started = self.cpu_profiler.start(interval)
+            except ValueError:
+                yield update.message.reply_text("Usage: /profile start [interval ms > 0]|stop")
+                return
+            if started:
+                yield update.message.reply_text(f"CPU profiling every {self.cpu_profiler.interval * 1000:.0f} ms, "
+                                                f"/profile stop for the results")
+            else:
+                yield update.message.reply_text("CPU profiling already started, /profile stop for the results")
+        elif action == 'stop':
+            report = yield self.blocking(self.cpu_profiler.stop)
+            if report is None:
+                yield update.message.reply_text("CPU profiling is not started")
+                return
+            yield from self.send_report('CPU profile', 'cpu', report)
+        else:
+            yield update.message.reply_text("Usage: /profile start [interval ms > 0]|stop")
+
+    @only_dev_chat
+    def memprofile(self, update, args: List[str]) -> Steps:
+        """Trace the allocations, each call sends the top ones since tracing started to the dev chat
+
+        The first call starts tracing, keeping the number of frames given of each allocation.
+        """
+        stop = bool(args) and args[0] == 'stop'
+        if not self.memory_profiler.running:
+            if stop:
+                yield update.message.reply_text("Not tracing the allocations")
+                return
+            try:
+                started = self.memory_profiler.start(int(args[0]) if args else None)
+            except ValueError:
+                yield update.message.reply_text("Usage: /memprofile [frames > 0]|stop")
+                return
+            if started:
+                yield update.message.reply_text(f"Tracing the allocations with {self.memory_profiler.frames} frames, "
+                                                "/memprofile again for a snapshot, "
+                                                "/memprofile stop to end")
+            else:
+                yield update.message.reply_text("tracemalloc is already tracing, started by something else")
+            return
+        # Snapshots of a big heap take a while
+        report = yield self.blocking(self.memory_profiler.stop if stop else self.memory_profiler.snapshot)
+        if report is not None:
+            yield from self.send_report('Memory profile', 'mem', report)
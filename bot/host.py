@@ -0,0 +1,661 @@
+import logging
+import os
+import shlex
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from bot.actions import BOOT, ActionCoordinator
+from bot.boot_flow import BootOrchestrator
+from bot.boot_history import BootEstimate, BootHistory, wait_phases
+from bot.fingerprint import DEFAULT_PORTS, LINUX, SSH, WINDOWS, Fingerprint, OSFingerprinter
+from bot.gpio_scheduler import PulseScheduler
+from bot.grub_menu import GrubEntry, GrubMenu, NextBoot
+from bot.host_monitor import HostMonitor, HostState
+from bot.probe import HostProber
+from bot.remote_exec import STDOUT, RemoteCommand
+from bot.ssh_pool import SSHPool
+from bot.steps import Steps, Wait, drive
+from bot.telemetry import TELEMETRY_SCRIPT, TelemetrySampler, TelemetryStore, parse_telemetry
+from utils.metrics import REGISTRY
+
+# Seconds a fingerprint telling no OS is kept, the services may still be starting
+UNKNOWN_OS_TTL = 10
+
+SSH_EXEC = REGISTRY.histogram('suckerfish_ssh_exec_seconds', 'Time to run a sudo command, output included', ('result',))
+ONLINE_WAIT = REGISTRY.histogram('suckerfish_host_online_wait_seconds', 'Time waiting for a host to come online',
+                                 ('host', 'result'))
+
+
+def _resolve_with(future: Future, inner: Future) -> None:
+    """Resolve a future with the outcome of the one doing the work"""
+    if inner.cancelled():
+        future.cancel()
+    elif inner.exception() is not None:
+        future.set_exception(inner.exception())
+    else:
+        future.set_result(inner.result())
+
+
+class Host:
+    """A PC wired to the bot, with its own relays, probes, ssh and boot worker.
+
+    Every host gets its own pulse scheduler, monitor thread and boot
+    orchestrator, so a boot running on one host never delays another.
+    """
+
+    def __init__(self,
+                 name: str,
+                 host_ip: str,
+                 host_username: str,
+                 host_password: str,
+                 power_pin: int = 21,
+                 reset_pin: int = 20,
+                 windows_entry_id: int = 1,  # Second after ubuntu
+                 grub_cfg: str = '/boot/grub/grub.cfg',
+                 arm_at_shutdown: Optional[str] = None,
+                 armed_check_timeout: float = 10,
+                 ssh_pool: Optional[SSHPool] = None,
+                 ssh_key: Optional[str] = None,
+                 ssh_port: int = 22,
+                 pulse_time: float = 1,
+                 hold_time: float = 5,
+                 telegram_bot=None,
+                 state_dir: str = '.',
+                 probe_timeout: float = 1.0,
+                 probe_interval: float = 0.5,
+                 probe_sparse_interval: float = 5,
+                 boot_timeout: float = 75,
+                 probe_tcp_ports: Sequence[int] = (22,),
+                 fingerprint_timeout: float = 0.5,
+                 monitor_interval: float = 10,
+                 monitor_max_interval: float = 60,
+                 monitor_ttl: float = 90,
+                 telemetry_interval: Optional[float] = 30,
+                 on_change: Optional[Callable[['Host', HostState], None]] = None,
+                 prober: Optional[HostProber] = None,
+                 fingerprinter: Optional[OSFingerprinter] = None,
+                 pin_factory=None,
+                 logger=None):
+        """Initialize the host
+
+        Args:
+            name (str): Name of the host used in the commands.
+            host_ip (str): Local ip of the host.
+            host_username (str): User to ssh into the host.
+            host_password (str): Password of the user, used for sudo.
+            power_pin (int, optional): GPIO of the power switch relay. Defaults to 21.
+            reset_pin (int, optional): GPIO of the reset switch relay. Defaults to 20.
+            windows_entry_id (int, optional): Grub entry of Windows until the menu of the
+                host is known. Defaults to 1.
+            grub_cfg (str, optional): The grub.cfg of the host. Defaults to '/boot/grub/grub.cfg'.
+            arm_at_shutdown (str, optional): OS armed for the next boot before a forced
+                shutdown. Defaults to None.
+            armed_check_timeout (float, optional): Seconds to look for the default OS after
+                booting an armed entry, to tell if the entry was really booted. Defaults to 10.
+            ssh_pool (SSHPool, optional): Pool shared by the hosts. Defaults to a new pool.
+            ssh_key (str, optional): Private key file to ssh into the host. Defaults to None.
+            ssh_port (int, optional): The ssh port of the host. Defaults to 22.
+            pulse_time (float, optional): Seconds the switches are pressed. Defaults to 1.
+            hold_time (float, optional): Seconds the power switch is held to force a shutdown. Defaults to 5.
+            telegram_bot (telegram.Bot, optional): Bot used to report boot progress. Defaults to None.
+            state_dir (str, optional): Folder for the boot journal. Defaults to '.'.
+            probe_interval (float, optional): Seconds between probes while waiting for a boot. Defaults to 0.5.
+            probe_sparse_interval (float, optional): Seconds between probes before the host
+                is expected to be up, from its boot history. Defaults to 5.
+            boot_timeout (float, optional): Seconds to wait for a boot until there is a
+                boot history. Defaults to 75.
+            fingerprint_timeout (float, optional): Seconds to wait for the services telling the
+                running OS. Defaults to 0.5.
+            telemetry_interval (float, optional): Seconds between telemetry reads while the
+                host is up, None to disable. Defaults to 30.
+            on_change (Callable, optional): Called with (host, state) when it goes online or offline.
+            prober (HostProber, optional): Prober to use instead of the default one.
+            fingerprinter (OSFingerprinter, optional): Fingerprinter to use instead of the default one.
+            pin_factory (gpiozero.Factory, optional): Pin factory of the relays. Defaults to gpiozero's.
+        """
+        self.name = name
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        # host pc data
+        self.host_ip = host_ip
+        self.host_username = host_username
+        self.host_password = host_password
+        self.windows_entry_id = windows_entry_id
+        self.grub_cfg = grub_cfg
+
+        # Grub menu read from the host, the boot targets are resolved against it
+        self.grub_menu = GrubMenu(os.path.join(state_dir, f'grub_menu_{name}.json'),
+                                  fallback=[GrubEntry('0', 'Ubuntu'),
+                                            GrubEntry(str(windows_entry_id), 'Windows')],
+                                  logger=self.logger)
+
+        # Entry armed while the host was up, the next power on boots straight into it
+        self.arm_at_shutdown = arm_at_shutdown
+        self.armed_check_timeout = armed_check_timeout
+        self.next_boot = NextBoot(os.path.join(state_dir, f'next_boot_{name}.json'), logger=self.logger)
+
+        # In-process liveness probe, avoids forking ping on every check
+        self.probe_interval = probe_interval
+        self.probe_sparse_interval = probe_sparse_interval
+        self.boot_timeout = boot_timeout
+        if prober is None:
+            prober = HostProber(self.host_ip, timeout=probe_timeout, tcp_ports=probe_tcp_ports)
+        self.prober = prober
+
+        # The running OS, told by the services answering, cached until the host goes offline or online
+        if fingerprinter is None:
+            fingerprinter = OSFingerprinter(self.host_ip, ports=dict(DEFAULT_PORTS, **{SSH: ssh_port}),
+                                            timeout=fingerprint_timeout)
+        self.fingerprinter = fingerprinter
+        self._fingerprint: Optional[Tuple[Fingerprint, Optional[float]]] = None
+
+        # SSH transport, kept open and shared by all the commands
+        self.ssh_pool = SSHPool() if ssh_pool is None else ssh_pool
+        self.ssh = self.ssh_pool.connection(self.host_ip,
+                                            self.host_username,
+                                            password=self.host_password,
+                                            key_file=ssh_key,
+                                            port=ssh_port)
+
+        # The power and reset pins are claimed on first use, see pulses
+        self.power_pin = power_pin
+        self.reset_pin = reset_pin
+        self.pulse_time = pulse_time
+        self.hold_time = hold_time
+        self.power_switch = None
+        self.reset_switch = None
+        self._pin_factory = pin_factory
+        self._pulses: Optional[PulseScheduler] = None
+        self._gpio_lock = threading.Lock()
+        self._pins_released = False
+
+        # Cached host state, refreshed in the background
+        self.on_change = on_change
+        self.monitor = HostMonitor(self.prober,
+                                   interval=monitor_interval,
+                                   max_interval=monitor_max_interval,
+                                   fast_interval=self.probe_interval,
+                                   ttl=monitor_ttl,
+                                   on_change=self._state_changed,
+                                   name=name,
+                                   logger=self.logger)
+
+        # Boot durations per OS, to know when to expect the host
+        self.boot_history = BootHistory(os.path.join(state_dir, f'boot_history_{name}.json'),
+                                        logger=self.logger)
+
+        # Boot sequences run on this host's own worker, journaled to survive restarts
+        self.boot = BootOrchestrator(self,
+                                     telegram_bot,
+                                     journal_file=os.path.join(state_dir, f'boot_journal_{name}.json'),
+                                     logger=self.logger)
+
+        # Boots, relay presses and arming, one at a time with duplicates coalesced
+        self.actions = ActionCoordinator(name, logger=self.logger)
+
+        # Temperatures, load and memory while the host is up, kept in ring buffers
+        self.telemetry = TelemetryStore(os.path.join(state_dir, f'telemetry_{name}.bin'), logger=self.logger)
+        self.telemetry_sampler = None
+        if telemetry_interval:
+            self.telemetry_sampler = TelemetrySampler(self, self.telemetry, interval=telemetry_interval,
+                                                      logger=self.logger)
+
+    @property
+    def pulses(self) -> PulseScheduler:
+        """Pulse scheduler of the relays, the pins are claimed on first use"""
+        if self._pulses is None:
+            with self._gpio_lock:
+                if self._pins_released:
+                    raise RuntimeError(f"{self.name} was reconfigured or removed, its pins are released")
+                if self._pulses is None:
+                    from gpiozero import LED
+                    self.power_switch = LED(self.power_pin, pin_factory=self._pin_factory)
+                    self.reset_switch = LED(self.reset_pin, pin_factory=self._pin_factory)
+
+                    # Pulses are timed in the background so handlers never sleep
+                    pulses = PulseScheduler(logger=self.logger)
+                    pulses.add_pin('power', self.power_switch)
+                    pulses.add_pin('reset', self.reset_switch)
+                    self._pulses = pulses
+        return self._pulses
+
+    def release_pins(self) -> None:
+        """Give the relays back for good, e.g. to the host replacing this one"""
+        with self._gpio_lock:
+            self._pins_released = True
+            for switch in (self.power_switch, self.reset_switch):
+                if switch is not None:
+                    switch.close()
+            self.power_switch = self.reset_switch = None
+            self._pulses = None
+
+    def warm_up(self) -> None:
+        """Claim the pins and load the ssh key now instead of on first use"""
+        t_start = time.monotonic()
+        self.pulses
+        self.ssh.load_key()
+        self.logger.debug(f"{self.name} warmed up in {(time.monotonic() - t_start) * 1000:.0f} ms")
+
+    def start(self) -> None:
+        """Start the background monitor and resume an interrupted boot"""
+        self.monitor.start()
+        if self.telemetry_sampler is not None:
+            self.telemetry_sampler.start()
+        resumed = self.boot.resume()
+        if resumed is not None:
+            # Taps on the boot button join it instead of being turned down
+            self.actions.request(BOOT, lambda: resumed, key=getattr(self.boot.job, 'os_name', None))
+
+    def stop(self) -> None:
+        """Stop the background workers"""
+        self.boot.shutdown()
+        if self.telemetry_sampler is not None:
+            self.telemetry_sampler.stop()
+        self.monitor.stop()
+        self.ssh.close()
+
+    def _state_changed(self, state: HostState) -> None:
+        if state.online and not self.boot.busy and self.next_boot.armed is not None:
+            # Booted by someone else, which used up the armed entry
+            armed = self.next_boot.clear()
+            self.logger.info(f"{self.name} booted outside the bot, {armed.os_name} is no longer armed")
+        if self.on_change is not None:
+            self.on_change(self, state)
+
+    def connect_ssh(self, timeout=5) -> bool:
+        """Connect to the ssh server"""
+        self.ssh.timeout = timeout
+        return self.ssh.ensure_connected()
+
+    def stream_sudo_command(self, command: str, max_lines: int = 100) -> RemoteCommand:
+        """Start a sudo command, its output is read as it runs
+
+        Args:
+            command (str): The command to execute.
+            max_lines (int, optional): Lines kept of each output stream. Defaults to 100.
+
+        Returns:
+            RemoteCommand: The running command, iterate it to read the output lines.
+        """
+        channel = self.ssh.open_session(timeout=self.ssh.timeout)
+        return RemoteCommand(channel,
+                             "sudo -S -p '' %s" % command,
+                             stdin=self.host_password + "\n",
+                             max_lines=max_lines)
+
+    def run_sudo_command(self, command="ls",
+                         jobid="None"):
+        """Executes a sudo command over a established SSH connectiom.
+
+        Args:
+            command (str, optional): The command to execute. Defaults to 'ls'.
+            jobid (str, optional): The job id to use. Defaults to 'None'.
+
+        Returns:
+            tuple: (bool, output): (True if the command was executed, the last
+                stdout lines if it was or the last stderr lines if not)
+        """
+
+        self.logger.info("Job[%s]: Executing on %s: sudo %s" % (jobid, self.name, command))
+        t_start = time.monotonic()
+        try:
+            remote = self.stream_sudo_command(command)
+            for stream, line in remote:
+                if stream == STDOUT:
+                    self.logger.info("Job[%s]: %s" % (jobid, line))
+        except Exception as e:
+            self.logger.error(f"SSH connection failed: {e}")
+            SSH_EXEC.labels('error').observe(time.monotonic() - t_start)
+            return False, [str(e)]
+        self.logger.debug("Job[%s]: SSH handshake time saved so far: %.0f ms" %
+                          (jobid, self.ssh.handshake_time_saved * 1000))
+
+        # Check exit code.
+        exit_status = remote.exit_status
+        SSH_EXEC.labels('failed' if exit_status else 'ok').observe(time.monotonic() - t_start)
+        stdoutput = list(remote.stdout)
+        stderroutput = list(remote.stderr)
+        self.logger.debug("Job[%s]:stderror: %s" % (jobid, stderroutput))
+        self.logger.info("Job[%s]:Command status: %s" % (jobid, exit_status))
+        if not exit_status:
+            self.logger.info("Job[%s]: Command executed." % jobid)
+            if not stdoutput:
+                stdoutput = True
+            return True, stdoutput
+        else:
+            self.logger.error("Job[%s]: Command failed." % jobid)
+            for output in stderroutput:
+                self.logger.error("Job[%s]: %s" % (jobid, output))
+            return False, stderroutput
+
+    def read_telemetry(self) -> Optional[Dict[str, float]]:
+        """Read the temperatures, load and memory use of the host in one command
+
+        Returns:
+            dict: The values reported by the host, see bot.telemetry.FIELDS, None if it could not be read.
+        """
+        t_start = time.monotonic()
+        try:
+            remote = self.stream_sudo_command(f"sh -c {shlex.quote(TELEMETRY_SCRIPT)}", max_lines=10)
+            values = parse_telemetry(line for stream, line in remote if stream == STDOUT)
+        except Exception as e:
+            # Expected while the host runs an OS without ssh
+            self.logger.debug(f"Could not read the telemetry of {self.name}: {e}")
+            SSH_EXEC.labels('error').observe(time.monotonic() - t_start)
+            return None
+        # A host without nvidia-smi fails the command, the other values are still there
+        SSH_EXEC.labels('failed' if remote.exit_status else 'ok').observe(time.monotonic() - t_start)
+        return values or None
+
+    def is_online(self, max_age: Optional[float] = None) -> bool:
+        """Check if the host pc is online, answered from the monitor cache when fresh"""
+        return self.monitor.is_online(max_age)
+
+    def expect_transition(self, duration: float = 120) -> None:
+        """Probe densely for the next duration seconds, e.g. during a boot"""
+        self.monitor.expect_transition(duration)
+
+    def os_fingerprint(self, max_age: Optional[float] = None) -> Fingerprint:
+        """The cached fingerprint of the running OS, taken again if it is stale, see cached_fingerprint"""
+        fingerprint = self.cached_fingerprint(max_age)
+        if fingerprint is None:
+            fingerprint = self.record_fingerprint(self.fingerprinter.fingerprint())
+        return fingerprint
+
+    def cached_fingerprint(self, max_age: Optional[float] = None) -> Optional[Fingerprint]:
+        """The last fingerprint, None if the host went offline or online since or it is too old
+
+        It is kept for max_age seconds, the monitor ttl by default, and at most
+        UNKNOWN_OS_TTL when it told no OS, as the services start after the
+        host answers the probes.
+        """
+        cached = self._fingerprint
+        if cached is None:
+            return None
+        fingerprint, changed_at = cached
+        state = self.monitor.state
+        max_age = self.monitor.ttl if max_age is None else max_age
+        if fingerprint.family is None:
+            max_age = min(max_age, UNKNOWN_OS_TTL)
+        if (state is not None and state.changed_at != changed_at) or \
+                time.monotonic() - fingerprint.checked_at > max_age:
+            return None
+        return fingerprint
+
+    def record_fingerprint(self, fingerprint: Fingerprint) -> Fingerprint:
+        """Cache a fingerprint, also used for those taken elsewhere"""
+        state = self.monitor.state
+        self._fingerprint = (fingerprint, None if state is None else state.changed_at)
+        return fingerprint
+
+    def running_os(self, fingerprint: Fingerprint) -> Optional[str]:
+        """The boot target running according to the fingerprint, None if it can't tell
+
+        Windows is the target named after it, Linux the default OS, the one
+        serving ssh to the bot, unless the default is Windows.
+        """
+        targets = self.boot_targets()
+        windows = [target for target in targets if WINDOWS in target.lower()]
+        if fingerprint.family == WINDOWS:
+            return windows[0] if windows else None
+        if fingerprint.family == LINUX:
+            default = self.default_os()
+            if default not in windows:
+                return default
+            return next((target for target in targets if target not in windows), None)
+        return None
+
+    def os_label(self, fingerprint: Fingerprint) -> Optional[str]:
+        """Name of the running OS in the replies, its boot target or else its family, None if unknown"""
+        running = self.running_os(fingerprint)
+        if running is None and fingerprint.family is not None:
+            return fingerprint.family.capitalize()
+        return running
+
+    def power_switch_action(self) -> Future:
+        """Press the power switch for pulse_time, the future resolves on release"""
+        return self.pulses.pulse('power', self.pulse_time)
+
+    def reset_switch_action(self) -> Future:
+        """Press the reset switch for pulse_time, the future resolves on release"""
+        return self.pulses.pulse('reset', self.pulse_time)
+
+    def power_switch_hold(self) -> Future:
+        """Hold the power switch for hold_time, the future resolves on release"""
+        return self.pulses.pulse('power', self.hold_time)
+
+    def boot_estimate(self, os_name: Optional[str]) -> Optional[BootEstimate]:
+        """Expected boot time of an OS from the history, None if unknown"""
+        if os_name is None:
+            return None
+        return self.boot_history.estimate(os_name)
+
+    def wait_for_host_online(self,
+                             timeout: Optional[float] = None,
+                             cancel: Optional[threading.Event] = None,
+                             os_name: Optional[str] = None,
+                             progress: Optional[Callable[[Optional[float]], None]] = None) -> bool:
+        """Wait for the host to come online, stops early if cancel is set
+
+        When the OS being booted is given, the probes are scheduled from its
+        boot history, see bot.boot_history.wait_phases, and the boot time is
+        added to the history once the host answers.
+
+        Args:
+            timeout (float, optional): Seconds to wait. Defaults to the one of the
+                boot history, or boot_timeout.
+            cancel (threading.Event, optional): Stop waiting when set. Defaults to None.
+            os_name (str, optional): The OS being booted. Defaults to None.
+            progress (Callable, optional): Called with the expected seconds left, or
+                None once the boot runs late, when the wait starts and changes pace.
+        """
+        return drive(self.wait_online_steps(self.prober, timeout, cancel, os_name, progress))
+
+    def wait_online_steps(self, prober: HostProber, timeout: Optional[float], cancel, os_name: Optional[str],
+                          progress: Optional[Callable[[Optional[float]], None]]) -> Steps:
+        """Steps of wait_for_host_online probing with prober, also driven by AsyncHost"""
+        estimate = self.boot_estimate(os_name)
+        if timeout is None:
+            timeout = self.boot_timeout if estimate is None else estimate.timeout
+        phases = wait_phases(estimate, timeout, self.probe_interval,
+                             self.probe_sparse_interval, prober.timeout)
+
+        t_start = time.monotonic()
+        result = yield prober.probe()
+        # Already up, e.g. a boot resumed after a restart, says nothing about the boot time
+        record = not result.online and os_name is not None
+        for phase in phases:
+            if result.online:
+                break
+            elapsed = time.monotonic() - t_start
+            if phase.until <= elapsed:
+                continue
+            if progress is not None and estimate is not None:
+                remaining = estimate.expected - elapsed
+                progress(remaining if elapsed < estimate.latest else None)
+            result = yield prober.wait_online(phase.until - elapsed,
+                                              interval=phase.interval,
+                                              probe_timeout=phase.probe_timeout,
+                                              stop_event=cancel)
+            if cancel is not None and cancel.is_set():
+                break
+
+        elapsed = time.monotonic() - t_start
+        self.monitor.record(result)
+        ONLINE_WAIT.labels(self.name, 'online' if result.online else 'timeout').observe(elapsed)
+        if result.online:
+            self.logger.info(f"{self.name} online after {elapsed:.1f} s "
+                             f"({result.method}, rtt {result.rtt * 1000:.1f} ms)")
+            if record:
+                self.boot_history.record(os_name, elapsed)
+        return result.online
+
+    def boot_targets(self) -> List[str]:
+        """Names of the OSes that can be booted, from the cached grub menu"""
+        return [entry.label for entry in self.grub_menu.targets()]
+
+    def boot_target(self, name: str) -> Optional[GrubEntry]:
+        """The grub entry of an OS by name, None if the menu has no such entry"""
+        return self.grub_menu.resolve(name)
+
+    def default_os(self) -> str:
+        """Name of the OS booted when no other one is armed"""
+        default = self.grub_menu.default
+        return 'Ubuntu' if default is None else default.label
+
+    def refresh_grub_menu(self) -> bool:
+        """Read the grub.cfg of the host and cache its menu
+
+        The hash and the file are read in a single command and parsed as
+        they arrive.
+        """
+        grub_cfg = shlex.quote(self.grub_cfg)
+        script = f"sha256sum {grub_cfg} && cat {grub_cfg}"
+        t_start = time.monotonic()
+        try:
+            remote = self.stream_sudo_command(f"sh -c {shlex.quote(script)}")
+            stdout = (line for stream, line in remote if stream == STDOUT)
+            digest = next(stdout, '').partition(' ')[0]
+            updated = self.grub_menu.update(digest, stdout)
+            # The parser reads to the end, which also reads the exit status
+        except Exception as e:
+            self.logger.error(f"Could not read the grub menu of {self.name}: {e}")
+            SSH_EXEC.labels('error').observe(time.monotonic() - t_start)
+            return False
+        SSH_EXEC.labels('failed' if remote.exit_status else 'ok').observe(time.monotonic() - t_start)
+        if remote.exit_status or not updated:
+            self.logger.error(f"Could not read the grub menu of {self.name}: {list(remote.stderr)}")
+            return False
+        self.logger.info(f"Grub menu of {self.name}: {', '.join(self.boot_targets())}")
+        return True
+
+    def arm_boot_target(self, name: str) -> Optional[GrubEntry]:
+        """Make an OS the one booted by the next reboot
+
+        The grub env is recreated, the entry armed, the env listed to confirm
+        it and the hash of the grub.cfg read back in a single command. The
+        menu is read from the host first if it isn't cached, and again if the
+        hash shows it changed (e.g. a kernel update), re-arming if the entry moved.
+
+        Returns:
+            GrubEntry: The armed entry, None if it could not be armed.
+        """
+        if not self.grub_menu.cached:
+            self.refresh_grub_menu()
+        entry = self.boot_target(name)
+        if entry is None:
+            self.logger.error(f"No grub entry of {name} on {self.name}")
+            return None
+
+        done, output = self.run_sudo_command(self._arm_command(entry.target, check_menu=True))
+        output = output if isinstance(output, list) else []
+        if not done or f'next_entry={entry.target}' not in output:
+            self.logger.error(f"Could not arm {entry.title} on {self.name}")
+            return None
+        digest = output[-1].partition(' ')[0]
+        if self.grub_menu.cached and digest != self.grub_menu.digest:
+            self.logger.info(f"Grub menu of {self.name} changed, reading it again")
+            if not self.refresh_grub_menu():
+                return None
+            new_entry = self.boot_target(name)
+            if new_entry is None:
+                self.logger.error(f"No grub entry of {name} on {self.name}")
+                return None
+            if new_entry.target != entry.target and not self.reboot_into_entry(new_entry.target):
+                return None
+            entry = new_entry
+        return entry
+
+    def arm_next_boot(self, name: str) -> Optional[GrubEntry]:
+        """Arm an OS while the host is up and record it, so the next power on boots it directly
+
+        Returns:
+            GrubEntry: The armed entry, None if the host could not be reached or armed.
+        """
+        if not self.connect_ssh():
+            self.logger.error(f"Could not arm {name}, no ssh connection to {self.name}")
+            return None
+        entry = self.arm_boot_target(name)
+        if entry is not None:
+            self.next_boot.record(entry.label, entry.target)
+            self.logger.info(f"{entry.label} armed for the next boot of {self.name}")
+        return entry
+
+    def disarm_next_boot(self) -> bool:
+        """Boot the default entry next again"""
+        if not self.connect_ssh():
+            self.logger.error(f"Could not disarm, no ssh connection to {self.name}")
+            return False
+        done, _ = self.run_sudo_command("grub-editenv - unset next_entry")
+        if done:
+            self.next_boot.clear()
+        return done
+
+    def default_os_running(self, cancel: Optional[threading.Event] = None) -> bool:
+        """Whether the default OS came up, seen as its ssh server answering
+
+        Only the default OS serves ssh to the bot, like the armed boot has
+        always assumed. Looks for up to armed_check_timeout seconds, as sshd
+        may start a little after the host answers the probes.
+        """
+        return drive(self.default_os_steps(self.prober, self.connect_ssh, cancel))
+
+    def default_os_steps(self, prober: HostProber, connect_ssh: Callable, cancel) -> Steps:
+        """Steps of default_os_running, logging in with connect_ssh(timeout), also driven by AsyncHost"""
+        deadline = time.monotonic() + self.armed_check_timeout
+        while True:
+            timeout = max(0.1, min(2.0, deadline - time.monotonic()))
+            # A closed port is refused at once, only try to log in when it is open
+            if ((yield prober.probe_tcp(self.ssh.port, timeout, open_only=True)) is not None
+                    and (yield connect_ssh(timeout))):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (yield Wait(min(0.5, remaining), cancel)):
+                return False
+
+    def force_shutdown(self) -> Future:
+        """Hold the power switch, arming arm_at_shutdown first if set
+
+        Returns:
+            Future: Resolves when the power switch is released.
+        """
+        if self.arm_at_shutdown is None:
+            return self.power_switch_hold()
+
+        future = Future()
+
+        def arm_and_hold():
+            # Fails when the host doesn't run the default OS, the shutdown goes on
+            try:
+                self.arm_next_boot(self.arm_at_shutdown)
+            except Exception as e:
+                self.logger.error(f"Could not arm {self.arm_at_shutdown} before the shutdown of {self.name}: {e}")
+            try:
+                hold = self.power_switch_hold()
+            except Exception as e:
+                future.set_exception(e)
+                return
+            hold.add_done_callback(lambda inner: _resolve_with(future, inner))
+
+        threading.Thread(target=arm_and_hold, name=f'shutdown_{self.name}', daemon=True).start()
+        return future
+
+    def make_windows_next(self) -> bool:
+        """Make the windows entry the default for the next boot"""
+        return self.arm_boot_target('Windows') is not None
+
+    def reboot_into_entry(self, entry_id) -> bool:
+        """Reboot into the given entry, a number, '1>2' path, title or id"""
+        done, _ = self.run_sudo_command(self._arm_command(entry_id))
+        return done
+
+    def _arm_command(self, entry_id, check_menu: bool = False) -> str:
+        """Command arming an entry, check_menu also lists the env and hashes the grub.cfg"""
+        # Only recreate the env when it can't be read, create would drop saved_entry
+        script = (f"grub-editenv - list > /dev/null || grub-editenv - create && "
+                  f"grub-reboot {shlex.quote(str(entry_id))}")
+        if check_menu:
+            script += f" && grub-editenv - list && sha256sum {shlex.quote(self.grub_cfg)}"
+        return f"sh -c {shlex.quote(script)}"
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+
+from bot.probe import HostProber, ProbeResult
+
+
+class HostState(NamedTuple):
+    """Cached liveness of the host"""
+    online: bool
+    rtt: Optional[float]
+    method: str
+    checked_at: float  # time.monotonic() of the probe
+    changed_at: float  # time.time() of the last online/offline transition
+
+
+class HostMonitor:
+    """Keeps the liveness of the host current in the background.
+
+    The host is probed every ``interval`` seconds. While its state does not
+    change the interval doubles up to ``max_interval``, and while a boot or
+    shutdown is expected it is probed every ``fast_interval`` seconds.
+    Readers get the cached state as long as it is younger than ``ttl``.
+    """
+
+    def __init__(self,
+                 prober: HostProber,
+                 interval: float = 10,
+                 max_interval: float = 60,
+                 fast_interval: float = 1,
+                 ttl: float = 90,
+                 on_change: Optional[Callable[[HostState], None]] = None,
+                 name: str = 'Host',
+                 logger=None):
+        """Initialize the monitor
+
+        Args:
+            prober (HostProber): The prober for the host.
+            interval (float, optional): Base seconds between probes. Defaults to 10.
+            max_interval (float, optional): Upper limit of the backoff. Defaults to 60.
+            fast_interval (float, optional): Seconds between probes during a transition. Defaults to 1.
+            ttl (float, optional): Max age of the cached state before probing again. Defaults to 90.
+            on_change (Callable, optional): Called with the new state on every transition. Defaults to None.
+            name (str, optional): Name of the host, used in the logs and the thread name. Defaults to 'Host'.
+        """
+        self.prober = prober
+        self.interval = interval
+        self.max_interval = max_interval
+        self.fast_interval = fast_interval
+        self.ttl = ttl
+        self.on_change = on_change
+        self.name = name
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._state: Optional[HostState] = None
+        self._current_interval = interval
+        self._dense_until = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def state(self) -> Optional[HostState]:
+        """The last known state, None before the first probe"""
+        return self._state
+
+    def start(self) -> None:
+        """Start the background probing"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f'host_monitor_{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background probing"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def current(self, max_age: Optional[float] = None) -> HostState:
+        """Return the cached state, probing first if it is older than max_age (the ttl by default)"""
+        max_age = self.ttl if max_age is None else max_age
+        state = self._state
+        if state is None or time.monotonic() - state.checked_at > max_age:
+            state = self.record(self.prober.probe())
+        return state
+
+    def is_online(self, max_age: Optional[float] = None) -> bool:
+        """Cached liveness of the host, see current"""
+        return self.current(max_age).online
+
+    def expect_transition(self, duration: float = 120) -> None:
+        """Probe densely for the next duration seconds, e.g. during a boot"""
+        self._dense_until = max(self._dense_until, time.monotonic() + duration)
+        self._wakeup.set()
+
+    def record(self, result: ProbeResult) -> HostState:
+        """Update the cache with a probe result, also used for probes done elsewhere"""
+        now = time.monotonic()
+        with self._lock:
+            previous = self._state
+            changed = previous is not None and previous.online != result.online
+            if previous is None or changed:
+                changed_at = time.time()
+            else:
+                changed_at = previous.changed_at
+            state = HostState(result.online, result.rtt, result.method, now, changed_at)
+            self._state = state
+            if changed:
+                self._current_interval = self.interval
+
+        if changed:
+            self.logger.info(f"{self.name} is now {'online' if state.online else 'offline'}")
+            if self.on_change is not None:
+                try:
+                    self.on_change(state)
+                except Exception as e:
+                    self.logger.error(f"Host state change callback failed: {e}")
+        return state
+
+    def next_interval(self) -> float:
+        """Seconds until the next probe, backing off while nothing changes"""
+        if time.monotonic() < self._dense_until:
+            return self.fast_interval
+        with self._lock:
+            interval = self._current_interval
+            self._current_interval = min(self._current_interval * 2, self.max_interval)
+        return interval
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.record(self.prober.probe())
+            except Exception as e:
+                self.logger.error(f"Host monitor probe failed: {e}")
+            self._wakeup.wait(self.next_interval())
+            self._wakeup.clear()
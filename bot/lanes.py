@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from utils.metrics import REGISTRY
+
+# Lanes of the handlers, by how long they keep a worker
+INSTANT = 'instant'  # Answer from memory, one or two Bot API calls
+IO = 'io'  # Wait on the network, e.g. an external service
+LONG = 'long'  # Run for seconds to minutes, e.g. ssh commands
+
+# Workers and queued tasks of each lane
+DEFAULT_LANES: Dict[str, Dict[str, int]] = {
+    INSTANT: {'workers': 2, 'queue': 50},
+    IO: {'workers': 2, 'queue': 20},
+    LONG: {'workers': 2, 'queue': 4},
+}
+
+# One worker per lane, for the low memory mode
+LOW_MEMORY_LANES: Dict[str, Dict[str, int]] = {
+    INSTANT: {'workers': 1, 'queue': 50},
+    IO: {'workers': 1, 'queue': 20},
+    LONG: {'workers': 1, 'queue': 4},
+}
+
+# Reply to a command refused because its lane is full
+BUSY_TEXT = 'Too busy right now, please try again in a minute'
+
+LANE_DEPTH = REGISTRY.gauge('suckerfish_lane_queue_depth', 'Tasks waiting for a worker of the lane', ('lane',))
+LANE_RUNNING = REGISTRY.gauge('suckerfish_lane_running', 'Tasks running in the lane', ('lane',))
+LANE_WAIT = REGISTRY.histogram('suckerfish_lane_wait_seconds', 'Time tasks waited for a worker of the lane',
+                               ('lane',))
+LANE_SHED = REGISTRY.counter('suckerfish_lane_shed', 'Tasks refused because the lane was full', ('lane',))
+
+
+class Lane:
+    """A bounded pool of workers with a bounded queue in front.
+
+    A task submitted while every worker is busy and the queue is full is
+    refused instead of queued, so a flood of slow work is turned away at
+    once rather than piling up behind itself.
+    """
+
+    def __init__(self, name: str, workers: int = 2, queue: int = 10, logger=None):
+        """Initialize the lane, the worker threads start on first use
+
+        Args:
+            name (str): Name of the lane in the metrics and thread names.
+            workers (int, optional): Tasks run at once. Defaults to 2.
+            queue (int, optional): Tasks waiting for a worker before refusing more. Defaults to 10.
+        """
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max(0, queue)
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'lane_{name}')
+        self._pending = 0  # Queued and running
+        self._running = 0
+        self._lock = threading.Lock()
+
+        self._wait = LANE_WAIT.labels(name)
+        self._shed = LANE_SHED.labels(name)
+        LANE_DEPTH.labels(name).set_function(lambda: self.depth)
+        LANE_RUNNING.labels(name).set_function(lambda: self.running)
+
+    @property
+    def depth(self) -> int:
+        """Tasks waiting for a worker"""
+        return self._pending - self._running
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def submit(self, fn: Callable, *args) -> Optional[Future]:
+        """Run fn(*args) on a worker of the lane
+
+        Returns:
+            Future: The result of the call, None if the lane is full.
+        """
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self._shed.inc()
+                return None
+            self._pending += 1
+        return self.executor.submit(self._run, time.perf_counter(), fn, args)
+
+    def _run(self, t_submit: float, fn: Callable, args: tuple):
+        self._wait.observe(time.perf_counter() - t_submit)
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._pending -= 1
+
+    def shutdown(self) -> None:
+        """Stop taking tasks, the running ones finish in the background"""
+        self.executor.shutdown(wait=False)
+
+
+def make_lanes(config: Optional[Dict[str, dict]] = None, logger=None,
+               defaults: Optional[Dict[str, Dict[str, int]]] = None) -> Dict[str, Lane]:
+    """The lanes of defaults (DEFAULT_LANES if None), with the workers and queue overridden by config"""
+    lanes = {}
+    for name, lane_defaults in (defaults or DEFAULT_LANES).items():
+        settings = dict(lane_defaults)
+        settings.update((config or {}).get(name) or {})
+        lanes[name] = Lane(name, int(settings['workers']), int(settings['queue']), logger=logger)
+    return lanes
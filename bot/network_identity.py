@@ -0,0 +1,283 @@
+import ipaddress
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from utils.metrics import REGISTRY
+
+# Plain text services answering with the public ip, tried in order
+DEFAULT_PROVIDERS = (
+    'https://api.ipify.org',
+    'https://ifconfig.me/ip',
+    'https://icanhazip.com',
+    'https://checkip.amazonaws.com',
+)
+
+SIOCGIFADDR = 0x8915
+
+LOOKUPS = REGISTRY.histogram('suckerfish_public_ip_lookup_seconds', 'Time to ask a provider for the public ip',
+                             ('provider', 'result'))
+
+
+def local_addresses() -> Dict[str, List[str]]:
+    """Addresses of the network interfaces, loopback left out
+
+    Read from the kernel (ioctl for IPv4, /proc/net/if_inet6 for IPv6) on
+    Linux, so nothing goes through DNS. Elsewhere only the address of the
+    default route is found, under the name 'default'.
+    """
+    addresses: Dict[str, List[str]] = {}
+    try:
+        import fcntl
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for _, name in socket.if_nameindex():
+                try:
+                    packed = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', name[:15].encode()))
+                except OSError:
+                    # No IPv4 address on this interface
+                    continue
+                addresses.setdefault(name, []).append(socket.inet_ntoa(packed[20:24]))
+    except (ImportError, AttributeError, OSError):
+        pass
+    try:
+        with open('/proc/net/if_inet6') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 6:
+                    continue
+                address = ipaddress.IPv6Address(int(fields[0], 16))
+                if not address.is_link_local:
+                    addresses.setdefault(fields[5], []).append(str(address))
+    except (OSError, ValueError):
+        pass
+
+    addresses = {name: ips for name, ips in addresses.items()
+                 if not all(ipaddress.ip_address(ip).is_loopback for ip in ips)}
+    if not addresses:
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                # Picks the route without sending anything
+                s.connect(('192.0.2.1', 9))
+                addresses['default'] = [s.getsockname()[0]]
+        except OSError:
+            pass
+    return addresses
+
+
+class NetworkState(NamedTuple):
+    """What the bot knows about its own addresses"""
+    local: Dict[str, List[str]]
+    public_ip: Optional[str]
+    provider: Optional[str]  # Which one answered
+    checked_at: Optional[float]  # time.time() of the last answer about the public ip
+    changed_at: Optional[float]  # time.time() the public ip was first seen
+
+
+class NetworkIdentity:
+    """Keeps the local and public addresses of the bot current in the background.
+
+    The local addresses are read from the interfaces and the public ip is
+    asked to the providers in order through one pooled HTTP session, every
+    ttl seconds, so /current_ip answers from memory. A failed lookup is
+    retried after retry_interval. The public ip is kept in a small json
+    file, so a change while the bot was down is noticed too.
+    """
+
+    def __init__(self,
+                 state_file: str,
+                 providers: Sequence[str] = DEFAULT_PROVIDERS,
+                 ttl: float = 300,
+                 timeout: float = 3,
+                 retry_interval: float = 60,
+                 on_change: Optional[Callable[[Optional[str], str], None]] = None,
+                 pooled: bool = True,
+                 logger=None):
+        """Initialize the service, the first lookup happens in start()
+
+        Args:
+            state_file (str): Where the last public ip is kept.
+            providers (Sequence[str], optional): Urls answering with the public ip as text.
+                Defaults to DEFAULT_PROVIDERS.
+            ttl (float, optional): Seconds between lookups. Defaults to 300.
+            timeout (float, optional): Seconds to wait for each provider. Defaults to 3.
+            retry_interval (float, optional): Seconds before trying again after every provider failed.
+                Defaults to 60.
+            on_change (Callable, optional): Called with (old, new) when the public ip changes.
+                Defaults to None.
+            pooled (bool, optional): Keep the connections to the providers open in a requests session,
+                else each lookup opens its own with urllib and requests is never loaded. Defaults to True.
+        """
+        self.state_file = state_file
+        self.pooled = pooled
+        self.providers = list(providers) or list(DEFAULT_PROVIDERS)
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.on_change = on_change
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._session = None
+        self._state = NetworkState({}, None, None, None, None)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._load()
+
+    @property
+    def state(self) -> NetworkState:
+        return self._state
+
+    @property
+    def session(self):
+        """The HTTP session, keeps the connections to the providers open"""
+        if self._session is None:
+            import requests
+            session = requests.Session()
+            session.headers['User-Agent'] = 'suckerfish-bot'
+            self._session = session
+        return self._session
+
+    def configure(self,
+                  providers: Sequence[str] = DEFAULT_PROVIDERS,
+                  ttl: float = 300,
+                  timeout: float = 3,
+                  retry_interval: float = 60) -> None:
+        """Change the lookups while running, e.g. from a reloaded config, the defaults are those of __init__"""
+        providers = list(providers) or list(DEFAULT_PROVIDERS)
+        changed = providers != self.providers or ttl < self.ttl
+        self.providers, self.ttl, self.timeout, self.retry_interval = providers, ttl, timeout, retry_interval
+        if changed:
+            # Not waiting out the old ttl for the new providers
+            self.refresh_soon()
+
+    def fetch(self, url: str) -> str:
+        """GET url on a connection of its own, raises unless it answers with a success"""
+        import urllib.request
+        request = urllib.request.Request(url, headers={'User-Agent': 'suckerfish-bot'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            # An address, anything longer is not one
+            return response.read(256).decode()
+
+    def start(self) -> None:
+        """Start refreshing in the background, the first lookup runs at once"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='network_identity', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._session is not None:
+            self._session.close()
+
+    def refresh_soon(self) -> None:
+        """Look up the public ip now instead of at the end of the ttl"""
+        self._wakeup.set()
+
+    def refresh(self) -> NetworkState:
+        """Read the interfaces and ask the providers for the public ip, returns the new state"""
+        local = local_addresses()
+        with self._lock:
+            # Instant, available while the providers are asked
+            self._state = self._state._replace(local=local)
+        return self.apply(local, *self.lookup_public_ip())
+
+    def apply(self, local: Dict[str, List[str]], public_ip: Optional[str], provider: Optional[str]) -> NetworkState:
+        """Record the outcome of a lookup, telling on_change if the public ip changed
+
+        Args:
+            local (dict): The addresses of the interfaces, see local_addresses.
+            public_ip (str): The answer of the provider, None if none answered.
+            provider (str): The provider that answered.
+
+        Returns:
+            NetworkState: The new state.
+        """
+        with self._lock:
+            previous = self._state
+            if public_ip is None:
+                # Keep the last known one, it says when it was checked
+                state = previous._replace(local=local)
+            else:
+                changed = public_ip != previous.public_ip
+                state = NetworkState(local, public_ip, provider, time.time(),
+                                     time.time() if changed or previous.changed_at is None else previous.changed_at)
+            self._state = state
+        if public_ip is not None and public_ip != previous.public_ip:
+            self._save(state)
+            self.logger.info(f"Public ip is now {public_ip}, from {provider}")
+            if previous.public_ip is not None and self.on_change is not None:
+                try:
+                    self.on_change(previous.public_ip, public_ip)
+                except Exception as e:
+                    self.logger.error(f"Public ip change callback failed: {e}")
+        return state
+
+    def lookup_public_ip(self) -> Tuple[Optional[str], Optional[str]]:
+        """Ask the providers in order until one answers with an address
+
+        Returns:
+            tuple: (the public ip, the provider that answered), (None, None) if none did.
+        """
+        for provider in self.providers:
+            t_start = time.monotonic()
+            try:
+                if self.pooled:
+                    response = self.session.get(provider, timeout=self.timeout)
+                    response.raise_for_status()
+                    text = response.text
+                else:
+                    text = self.fetch(provider)
+                public_ip = str(ipaddress.ip_address(text.strip()))
+            except Exception as e:
+                LOOKUPS.labels(provider, 'error').observe(time.monotonic() - t_start)
+                self.logger.debug(f"Public ip lookup at {provider} failed: {e}")
+                continue
+            LOOKUPS.labels(provider, 'ok').observe(time.monotonic() - t_start)
+            return public_ip, provider
+        self.logger.warning(f"Could not get the public ip from any of {len(self.providers)} providers")
+        return None, None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            t_start = time.time()
+            try:
+                state = self.refresh()
+                answered = state.checked_at is not None and state.checked_at >= t_start
+            except Exception as e:
+                self.logger.error(f"Network identity refresh failed: {e}")
+                answered = False
+            self._wakeup.wait(self.ttl if answered else min(self.ttl, self.retry_interval))
+            self._wakeup.clear()
+
+    def _load(self) -> None:
+        try:
+            with open(self.state_file) as f:
+                saved = json.load(f)
+            public_ip = str(ipaddress.ip_address(saved['public_ip']))
+            self._state = NetworkState({}, public_ip, saved.get('provider'), None, saved.get('changed_at'))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            self.logger.error(f"Discarding unreadable network state: {e}")
+
+    def _save(self, state: NetworkState) -> None:
+        tmp_file = self.state_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'public_ip': state.public_ip, 'provider': state.provider,
+                           'changed_at': state.changed_at}, f)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            self.logger.error(f"Could not write the network state: {e}")
@@ -0,0 +1,203 @@
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+from bot.steps import Steps, Wait, drive
+from utils.metrics import REGISTRY
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+PROBES = REGISTRY.counter('suckerfish_probes', 'Liveness probes by method, none if offline', ('method',))
+PROBE_RTT = REGISTRY.histogram('suckerfish_probe_rtt_seconds', 'Round trip time of the answered probes', ('method',))
+
+
+class ProbeResult(NamedTuple):
+    """Outcome of a single liveness probe"""
+    online: bool
+    rtt: Optional[float]  # Round trip time in seconds, None if offline
+    method: str  # 'icmp', 'tcp:<port>' or 'none'
+
+
+def icmp_checksum(data: bytes) -> int:
+    """RFC 1071 internet checksum of the given bytes"""
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class HostProber:
+    """In-process liveness probe for a host.
+
+    Sends an ICMP echo request without forking ``ping``, using an unprivileged
+    ICMP datagram socket if the kernel allows it (``net.ipv4.ping_group_range``)
+    or a raw socket when running as root. If neither is available, or the host
+    does not answer the echo, it falls back to a TCP connect on the given ports,
+    where both an accepted and a refused connection mean the host is up.
+    """
+
+    def __init__(self,
+                 host_ip: str,
+                 timeout: float = 1.0,
+                 tcp_ports: Sequence[int] = (22,),
+                 use_icmp: bool = True):
+        """Initialize the prober
+
+        Args:
+            host_ip (str): The ip of the host to probe.
+            timeout (float, optional): Timeout of each probe in seconds. Defaults to 1.0.
+            tcp_ports (Sequence[int], optional): Ports tried when ICMP fails. Defaults to (22,).
+            use_icmp (bool, optional): Try ICMP before TCP. Defaults to True.
+        """
+        self.host_ip = host_ip
+        self.timeout = timeout
+        self.tcp_ports = tuple(tcp_ports)
+        self.use_icmp = use_icmp
+
+        self._icmp_id = os.getpid() & 0xffff
+        self._seq = 0
+
+    def probe(self, timeout: Optional[float] = None) -> ProbeResult:
+        """Probe the host once, ICMP first and then each TCP port"""
+        return drive(self._probe_steps(timeout))
+
+    def _probe_steps(self, timeout: Optional[float]) -> Steps:
+        timeout = self.timeout if timeout is None else timeout
+        result = ProbeResult(False, None, 'none')
+        if self.use_icmp:
+            rtt = yield self.probe_icmp(timeout)
+            if rtt is not None:
+                result = ProbeResult(True, rtt, 'icmp')
+
+        for port in self.tcp_ports:
+            if result.online:
+                break
+            rtt = yield self.probe_tcp(port, timeout)
+            if rtt is not None:
+                result = ProbeResult(True, rtt, f'tcp:{port}')
+
+        PROBES.labels(result.method).inc()
+        if result.online:
+            PROBE_RTT.labels(result.method).observe(result.rtt)
+        return result
+
+    def is_online(self, timeout: Optional[float] = None) -> bool:
+        """Return True if the host answers a probe"""
+        return self.probe(timeout).online
+
+    def wait_online(self,
+                    timeout: float,
+                    interval: float = 0.5,
+                    probe_timeout: Optional[float] = None,
+                    stop_event: Optional[threading.Event] = None) -> ProbeResult:
+        """Probe until the host answers or the timeout expires
+
+        Args:
+            timeout (float): Total time to wait in seconds.
+            interval (float, optional): Time between probe starts in seconds. Defaults to 0.5.
+            probe_timeout (float, optional): Per probe timeout. Defaults to the prober timeout.
+            stop_event (threading.Event, optional): Stop waiting early when set. Defaults to None.
+
+        Returns:
+            ProbeResult: The first successful probe, or the last failed one.
+        """
+        return drive(self._wait_online_steps(timeout, interval, probe_timeout, stop_event))
+
+    def _wait_online_steps(self, timeout: float, interval: float, probe_timeout: Optional[float],
+                           stop_event) -> Steps:
+        deadline = time.monotonic() + timeout
+        while True:
+            t_probe = time.monotonic()
+            result = yield self.probe(probe_timeout)
+            if result.online:
+                return result
+
+            now = time.monotonic()
+            if now >= deadline or (stop_event is not None and stop_event.is_set()):
+                return result
+            if (yield Wait(max(0.0, min(interval - (now - t_probe), deadline - now)), stop_event)):
+                return result
+
+    def open_icmp_socket(self):
+        """Open an ICMP socket, returns (socket, is_raw) or (None, False)"""
+        try:
+            return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+        except (PermissionError, OSError):
+            pass
+        try:
+            return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+        except (PermissionError, OSError):
+            return None, False
+
+    def echo_request(self) -> Tuple[int, bytes]:
+        """A new ICMP echo request, returns (its sequence number, the packet)"""
+        self._seq = (self._seq + 1) & 0xffff
+        seq = self._seq
+        payload = struct.pack('!d', time.monotonic()) + b'suckerfish'
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, self._icmp_id, seq)
+        checksum = icmp_checksum(header + payload)
+        return seq, struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, self._icmp_id, seq) + payload
+
+    def is_echo_reply(self, data: bytes, addr, seq: int, is_raw: bool) -> bool:
+        """Whether a received packet is the reply to the echo request seq"""
+        if addr[0] != self.host_ip:
+            return False
+        if is_raw:
+            # Raw sockets get the IP header too
+            data = data[(data[0] & 0x0f) * 4:]
+        if len(data) < 8:
+            return False
+        icmp_type, _, _, icmp_id, icmp_seq = struct.unpack('!BBHHH', data[:8])
+        # The kernel rewrites the id of datagram sockets, so only check it on raw ones
+        return icmp_type == ICMP_ECHO_REPLY and icmp_seq == seq and (not is_raw or icmp_id == self._icmp_id)
+
+    def probe_icmp(self, timeout: float) -> Optional[float]:
+        """Send one ICMP echo request, return the rtt or None if no reply"""
+        sock, is_raw = self.open_icmp_socket()
+        if sock is None:
+            return None
+
+        seq, packet = self.echo_request()
+        try:
+            t_sent = time.monotonic()
+            sock.sendto(packet, (self.host_ip, 0))
+            deadline = t_sent + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                ready, _, _ = select.select([sock], [], [], remaining)
+                if not ready:
+                    return None
+                data, addr = sock.recvfrom(1024)
+                if self.is_echo_reply(data, addr, seq, is_raw):
+                    return time.monotonic() - t_sent
+        except OSError:
+            return None
+        finally:
+            sock.close()
+
+    def probe_tcp(self, port: int, timeout: float, open_only: bool = False) -> Optional[float]:
+        """Try a TCP connection to the port, return the rtt or None if unreachable
+
+        A refused connection still tells the host is up, open_only also
+        returns None for it, when what matters is something listening.
+        """
+        t_start = time.monotonic()
+        try:
+            with socket.create_connection((self.host_ip, port), timeout=timeout):
+                pass
+        except ConnectionRefusedError:
+            # A RST means the host is up even if nothing listens on the port
+            if open_only:
+                return None
+        except OSError:
+            return None
+        return time.monotonic() - t_start
@@ -0,0 +1,125 @@
+import select
+import threading
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, Iterator, Optional, Tuple
+
+if TYPE_CHECKING:
+    import paramiko
+
+STDOUT = 'stdout'
+STDERR = 'stderr'
+
+
+class RemoteCommand:
+    """A command running in an ssh channel, read line by line while it runs.
+
+    stdout and stderr are drained together as data arrives, so a chatty
+    stream can never fill its window and stall the other one. Only the last
+    max_lines of each stream are kept and overlong lines are cut, so memory
+    stays bounded whatever the command prints.
+    """
+
+    def __init__(self,
+                 channel: 'paramiko.Channel',
+                 command: str,
+                 stdin: Optional[str] = None,
+                 max_lines: int = 100,
+                 max_line_length: int = 1000,
+                 chunk_size: int = 32768):
+        """Start the command
+
+        Args:
+            channel (paramiko.Channel): A new session channel.
+            command (str): The command line to execute.
+            stdin (str, optional): Text written to the command's stdin. Defaults to None.
+            max_lines (int, optional): Lines kept of each stream. Defaults to 100.
+            max_line_length (int, optional): Characters kept of each line. Defaults to 1000.
+            chunk_size (int, optional): Bytes read at a time. Defaults to 32768.
+        """
+        self.channel = channel
+        self.command = command
+        self.max_line_length = max_line_length
+        self.chunk_size = chunk_size
+
+        self.stdout: Deque[str] = deque(maxlen=max_lines)
+        self.stderr: Deque[str] = deque(maxlen=max_lines)
+        self.lines_read = 0
+        self._partial: Dict[str, bytes] = {STDOUT: b'', STDERR: b''}
+        self._exit_status: Optional[int] = None
+        self._cancel = threading.Event()
+
+        channel.exec_command(command)
+        if stdin:
+            channel.sendall(stdin.encode())
+
+    @property
+    def exit_status(self) -> Optional[int]:
+        """Exit status once the command has finished, None before"""
+        return self._exit_status
+
+    def cancel(self) -> None:
+        """Stop reading and close the channel, the remote command gets a SIGHUP"""
+        self._cancel.set()
+
+    def _split(self, stream: str, data: bytes) -> Iterator[str]:
+        """Complete lines of a stream after appending data"""
+        buffer = self._partial[stream] + data
+        *lines, rest = buffer.split(b'\n')
+        # Flush an overlong line cut short, so the partial buffer stays bounded
+        if len(rest) > self.max_line_length:
+            lines.append(rest)
+            rest = b''
+        self._partial[stream] = rest
+        for line in lines:
+            yield line[:self.max_line_length].decode(errors='replace').rstrip('\r')
+
+    def _keep(self, stream: str, line: str) -> Tuple[str, str]:
+        (self.stdout if stream == STDOUT else self.stderr).append(line)
+        self.lines_read += 1
+        return stream, line
+
+    def lines(self, poll_interval: float = 0.1) -> Iterator[Tuple[str, str]]:
+        """Yield (stream, line) as the command prints them, until it exits or is cancelled"""
+        channel = self.channel
+        try:
+            while not self._cancel.is_set():
+                read = False
+                if channel.recv_ready():
+                    read = True
+                    for line in self._split(STDOUT, channel.recv(self.chunk_size)):
+                        yield self._keep(STDOUT, line)
+                if channel.recv_stderr_ready():
+                    read = True
+                    for line in self._split(STDERR, channel.recv_stderr(self.chunk_size)):
+                        yield self._keep(STDERR, line)
+                if read:
+                    continue
+                if channel.exit_status_ready() and not channel.recv_ready() \
+                        and not channel.recv_stderr_ready():
+                    break
+                if channel.eof_received:
+                    # Nothing else can arrive, only the exit status is missing
+                    channel.status_event.wait(poll_interval)
+                else:
+                    # Wakes up on stdout data, stderr is picked up on the next poll
+                    select.select([channel], [], [], poll_interval)
+
+            if self._cancel.is_set():
+                return
+            for stream in (STDOUT, STDERR):
+                if self._partial[stream]:
+                    line = self._partial[stream][:self.max_line_length].decode(errors='replace')
+                    self._partial[stream] = b''
+                    yield self._keep(stream, line)
+            self._exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        return self.lines()
+
+    def wait(self) -> Optional[int]:
+        """Read the command to the end, returns its exit status (None if cancelled)"""
+        for _ in self.lines():
+            pass
+        return self._exit_status
@@ -0,0 +1,249 @@
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from utils.metrics import REGISTRY
+
+if TYPE_CHECKING:
+    import paramiko
+
+# paramiko takes seconds to import on a Pi Zero, so it is only imported on
+# the first connection and private keys are loaded once per file
+_keys: Dict[str, 'paramiko.PKey'] = {}
+_keys_lock = threading.Lock()
+
+SSH_CONNECT = REGISTRY.histogram('suckerfish_ssh_connect_seconds', 'SSH connect and authentication time')
+SSH_CONNECT_FAILURES = REGISTRY.counter('suckerfish_ssh_connect_failures', 'SSH connections that failed')
+SSH_REUSED = REGISTRY.counter('suckerfish_ssh_reused', 'Commands run over an already open transport')
+SSH_HANDSHAKE_SAVED = REGISTRY.counter('suckerfish_ssh_handshake_saved_seconds',
+                                       'Handshake time saved by reusing the transport, the mean handshake per command',
+                                       ('host',))
+
+
+def load_private_key(key_file: str) -> 'paramiko.PKey':
+    """Load an RSA private key, cached by file name"""
+    with _keys_lock:
+        if key_file not in _keys:
+            import paramiko
+            _keys[key_file] = paramiko.RSAKey.from_private_key_file(key_file)
+        return _keys[key_file]
+
+
+class PooledSSHConnection:
+    """A persistent, authenticated SSH transport to one host.
+
+    Every command is opened as a new channel over the same transport, so the
+    key exchange and authentication are only paid once. The transport sends
+    keepalives and is health checked before use, and is transparently rebuilt
+    when the host has gone away (e.g. after a reboot).
+    """
+
+    def __init__(self,
+                 host_ip: str,
+                 username: str,
+                 password: Optional[str] = None,
+                 pkey: Optional['paramiko.PKey'] = None,
+                 key_file: Optional[str] = None,
+                 port: int = 22,
+                 timeout: float = 5,
+                 keepalive: int = 15,
+                 logger=None):
+        """Initialize the connection, the transport is opened on first use
+
+        Args:
+            host_ip (str): The ip of the host.
+            username (str): The user to log in as.
+            password (str, optional): Password for the user. Defaults to None.
+            pkey (paramiko.PKey, optional): Private key for the user. Defaults to None.
+            key_file (str, optional): Private key file loaded on first use if pkey is None. Defaults to None.
+            port (int, optional): The ssh port. Defaults to 22.
+            timeout (float, optional): Connection timeout in seconds. Defaults to 5.
+            keepalive (int, optional): Seconds between keepalive packets, 0 to disable. Defaults to 15.
+        """
+        self.host_ip = host_ip
+        self.username = username
+        self.password = password
+        self.pkey = pkey
+        self.key_file = key_file
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._client: Optional['paramiko.SSHClient'] = None
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.handshakes = 0
+        self.handshake_time = 0.0
+        self.commands = 0
+        self.reused = 0
+
+    @property
+    def mean_handshake_time(self) -> float:
+        """Average seconds spent connecting and authenticating"""
+        return self.handshake_time / self.handshakes if self.handshakes else 0.0
+
+    @property
+    def handshake_time_saved(self) -> float:
+        """Estimated seconds saved by reusing the transport instead of reconnecting"""
+        return self.reused * self.mean_handshake_time
+
+    def load_key(self) -> Optional['paramiko.PKey']:
+        """Load the private key if it was given as a file"""
+        if self.pkey is None and self.key_file is not None:
+            self.pkey = load_private_key(self.key_file)
+        return self.pkey
+
+    def _is_healthy(self) -> bool:
+        """Check the transport is up and still answers"""
+        if self._client is None:
+            return False
+        import paramiko
+        transport = self._client.get_transport()
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            # Fails fast if the socket has been closed by the other end
+            transport.send_ignore()
+        except (paramiko.SSHException, EOFError, OSError):
+            return False
+        return True
+
+    def _connect(self) -> 'paramiko.SSHClient':
+        """Open and authenticate a new transport, must hold the lock"""
+        import paramiko
+        self._close()
+        self.load_key()
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+        t_start = time.monotonic()
+        try:
+            client.connect(hostname=self.host_ip,
+                           port=self.port,
+                           username=self.username,
+                           password=self.password,
+                           pkey=self.pkey,
+                           timeout=self.timeout,
+                           banner_timeout=self.timeout,
+                           auth_timeout=self.timeout)
+        except Exception:
+            SSH_CONNECT_FAILURES.inc()
+            raise
+        elapsed = time.monotonic() - t_start
+        SSH_CONNECT.observe(elapsed)
+
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
+
+        self.handshakes += 1
+        self.handshake_time += elapsed
+        self.logger.debug(f"SSH handshake with {self.host_ip} took {elapsed * 1000:.0f} ms")
+
+        self._client = client
+        return client
+
+    def _close(self) -> None:
+        """Close the current transport if any, must hold the lock"""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def get_client(self) -> 'paramiko.SSHClient':
+        """Return a healthy client, reconnecting if needed"""
+        with self._lock:
+            if self._is_healthy():
+                self.reused += 1
+                SSH_REUSED.inc()
+                SSH_HANDSHAKE_SAVED.labels(self.host_ip).inc(self.mean_handshake_time)
+                return self._client
+            return self._connect()
+
+    def ensure_connected(self) -> bool:
+        """Make sure the transport is up, returns False if the host can't be reached"""
+        try:
+            with self._lock:
+                if not self._is_healthy():
+                    self._connect()
+            return True
+        except Exception as e:
+            self.logger.error(f"SSH connection failed: {e}")
+            return False
+
+    def open_session(self, timeout: Optional[float] = None) -> 'paramiko.Channel':
+        """Open a new session channel over the pooled transport
+
+        If the channel can't be opened on a stale transport, the transport is
+        rebuilt and the channel opened again once.
+        """
+        import paramiko
+        for attempt in range(2):
+            client = self.get_client()
+            try:
+                channel = client.get_transport().open_session(timeout=timeout)
+                self.commands += 1
+                return channel
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                if attempt:
+                    raise
+                self.logger.warning(f"SSH transport to {self.host_ip} went stale ({e}), reconnecting")
+                with self._lock:
+                    self._close()
+
+    def close(self) -> None:
+        """Close the transport"""
+        with self._lock:
+            self._close()
+
+
+class SSHPool:
+    """Keeps one pooled connection per host and user"""
+
+    def __init__(self, timeout: float = 5, keepalive: int = 15, logger=None):
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.logger = logger
+        self._connections: Dict[Tuple[str, int, str], PooledSSHConnection] = {}
+        self._lock = threading.Lock()
+
+    def connection(self,
+                   host_ip: str,
+                   username: str,
+                   password: Optional[str] = None,
+                   pkey: Optional['paramiko.PKey'] = None,
+                   key_file: Optional[str] = None,
+                   port: int = 22) -> PooledSSHConnection:
+        """Get the pooled connection for a host, creating it if needed"""
+        key = (host_ip, port, username)
+        with self._lock:
+            if key not in self._connections:
+                self._connections[key] = PooledSSHConnection(host_ip,
+                                                             username,
+                                                             password=password,
+                                                             pkey=pkey,
+                                                             key_file=key_file,
+                                                             port=port,
+                                                             timeout=self.timeout,
+                                                             keepalive=self.keepalive,
+                                                             logger=self.logger)
+            return self._connections[key]
+
+    def discard(self, connection: PooledSSHConnection) -> None:
+        """Close a connection and drop it from the pool, e.g. when its host is reconfigured
+
+        The next connection to the host is made with the credentials it is then given.
+        """
+        with self._lock:
+            key = (connection.host_ip, connection.port, connection.username)
+            if self._connections.get(key) is connection:
+                del self._connections[key]
+        connection.close()
+
+    def close_all(self) -> None:
+        """Close every pooled transport"""
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
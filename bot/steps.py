@@ -0,0 +1,77 @@
+import asyncio
+import inspect
+import threading
+import time
+from concurrent.futures import Future
+from typing import Generator, NamedTuple, Optional, Union
+
+# Code shared by the threads runtime and the asyncio one is written once, as
+# generators yielding what they wait for: a blocking call has already returned
+# its value, a coroutine or an asyncio future is awaited by drive_async, a
+# concurrent future is waited for by drive, and a Wait sleeps. The outcome is
+# sent back into the generator, or raised in it, and its return value is the
+# one of the driver.
+Steps = Generator[object, object, object]
+
+
+class Wait(NamedTuple):
+    """Sleep for timeout seconds, or less if event is set. The driver sends back whether it was"""
+    timeout: float
+    event: Optional[Union[threading.Event, asyncio.Event]] = None
+
+
+async def wait_event(event: Optional[asyncio.Event], timeout: float) -> bool:
+    """Sleep until the event is set or the timeout expires, returns True if it was set"""
+    if event is None:
+        await asyncio.sleep(timeout)
+        return False
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return event.is_set()
+
+
+def drive(steps: Steps):
+    """Run steps on the calling thread, returns what they return"""
+    value, error = None, None
+    while True:
+        try:
+            awaited = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+        value, error = None, None
+        try:
+            if isinstance(awaited, Wait):
+                if awaited.event is None:
+                    time.sleep(awaited.timeout)
+                    value = False
+                else:
+                    value = awaited.event.wait(awaited.timeout)
+            elif isinstance(awaited, Future):
+                value = awaited.result()
+            else:
+                value = awaited
+        except Exception as e:
+            error = e
+
+
+async def drive_async(steps: Steps):
+    """Run steps on the event loop, returns what they return"""
+    value, error = None, None
+    while True:
+        try:
+            awaited = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+        value, error = None, None
+        try:
+            if isinstance(awaited, Wait):
+                value = await wait_event(awaited.event, awaited.timeout)
+            elif inspect.isawaitable(awaited):
+                value = await awaited
+            else:
+                value = awaited
+        except (Exception, asyncio.CancelledError) as e:
+            # The steps get to clean up when their task is cancelled
+            error = e
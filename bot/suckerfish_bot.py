@@ -1,78 +1,190 @@
 #!/usr/bin/python3
 
+import functools
 import logging
-import socket
-import subprocess
+import os
+import secrets
+import shlex
+import threading
 import time
-from typing import List
+import warnings
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple
 
-import paramiko
-from gpiozero import LED
-from requests import get
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Message, Update
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
                           CommandHandler, Updater)
 
-
-def only_allowed_chats(func):
-    """Decorator for callbacks which are only allowed to a specific user list"""
-    def wrapped(self, update: Update, context: CallbackContext):
-        if self.allowed_chats is None:
-            return func(self, update, context)
-        elif str(update.message.chat_id) in self.allowed_chats:
-            return func(self, update, context)
-        else:
-            self.logger.info(f"User {update.message.chat_id} tried to access a restricted command")
-            update.message.reply_text('Only owner allowed')
+from bot.acl import ChatACL
+from bot.fleet import Fleet, host_changes
+from bot.handlers import BotHandlers
+from bot.host import Host
+from bot.host_monitor import HostState
+from bot.lanes import BUSY_TEXT, INSTANT, IO, LONG, LOW_MEMORY_LANES, make_lanes
+from bot.network_identity import NetworkIdentity
+from bot.remote_exec import RemoteCommand
+from bot.ssh_pool import SSHPool
+from bot.steps import Steps, drive
+from utils.chat_sender import LiveMessage
+from utils.metrics import REGISTRY, MetricsServer
+from utils.profiling import CPUProfiler, MemoryProfiler, handler_codes
+
+if TYPE_CHECKING:
+    from bot.webhook import WebhookServer
+
+HANDLER_SECONDS = REGISTRY.histogram('suckerfish_handler_seconds', 'Time spent in each handler', ('handler',))
+HANDLER_ERRORS = REGISTRY.counter('suckerfish_handler_errors', 'Handlers that raised an exception', ('handler',))
+
+# Lane of each handler, the ones not listed run in the IO lane
+HANDLER_LANES = {
+    'send_user_chat_id': INSTANT,
+    'force_shutdown': INSTANT,
+    'check_force_shutdown': INSTANT,
+    'press_power_switch': INSTANT,
+    'press_reset_switch': INSTANT,
+    'cancel_boot': INSTANT,
+    'send_stats': INSTANT,
+    'send_telemetry': INSTANT,
+    'current_ip': INSTANT,
+    # May fingerprint the OS of the host, waiting up to probe.fingerprint_timeout
+    'check_host_online': IO,
+    'power_on': IO,
+    'select_os': IO,
+    'run_command': IO,
+    'next_boot': IO,
+}
+
+
+def timed_handler(callback):
+    """Wrap a handler callback to record its latency and errors"""
+    latency = HANDLER_SECONDS.labels(callback.__name__)
+    errors = HANDLER_ERRORS.labels(callback.__name__)
+
+    @functools.wraps(callback)
+    def wrapped(update: Update, context: CallbackContext):
+        t_start = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - t_start)
     return wrapped
 
-class SuckerfishBot:
-    """ Telegram bot class with the methods to turn on and off the pc"""
+
+def driven(handler):
+    """Wrap a handler of BotHandlers into a dispatcher callback running it to completion"""
+    @functools.wraps(handler)
+    def callback(update: Update, context: CallbackContext):
+        # Buttons have no arguments
+        return drive(handler(update, context.args or []))
+    return callback
+
+
+class SuckerfishBot(BotHandlers):
+    """ Telegram bot class with the methods to turn on and off the pcs"""
 
     def __init__(self,
                  bot_token: str,
-                 host_ip: str,
-                 host_username: str,
-                 host_password: str,
-                 power_pin: int = 21,
-                 reset_pin: int = 20,
-                 windows_entry_id: int = 1,  # Second after ubuntu
+                 hosts: List[dict],
                  allowed_chats: List[str] = None,
-                 logger = None,):
+                 logger = None,
+                 state_dir: str = '.',
+                 notify_host_changes: bool = True,
+                 lazy_init: bool = False,
+                 base_url: Optional[str] = None,
+                 metrics: Optional[dict] = None,
+                 run_commands: Optional[Dict[str, str]] = None,
+                 lanes: Optional[Dict[str, dict]] = None,
+                 network: Optional[dict] = None,
+                 low_memory: bool = False):
         """Initialize the bot
 
         Args:
-            config_file (str, optional): The config file to use. Defaults to 'config.yaml'
+            bot_token (str): The telegram bot token.
+            hosts (List[dict]): Keyword arguments of each bot.host.Host, as given by get_config.
+            allowed_chats (List[str], optional): Chats allowed to use the switches, every chat if None.
+                Defaults to None.
+            logger (DevChatLogger, optional): Logger also reporting to the dev chat. Defaults to None.
+            state_dir (str, optional): Folder for the files kept between restarts. Defaults to '.'.
+            notify_host_changes (bool, optional): Message the allowed chats when a host goes
+                online or offline. Defaults to True.
+            lazy_init (bool, optional): Claim the GPIO pins and load the ssh keys in a
+                background thread after start(), or on first use, instead of now. Defaults to False.
+            base_url (str, optional): Bot API server url, e.g. a self-hosted one. Defaults to Telegram's.
+            metrics (dict, optional): listen and port of the Prometheus endpoint, none if None.
+                Defaults to None.
+            run_commands (Dict[str, str], optional): Commands allowed in /run by name,
+                run with sudo on the host. Defaults to None.
+            lanes (Dict[str, dict], optional): workers and queue of the instant, io and long
+                lanes the handlers run in. Defaults to bot.lanes.DEFAULT_LANES.
+            network (dict, optional): providers, ttl, timeout and notify of the public ip
+                lookups of /current_ip. Defaults to bot.network_identity's defaults.
+            low_memory (bool, optional): Run the dispatcher without worker threads, the lanes with
+                one worker unless lanes says otherwise and the connection pool sized for them, and
+                look up the public ip without requests. Defaults to False.
         """
 
         # Load the config
         self.bot_token = bot_token
-        self.allowed_chats = allowed_chats
+        self.base_url = base_url
+        self.acl = ChatACL(allowed_chats)
+        self.notify_host_changes = notify_host_changes
+        self.lazy_init = lazy_init
+        self.run_commands = dict(run_commands or {})
 
-        # Pin wiring por the switches
-        self.power_pin = power_pin
-        self.reset_pin = reset_pin
+        # Running /run commands by host name, None while they start
+        self.runs: Dict[str, Optional[RemoteCommand]] = {}
+        self._runs_lock = threading.Lock()
+
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
 
-        # host pc data
-        self.host_ip = host_ip
-        self.host_username = host_username
-        self.host_password = host_password
-        self.windows_entry_id = windows_entry_id
+        # The dispatcher only routes the updates, the handlers run in their lane
+        self.lanes = make_lanes(lanes, logger=self.logger, defaults=LOW_MEMORY_LANES if low_memory else None)
 
         # Make sure to set use_context=True to use the new context based callbacks
-        self.updater = Updater(self.bot_token, use_context=True)
+        if low_memory:
+            # Its workers only serve run_async handlers, there are none
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', message='Asynchronous callbacks')
+                # getUpdates, the lane workers and the dev chat logger
+                pool_size = 2 + sum(lane.workers for lane in self.lanes.values())
+                self.updater = Updater(self.bot_token, base_url=base_url, use_context=True, workers=0,
+                                       request_kwargs={'con_pool_size': pool_size})
+        else:
+            self.updater = Updater(self.bot_token, base_url=base_url, use_context=True)
 
         # Get the dispatcher to register handlers
         self.dp = self.updater.dispatcher
 
-        # SSH client
-        self.ssh_client = paramiko.SSHClient()
-        self.key = paramiko.RSAKey.from_private_key_file('/home/pi/.ssh/id_rsa')
-        self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        # Define the power and reset pins
-        self.power_switch = LED(self.power_pin)
-        self.reset_switch = LED(self.reset_pin)
+        # The hosts share one ssh pool, everything else is per host
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self.ssh_pool = SSHPool(logger=self.logger)
+        self.fleet = Fleet([self.make_host(host_config) for host_config in hosts])
+        if not self.lazy_init:
+            self.warm_up()
+
+        # Config of the running hosts and of the configured ones, they differ while a host is busy
+        self.host_configs = {host_config['name']: host_config for host_config in hosts}
+        self._wanted_hosts = dict(self.host_configs)
+        self._hosts_lock = threading.Lock()
+        self._hosts_retry: Optional[threading.Timer] = None
+
+        # Local and public ips of the bot, refreshed in the background for /current_ip
+        network = dict(network or {})
+        self.notify_ip_changes = network.pop('notify', True)
+        if low_memory:
+            # A lookup every ttl does not need requests and its pool
+            network.setdefault('pooled', False)
+        self.network = NetworkIdentity(os.path.join(state_dir, 'network.json'),
+                                       on_change=self.notify_public_ip,
+                                       logger=self.logger,
+                                       **network)
 
         # on different commands - answer in Telegram
         self.dp.add_handler(CommandHandler("current_ip", self.current_ip))
@@ -88,88 +200,250 @@ class SuckerfishBot:
 
         self.dp.add_handler(CommandHandler("power_on", self.power_on))
         self.dp.add_handler(CallbackQueryHandler(self.select_os, pattern="power_on_"))
-
-        if logger is None:
-            self.logger = logging.getLogger(__name__)
-        else:
-            self.logger = logger
+        self.dp.add_handler(CommandHandler("cancel", self.cancel_boot))
+        self.dp.add_handler(CommandHandler("run", self.run_command))
+        self.dp.add_handler(CommandHandler("next_boot", self.next_boot))
+        self.dp.add_handler(CommandHandler("telemetry", self.send_telemetry))
+
+        # developer commands
+        self.dp.add_handler(CommandHandler("stats", self.send_stats))
+        self.dp.add_handler(CommandHandler("profile", self.profile))
+        self.dp.add_handler(CommandHandler("memprofile", self.memprofile))
+
+        # Idle until /profile and /memprofile, nothing wraps the handlers
+        callbacks = [handler.callback for handlers in self.dp.handlers.values() for handler in handlers]
+        self.cpu_profiler = CPUProfiler(handlers=handler_codes(callbacks), logger=self.logger)
+        self.memory_profiler = MemoryProfiler()
+
+        self.drive_handlers()
+        self.instrument_handlers()
+        self.assign_lanes()
+
+        if logger is not None:
             self.dp.add_error_handler(self.logger.error_handler)
 
-    def connect_ssh(self, timeout=5) -> bool:
-        """Connect to the ssh server"""
+        self.webhook: Optional['WebhookServer'] = None
+        self.metrics_config = metrics
+        self.metrics_server: Optional[MetricsServer] = None
+
+    def make_host(self, host_config: dict) -> Host:
+        """A host of the fleet from its config"""
+        return Host(ssh_pool=self.ssh_pool,
+                    telegram_bot=self.updater.bot,
+                    state_dir=self.state_dir,
+                    on_change=self.notify_host_state,
+                    logger=self.logger,
+                    **host_config)
+
+    def reload_config(self, bot_config: dict) -> None:
+        """Apply a config from get_config while running, the parts that need no restart
+
+        The ACL, the notifications, the /run commands and the public ip lookups
+        are swapped at once. Changed hosts are replaced and removed ones
+        stopped, but a host running an action keeps its config until it is
+        done, so nothing in flight is dropped.
+        """
+        acl = ChatACL(bot_config['allowed_chats'])
+        if acl != self.acl:
+            self.logger.info(f"Allowed chats are now {acl}")
+        self.acl = acl
+        self.notify_host_changes = bot_config['notify_host_changes']
+        self.run_commands = dict(bot_config['run_commands'])
+        network = dict(bot_config['network'])
+        self.notify_ip_changes = network.pop('notify', True)
+        self.network.configure(**network)
+
+        with self._hosts_lock:
+            self._wanted_hosts = {host_config['name']: host_config for host_config in bot_config['hosts']}
+        self.apply_hosts()
+
+    def host_busy(self, host: Host) -> bool:
+        """Whether the host runs something a reconfiguration would cut short"""
+        return host.actions.current is not None or host.boot.busy or host.name in self.runs
+
+    def apply_hosts(self) -> None:
+        """Retire and start hosts to match the configured ones, retried later while some are busy"""
+        with self._hosts_lock:
+            if self._hosts_retry is not None:
+                self._hosts_retry.cancel()
+                self._hosts_retry = None
+            changes = host_changes(self.host_configs, self._wanted_hosts,
+                                   [host.name for host in self.fleet if self.host_busy(host)])
+            for name in changes.retire:
+                host = self.fleet.get(name)
+                # Gone from the commands before its pins are released
+                if name not in self._wanted_hosts:
+                    self.fleet.remove(name)
+                host.stop()
+                host.release_pins()
+                self.ssh_pool.discard(host.ssh)
+                del self.host_configs[name]
+                self.logger.info(f"{name} {'reconfigured' if name in self._wanted_hosts else 'removed'}")
+            for host_config in changes.create:
+                host = self.make_host(host_config)
+                self.fleet.put(host)
+                self.host_configs[host.name] = host_config
+                if not self.lazy_init:
+                    try:
+                        host.warm_up()
+                    except Exception as e:
+                        # Retried on first use, where the error reaches the user
+                        self.logger.error(f"Could not initialize {host.name}: {e}")
+                host.start()
+            if changes.deferred:
+                self.logger.info(f"{', '.join(changes.deferred)} will be reconfigured once idle")
+                self._hosts_retry = threading.Timer(5, self.apply_hosts)
+                self._hosts_retry.daemon = True
+                self._hosts_retry.start()
+
+    def drive_handlers(self) -> None:
+        """Run every registered handler, steps shared with the asyncio runtime, as a dispatcher callback"""
+        for handlers in self.dp.handlers.values():
+            for handler in handlers:
+                handler.callback = driven(handler.callback)
+
+    def instrument_handlers(self) -> None:
+        """Record the latency of every registered handler"""
+        for handlers in self.dp.handlers.values():
+            for handler in handlers:
+                handler.callback = timed_handler(handler.callback)
+
+    def assign_lanes(self) -> None:
+        """Run every registered handler in its lane instead of the dispatcher thread"""
+        for handlers in self.dp.handlers.values():
+            for handler in handlers:
+                handler.callback = self.in_lane(HANDLER_LANES.get(handler.callback.__name__, IO),
+                                                handler.callback)
+
+    def in_lane(self, lane_name: str, callback):
+        """Wrap a handler callback to be submitted to a lane, answering busy if it is full"""
+        def run(update: Update, context: CallbackContext):
+            try:
+                callback(update, context)
+            except Exception as e:
+                # Errors no longer reach the dispatcher on their own
+                self.dp.dispatch_error(update, e)
+
+        @functools.wraps(callback)
+        def wrapped(update: Update, context: CallbackContext):
+            if self.lanes[lane_name].submit(run, update, context) is None:
+                self.logger.warning(f"Lane {lane_name} is full, refused {callback.__name__}")
+                self.reply_busy(update)
+        return wrapped
+
+    def reply_busy(self, update: Update) -> None:
+        """Tell the user a command was refused"""
         try:
-            self.ssh_client.connect(self.host_ip,
-                                    username=self.host_username,
-                                    timeout=timeout,
-                                    pkey=self.key)
-            return True
+            if update.callback_query is not None:
+                update.callback_query.answer(text=BUSY_TEXT)
+            elif update.effective_message is not None:
+                update.effective_message.reply_text(BUSY_TEXT)
         except Exception as e:
-            self.logger.error(f"SSH connection failed: {e}")
-            return False
-
-    def run_sudo_command(self, command="ls",
-                         jobid="None"):
-        """Executes a sudo command over a established SSH connectiom.
+            self.logger.warning(f"Could not send the busy reply: {e}")
+
+    def notify_host_state(self, host: Host, state: HostState) -> None:
+        """Tell the allowed chats a host went online or offline"""
+        acl = self.acl
+        if not self.notify_host_changes or not acl:
+            return
+        text = f"{self.host_label(host)} is now {'online' if state.online else 'offline'}"
+        for chat_id in acl:
+            try:
+                self.updater.bot.send_message(chat_id=chat_id, text=text)
+            except Exception as e:
+                self.logger.warning(f"Could not notify chat {chat_id}: {e}")
+
+    def notify_public_ip(self, old: Optional[str], new: str) -> None:
+        """Tell the allowed chats the public ip of the bot changed"""
+        acl = self.acl
+        if not self.notify_ip_changes or not acl:
+            return
+        for chat_id in acl:
+            try:
+                self.updater.bot.send_message(chat_id=chat_id, text=f"Public ip changed from {old} to {new}")
+            except Exception as e:
+                self.logger.warning(f"Could not notify chat {chat_id}: {e}")
+
+    def start(self, webhook: Optional[dict] = None):
+        """Start the bot.
 
         Args:
-            command (str, optional): The command to execute. Defaults to 'ls'.
-            jobid (str, optional): The job id to use. Defaults to 'None'.
-
-        Returns:
-            tuple: (bool, stderr): (True if the command was executed, the stderr)
+            webhook (dict, optional): The webhook config, polls for updates if None. Defaults to None.
         """
-
-        root_ssh_client = paramiko.SSHClient()
-        root_ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        try:
-            root_ssh_client.connect(hostname=self.host_ip,
-                                    username=self.host_username,
-                                    password=self.host_password,
-                                    timeout=5,
-                                    pkey=self.key)
-        except Exception as e:
-            self.logger.error(f"SSH connection failed: {e}")
-            return False
-
-        command = "sudo -S -p '' %s" % command
-        self.logger.info("Job[%s]: Executing: %s" % (jobid, command))
-        stdin, stdout, stderr = root_ssh_client.exec_command(command=command)
-        stdin.write(self.host_password + "\n")
-        stdin.flush()
-        stdoutput = [line for line in stdout]
-        stderroutput = [line for line in stderr]
-        for output in stdoutput:
-            self.logger.info("Job[%s]: %s" % (jobid, output.strip()))
-        # Check exit code.
-        self.logger.debug("Job[%s]:stdout: %s" % (jobid, stdoutput))
-        self.logger.debug("Job[%s]:stderror: %s" % (jobid, stderroutput))
-        self.logger.info("Job[%s]:Command status: %s" % (jobid, stdout.channel.recv_exit_status()))
-        if not stdout.channel.recv_exit_status():
-            self.logger.info("Job[%s]: Command executed." % jobid)
-            root_ssh_client.close()
-            if not stdoutput:
-                stdoutput = True
-            return True, stdoutput
+        if webhook is None:
+            self.updater.start_polling()
         else:
-            self.logger.error("Job[%s]: Command failed." % jobid)
-            for output in stderroutput:
-                self.logger.error("Job[%s]: %s" % (jobid, output))
-            root_ssh_client.close()
-            return False, stderroutput
-
-    def is_host_online(self) -> bool:
-        """Check if the host pc is online"""
-        # TODO make it work for both windows and linux
-        try:
-            subprocess.check_output(["ping", "-c", "1", self.host_ip])
-        except:
-            return False
-        return True
+            self.start_webhook(**webhook)
+
+        if self.metrics_config is not None:
+            self.metrics_server = MetricsServer(REGISTRY, logger=self.logger, **self.metrics_config)
+            self.metrics_server.start()
+
+        # Already answering, load the slow subsystems in the background
+        if self.lazy_init:
+            threading.Thread(target=self.warm_up, name='warm_up', daemon=True).start()
+
+        # Start the monitors and pick up boots interrupted by a restart
+        self.fleet.start()
+        self.network.start()
+
+    def dev_chat_client(self, token: str) -> Bot:
+        """A client for DevChatLogger.use_client on the connection pool of the bot, the bot itself for its token"""
+        if token == self.bot_token:
+            return self.updater.bot
+        return Bot(token, base_url=self.base_url, request=self.updater.bot.request)
+
+    def warm_up(self):
+        """Claim the GPIO pins and load the ssh keys of every host"""
+        t_start = time.monotonic()
+        for host in self.fleet:
+            try:
+                host.warm_up()
+            except Exception as e:
+                if not self.lazy_init:
+                    raise
+                # Retried on first use, where the error reaches the user
+                self.logger.error(f"Could not initialize {host.name}: {e}")
+        self.logger.info(f"Hosts initialized in {time.monotonic() - t_start:.2f} s")
+
+    def start_webhook(self,
+                      url: str,
+                      listen: str = '127.0.0.1',
+                      port: int = 8443,
+                      secret: str = '',
+                      cert: Optional[str] = None,
+                      key: Optional[str] = None):
+        """Receive the updates through a webhook instead of polling
 
-    def start(self):
-        """Start the bot."""
-        self.updater.start_polling()
+        Args:
+            url (str): Public url Telegram posts to, without the secret path.
+            listen (str, optional): Address to bind. Defaults to '127.0.0.1'.
+            port (int, optional): Port to bind. Defaults to 8443.
+            secret (str, optional): Secret path appended to the url. Defaults to a random one for this run.
+            cert (str, optional): TLS certificate, also uploaded to Telegram. Defaults to None.
+            key (str, optional): TLS private key. Defaults to None.
+        """
+        if not secret.strip('/'):
+            # Anyone could post updates to a webhook without one, it is set again at every start anyway
+            secret = secrets.token_urlsafe(32)
+            self.logger.warning("No webhook secret in the config, using a random one until the bot restarts")
+        # Only loaded for the webhook, with its http server
+        from bot.webhook import WebhookServer
+        self.webhook = WebhookServer(self.dp, listen, port, secret, cert, key, logger=self.logger)
+
+        # Run the dispatcher like start_polling does, marking the updater as
+        # running so idle() stops it on a signal
+        threading.Thread(target=self.dp.start, name='dispatcher', daemon=True).start()
+        self.updater.running = True
+        self.webhook.start()
+
+        webhook_url = f"{url.rstrip('/')}/{secret.strip('/')}"
+        if cert is not None:
+            with open(cert, 'rb') as certificate:
+                self.updater.bot.set_webhook(webhook_url, certificate=certificate)
+        else:
+            self.updater.bot.set_webhook(webhook_url)
+        self.logger.info(f"Listening for updates on {listen}:{self.webhook.port}")
 
     def idle(self):
         """
@@ -178,201 +452,78 @@ class SuckerfishBot:
         start_polling() is non-blocking and will stop the bot gracefully.
         """
         self.updater.idle()
+        if self.webhook is not None:
+            self.webhook.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        for lane in self.lanes.values():
+            lane.shutdown()
+        self.network.stop()
+        with self._hosts_lock:
+            if self._hosts_retry is not None:
+                self._hosts_retry.cancel()
+        self.fleet.stop()
+        self.ssh_pool.close_all()
 
     def echo(self, update: Update, context: CallbackContext):
         """Echo the user message. Use to test if the bot is running"""
         update.message.reply_text(update.message.text)
 
-    def send_user_chat_id(self, update: Update, context: CallbackContext) -> int:
-        """Send the chat id of the user asking for it"""
-        update.message.reply_text(f"Your chat id is {update.message.chat_id}")
-
-    def current_ip(self, update: Update, context: CallbackContext):
-        """Send the current local and public ips of the pizero machine"""
-        pub_ip = get('https://api.ipify.org').text
-        local_ip = socket.gethostbyname(socket.getfqdn())
-        message = (
-        """local ip = {}\npublic ip = {}""".format(local_ip, pub_ip)
-        )
-        update.message.reply_text(message)
-
-    def power_switch_action(self):
-        self.power_switch.on()
-        time.sleep(1)
-        self.power_switch.off()
-
-    @only_allowed_chats
-    def press_power_switch(self, update: Update, context: CallbackContext):
-        """Short the power switch on the computer"""
-        self.power_switch_action()
-
-    def reset_switch_action(self):
-        self.reset_switch.on()
-        time.sleep(1)
-        self.reset_switch.off()
-
-    @only_allowed_chats
-    def press_reset_switch(self, update: Update, context: CallbackContext):
-        """Short the reset switch on the computer"""
-        self.reset_switch_action()
-
-    def power_switch_hold(self):
-        self.power_switch.on()
-        time.sleep(5)
-        self.power_switch.off()
-
-    @only_allowed_chats
-    def force_shutdown(self, update: Update, context: CallbackContext) -> None:
-        """ Ask the user if he wants to forcefully shutdown the computer """
-
-        # Add tag to prevent query from being handled by the wrong callbacks
-        tag = "force_shutdown_"
-        keyboard = [
-            [
-                InlineKeyboardButton("Yes", callback_data=tag+"yes"),
-                InlineKeyboardButton("No", callback_data=tag+"no"),
-            ]
-        ]
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        update.message.reply_text(
-            'This will abruptly shutdown the computer\n Are you sure?:',
-            reply_markup=reply_markup
-        )
-
-    def check_force_shutdown(self, update: Update, context: CallbackContext) -> None:
-        """ Callback for the force_shutdown button, if yes hold the powerbutton for 5 seconds """
-        query = update.callback_query
-
-        # CallbackQueries need to be answered, even if no notification to the user is needed
-        # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
-        query.answer()
-
-        # remove tag from callback data
-        tag = "force_shutdown_"
-        data = query.data.replace(tag, "")
-
-        if data == 'yes':
-            query.edit_message_text(text=f"Done")
-            self.power_switch_hold()
-        elif data == 'no':
-            query.edit_message_text(text=f"Shutdown canceled")
-        else:
-            self.logger.error(f"(check_force_shutdown) Unknown callback data: {data}")
-
-    @only_allowed_chats
-    def power_on(self, update: Update, context: CallbackContext):
-        """Power on the computer into the selected OS"""
-
-        # Add tag to prevent query from being handled by the wrong callbacks
-        tag = "power_on_"
-
-        if not self.is_host_online():
-            # Ask the user which OS he wants to boot
-            keyboard = [
-                [
-                    InlineKeyboardButton("Windows", callback_data=tag+'Windows'),
-                    InlineKeyboardButton("Ubuntu", callback_data=tag+'Ubuntu'),
-                ]
-            ]
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            update.message.reply_text(
-                'Which OS do you want to boot?',
-                reply_markup=reply_markup
-            )
-        else:
-            update.message.reply_text(
-                'The host is already online, please power off first'
-            )
-
-    def select_os(self, update: Update, context: CallbackContext) -> None:
-        """ Callback for the power_on button, if yes boot the selected OS """
-        query = update.callback_query
-
-        # CallbackQueries need to be answered, even if no notification to the user is needed
-        # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
-        query.answer()
-
-        # remove tag from callback data
-        tag = "power_on_"
-        data = query.data.replace(tag, "")
-
-        # Turn on the computer
-        self.power_switch_action()
-
-        if data == 'Windows':
-            query.edit_message_text(text=f"Booting Windows")
-
-            # Connect to the host via ssh
-            success = self.wait_for_host_online()
-            if not success:
-                query.edit_message_text(text=f"Could not connect to host")
-                return
-
-            if self.connect_ssh():
-                self.logger.info("SSH connection successful")
-
-                # Set next boot to Windows
-                if self.make_windows_next():
-                    self.reset_switch_action()
-
-                    # TODO Somehow a second reset switch is needed to boot Windows
-                    self.wait_for_host_online()
-                    self.reset_switch_action()
-                else:
-                    self.logger.error("Could not make Windows next")
-                    query.edit_message_text(text=f"Failed to set windows on reboot")
-            else:
-                self.logger.error("SSH connection failed in power_on->select_os")
-                query.edit_message_text(text=f"SSH connection failed")
+    # Runtime hooks of BotHandlers
+    def update_chat_id(self, update: Update) -> Optional[int]:
+        return update.effective_chat.id if update.effective_chat is not None else None
 
-        elif data == 'Ubuntu':
-            # Nothing to do Ubuntu is the default
-            query.edit_message_text(text=f"Booting Ubuntu")
-                        # Let it boot into Ubuntu
+    def keyboard(self, rows: Sequence[Sequence[Tuple[str, str]]]) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data) for text, data in row]
+                                     for row in rows])
 
-            success = self.wait_for_host_online()
+    def blocking(self, func: Callable, *args):
+        return func(*args)
 
-            # check if the host is online
-            if not success:
-                query.edit_message_text(text=f"Could not boot Ubuntu")
+    def ssh_call(self, host: Host, func: Callable, *args):
+        return func(*args)
 
-            self.power_switch_action()
-        else:
-            self.logger.error(f"(select_os) Unknown callback data: {data}")
-
-    def check_host_online(self, update: Update, context: CallbackContext) -> None:
-        """Reply if the host is online"""
-        if self.is_host_online():
-            update.message.reply_text(
-                'The host is online'
-            )
-        else:
-            update.message.reply_text(
-                'The host is offline'
-            )
-
-    def wait_for_host_online(self, timeout: float = 75) -> bool:
-        """Wait for the host to come online"""
-        t_start = time.time()
-        while not self.is_host_online() and time.time() - t_start < timeout:
-            time.sleep(5)
-
-        return self.is_host_online()
-
-    def make_windows_next(self) -> bool:
-        """Make the windows entry the default for the next boot"""
-
-        # Execute the bash command
-        return self.reboot_into_entry(self.windows_entry_id)
-
-    def reboot_into_entry(self, entry_id: int) -> bool:
-        """Reboot into the given entry"""
-        # Regen the grub env
-        done, _ = self.run_sudo_command("sudo grub-editenv create")
-        # set the entry id
-        done, _ = self.run_sudo_command("grub-reboot " + str(entry_id))
-        return done
+    def map_hosts(self, steps_of: Callable[[Host], Steps], hosts: List[Host]) -> List[Tuple[Host, object]]:
+        return self.fleet.map(lambda host: drive(steps_of(host)), hosts)
+
+    def on_done(self, future: Future, func: Callable, *args) -> None:
+        future.add_done_callback(lambda _: func(*args))
+
+    def refresh_network_soon(self) -> None:
+        self.network.refresh_soon()
+
+    def start_run(self, host: Host, name: str, message: Message) -> None:
+        # Commands may run for minutes, in the long lane
+        if self.lanes[LONG].submit(self._run_remote, host, name, message.chat_id, message.message_id) is None:
+            with self._runs_lock:
+                self.runs.pop(host.name, None)
+            message.edit_text(BUSY_TEXT)
+
+    def start_arming(self, host: Host, name: str, message: Message) -> Optional[Future]:
+        # Takes an ssh round trip or two, in the long lane
+        future = self.lanes[LONG].submit(drive, self._arm_next_boot(host, name, message))
+        if future is None:
+            message.reply_text(BUSY_TEXT)
+        return future
+
+    def _run_remote(self, host: Host, name: str, chat_id: int, message_id: int) -> None:
+        """Stream a /run command into its message"""
+        live = LiveMessage(self.updater.bot, chat_id, message_id, f"{name} on {host.name}",
+                           logger=self.logger)
+        try:
+            remote = host.stream_sudo_command(f"sh -c {shlex.quote(self.run_commands[name])}")
+            with self._runs_lock:
+                self.runs[host.name] = remote
+            for _, line in remote:
+                live.append(line)
+            if remote.exit_status is None:
+                status = 'Stopped'
+            else:
+                status = f"Exited with status {remote.exit_status}"
+        except Exception as e:
+            self.logger.error(f"Could not run {name} on {host.name}: {e}")
+            status = f"Failed: {e}"
+        finally:
+            with self._runs_lock:
+                self.runs.pop(host.name, None)
+        live.finish(status)
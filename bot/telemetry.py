@@ -0,0 +1,380 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from utils.metrics import REGISTRY
+
+# Values of a sample, NaN when the host does not report one
+FIELDS = ('cpu_temp', 'gpu_temp', 'load', 'mem_used')
+FIELD_LABELS = {
+    'cpu_temp': ('CPU temp', '°C'),
+    'gpu_temp': ('GPU temp', '°C'),
+    'load': ('Load', ''),
+    'mem_used': ('Memory', '%'),
+}
+
+# One command for every value, the GPU temperatures follow the marker
+GPU_MARKER = 'gpu'
+TELEMETRY_SCRIPT = ('cat /proc/loadavg /proc/meminfo /sys/class/thermal/thermal_zone*/temp; '
+                    f'echo {GPU_MARKER}; '
+                    'nvidia-smi --query-gpu=temperature.gpu --format=csv,noheader,nounits')
+
+SAMPLES = REGISTRY.counter('suckerfish_telemetry_samples', 'Telemetry reads by result', ('host', 'result'))
+
+NAN = float('nan')
+
+
+class Tier(NamedTuple):
+    """Resolution of a time series: one point per step seconds, slots points kept"""
+    name: str
+    step: float
+    slots: int
+
+
+# An hour of 30 s points, a day of 5 min points and a week of 30 min points,
+# about 30 kB for the four fields
+TIERS = (
+    Tier('hour', 30, 120),
+    Tier('day', 300, 288),
+    Tier('week', 1800, 336),
+)
+
+SPARK_CHARS = '▁▂▃▄▅▆▇█'
+FILE_VERSION = 1
+
+
+def parse_telemetry(lines: Iterable[str]) -> Dict[str, float]:
+    """Values of the output of TELEMETRY_SCRIPT, the missing ones are left out
+
+    Args:
+        lines (Iterable[str]): stdout of the script.
+
+    Returns:
+        dict: The values by field.
+    """
+    values: Dict[str, float] = {}
+    memory: Dict[str, float] = {}
+    cpu_temps: List[float] = []
+    gpu_temps: List[float] = []
+    gpu = False
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == GPU_MARKER:
+            gpu = True
+        elif len(words) == 5 and '/' in words[3] and 'load' not in values:
+            # /proc/loadavg: 0.52 0.58 0.59 1/467 12345
+            values['load'] = _number(words[0])
+        elif words[0].endswith(':') and len(words) >= 2:
+            memory[words[0][:-1]] = _number(words[1])
+        elif len(words) == 1:
+            value = _number(words[0])
+            if gpu:
+                gpu_temps.append(value)
+            else:
+                # Thermal zones report millidegrees
+                cpu_temps.append(value / 1000)
+    total, available = memory.get('MemTotal'), memory.get('MemAvailable')
+    if total and available is not None:
+        values['mem_used'] = 100 * (total - available) / total
+    for field, temps in (('cpu_temp', cpu_temps), ('gpu_temp', gpu_temps)):
+        temps = [temp for temp in temps if not math.isnan(temp)]
+        if temps:
+            values[field] = max(temps)
+    return {field: value for field, value in values.items() if not math.isnan(value)}
+
+
+def _number(text: str) -> float:
+    try:
+        return float(text)
+    except ValueError:
+        return NAN
+
+
+class RingSeries:
+    """Fixed size time series of one tier, kept in flat arrays.
+
+    Samples are averaged into buckets of the tier's step, each bucket keeps
+    the mean and the max of every field. The arrays are allocated once, a
+    full series overwrites its oldest bucket.
+    """
+
+    def __init__(self, tier: Tier, fields: int):
+        self.tier = tier
+        self.fields = fields
+        self.times = array('d', [0.0]) * tier.slots  # Start of each bucket
+        self.means = array('f', [NAN]) * (tier.slots * fields)
+        self.maxes = array('f', [NAN]) * (tier.slots * fields)
+        self.head = 0  # Next slot to write
+        self.count = 0
+
+        # Bucket being filled
+        self._start: Optional[float] = None
+        self._sums = [0.0] * fields
+        self._counts = [0] * fields
+        self._max = [NAN] * fields
+
+    def add(self, t: float, values: List[float]) -> None:
+        """Add a sample, closing the bucket of the previous one if t is past it"""
+        start = t - t % self.tier.step
+        if self._start is not None and start != self._start:
+            self._close()
+        self._start = start
+        for i, value in enumerate(values):
+            if math.isnan(value):
+                continue
+            self._sums[i] += value
+            self._counts[i] += 1
+            if not value <= self._max[i]:
+                self._max[i] = value
+
+    def _close(self) -> None:
+        slot = self.head
+        self.times[slot] = self._start
+        base = slot * self.fields
+        for i in range(self.fields):
+            count = self._counts[i]
+            self.means[base + i] = self._sums[i] / count if count else NAN
+            self.maxes[base + i] = self._max[i]
+        self.head = (slot + 1) % self.tier.slots
+        self.count = min(self.count + 1, self.tier.slots)
+        self._sums = [0.0] * self.fields
+        self._counts = [0] * self.fields
+        self._max = [NAN] * self.fields
+
+    def points(self, since: float = 0) -> List[Tuple[float, List[float], List[float]]]:
+        """(start, means, maxes) of the buckets starting at or after since, oldest first,
+        including the one being filled"""
+        slots = self.tier.slots
+        points = []
+        for n in range(self.count):
+            slot = (self.head - self.count + n) % slots
+            if self.times[slot] < since:
+                continue
+            base = slot * self.fields
+            points.append((self.times[slot],
+                           list(self.means[base:base + self.fields]),
+                           list(self.maxes[base:base + self.fields])))
+        if self._start is not None and self._start >= since:
+            means = [total / count if count else NAN for total, count in zip(self._sums, self._counts)]
+            points.append((self._start, means, list(self._max)))
+        return points
+
+    def nbytes(self) -> int:
+        """Bytes of the arrays"""
+        return sum(len(a) * a.itemsize for a in (self.times, self.means, self.maxes))
+
+
+class FieldSummary(NamedTuple):
+    last: float
+    mean: float
+    max: float
+    spark: str
+
+
+class TelemetryStore:
+    """Telemetry of a host in one RingSeries per tier, saved to a compact file.
+
+    The file is a json header line with the layout followed by the raw
+    arrays, so loading it is a few reads. A file of another layout is
+    discarded. The buckets being filled are not saved.
+    """
+
+    def __init__(self, state_file: str, tiers: Iterable[Tier] = TIERS, fields: Iterable[str] = FIELDS, logger=None):
+        """Initialize the store, loading the file if it exists
+
+        Args:
+            state_file (str): The file of the store.
+            tiers (Iterable[Tier], optional): Resolutions kept. Defaults to TIERS.
+            fields (Iterable[str], optional): Values of a sample. Defaults to FIELDS.
+        """
+        self.state_file = state_file
+        self.fields = tuple(fields)
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self.series = {tier.name: RingSeries(tier, len(self.fields)) for tier in tiers}
+        self.last: Optional[Tuple[float, Dict[str, float]]] = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def add(self, values: Dict[str, float], t: Optional[float] = None) -> None:
+        """Record a sample taken at t, now by default"""
+        t = time.time() if t is None else t
+        row = [values.get(field, NAN) for field in self.fields]
+        with self._lock:
+            for series in self.series.values():
+                series.add(t, row)
+            self.last = (t, dict(values))
+
+    def summary(self, tier: str, now: Optional[float] = None, width: int = 24) -> Dict[str, FieldSummary]:
+        """Last value, mean, max and a sparkline of every field over the span of a tier
+
+        Args:
+            tier (str): Name of the tier, e.g. 'day'.
+            width (int, optional): Characters of the sparklines. Defaults to 24.
+
+        Returns:
+            dict: The summary of each field with any value in the span.
+        """
+        now = time.time() if now is None else now
+        series = self.series[tier]
+        with self._lock:
+            points = series.points(now - series.tier.step * series.tier.slots)
+            last = self.last
+        summaries = {}
+        for i, field in enumerate(self.fields):
+            means = [(t, point_means[i]) for t, point_means, _ in points if not math.isnan(point_means[i])]
+            maxes = [point_maxes[i] for _, _, point_maxes in points if not math.isnan(point_maxes[i])]
+            if not means:
+                continue
+            last_value = last[1].get(field, means[-1][1]) if last is not None else means[-1][1]
+            summaries[field] = FieldSummary(last_value,
+                                            sum(value for _, value in means) / len(means),
+                                            max(maxes),
+                                            sparkline([value for _, value in means], width))
+        return summaries
+
+    def nbytes(self) -> int:
+        return sum(series.nbytes() for series in self.series.values())
+
+    def _layout(self) -> dict:
+        return {'version': FILE_VERSION,
+                'fields': list(self.fields),
+                'tiers': [list(series.tier) for series in self.series.values()]}
+
+    def save(self) -> None:
+        """Atomically replace the file with the closed buckets"""
+        with self._lock:
+            header = self._layout()
+            header['heads'] = [[series.head, series.count] for series in self.series.values()]
+            chunks = [json.dumps(header).encode() + b'\n']
+            for series in self.series.values():
+                chunks.extend(a.tobytes() for a in (series.times, series.means, series.maxes))
+        tmp_file = self.state_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.writelines(chunks)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            self.logger.error(f"Could not write the telemetry: {e}")
+
+    def _load(self) -> None:
+        try:
+            with open(self.state_file, 'rb') as f:
+                header = json.loads(f.readline())
+                heads = header.pop('heads')
+                if header != self._layout():
+                    raise ValueError('the layout changed')
+                for series, (head, count) in zip(self.series.values(), heads):
+                    for a in (series.times, series.means, series.maxes):
+                        data = f.read(len(a) * a.itemsize)
+                        if len(data) != len(a) * a.itemsize:
+                            raise ValueError('the file is truncated')
+                        a[:] = array(a.typecode, data)
+                    series.head, series.count = int(head), int(count)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            self.logger.error(f"Discarding unreadable telemetry: {e}")
+            self.series = {name: RingSeries(series.tier, len(self.fields)) for name, series in self.series.items()}
+
+
+def sparkline(values: List[float], width: int = 24) -> str:
+    """The values averaged down to width characters of SPARK_CHARS"""
+    if not values:
+        return ''
+    if len(values) > width:
+        columns = []
+        for i in range(width):
+            chunk = values[i * len(values) // width:(i + 1) * len(values) // width]
+            columns.append(sum(chunk) / len(chunk))
+        values = columns
+    low, high = min(values), max(values)
+    if high - low < 1e-9:
+        return SPARK_CHARS[0] * len(values)
+    scale = (len(SPARK_CHARS) - 1) / (high - low)
+    return ''.join(SPARK_CHARS[round((value - low) * scale)] for value in values)
+
+
+class TelemetrySampler:
+    """Reads the telemetry of a host over ssh every interval while it is up.
+
+    Reads are skipped while the host is offline or busy with an action, and
+    after a failed read (e.g. the host runs an OS without ssh) only every
+    tenth interval is tried until the host goes offline and back online.
+    The store is saved every save_interval seconds and on stop.
+    """
+
+    def __init__(self, host, store: TelemetryStore, interval: float = 30, save_interval: float = 600,
+                 logger=None):
+        """Initialize the sampler
+
+        Args:
+            host (Host): The host to read.
+            store (TelemetryStore): Where the samples go.
+            interval (float, optional): Seconds between reads. Defaults to 30.
+            save_interval (float, optional): Seconds between saves of the store. Defaults to 600.
+        """
+        self.host = host
+        self.store = store
+        self.interval = interval
+        self.save_interval = save_interval
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._failed_at_change: Optional[float] = None  # changed_at of the host state when a read failed
+        self._skipped = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start the background sampling"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f'telemetry_{self.host.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the sampling and save the store"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.store.save()
+
+    def sample(self) -> bool:
+        """Read the host once if it is up and idle, returns True if a sample was added"""
+        state = self.host.monitor.state
+        if state is None or not state.online or self.host.actions.current is not None:
+            return False
+        if self._failed_at_change == state.changed_at:
+            self._skipped += 1
+            if self._skipped % 10:
+                return False
+        values = self.host.read_telemetry()
+        if not values:
+            self._failed_at_change = state.changed_at
+            SAMPLES.labels(self.host.name, 'failed').inc()
+            return False
+        self._failed_at_change = None
+        self._skipped = 0
+        self.store.add(values)
+        SAMPLES.labels(self.host.name, 'ok').inc()
+        return True
+
+    def _run(self) -> None:
+        next_save = time.monotonic() + self.save_interval
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.error(f"Telemetry of {self.host.name} failed: {e}")
+            if time.monotonic() >= next_save:
+                self.store.save()
+                next_save = time.monotonic() + self.save_interval
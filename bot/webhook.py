@@ -0,0 +1,114 @@
+import hmac
+import json
+import logging
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from telegram import Update
+
+
+class WebhookServer:
+    """Minimal HTTP server receiving the Telegram updates pushed to a webhook.
+
+    Only POSTs to ``/<secret>`` are accepted. The request is acknowledged
+    before the update is decoded, so Telegram is never kept waiting, and the
+    update is handed to the dispatcher queue like the poller would.
+    """
+
+    def __init__(self,
+                 dispatcher,
+                 listen: str = '127.0.0.1',
+                 port: int = 8443,
+                 secret: str = '',
+                 cert: Optional[str] = None,
+                 key: Optional[str] = None,
+                 logger=None):
+        """Initialize the server
+
+        Args:
+            dispatcher (telegram.ext.Dispatcher): Dispatcher receiving the updates.
+            listen (str, optional): Address to bind. Defaults to '127.0.0.1'.
+            port (int, optional): Port to bind, 0 picks a free one. Defaults to 8443.
+            secret (str): Secret url path the updates are posted to, required as it keeps anyone else
+                from posting updates.
+            cert (str, optional): TLS certificate file, serves plain http if None. Defaults to None.
+            key (str, optional): TLS private key file. Defaults to None.
+
+        Raises:
+            ValueError: If the secret is empty.
+        """
+        if not secret.strip('/'):
+            raise ValueError('The webhook needs a secret path')
+        self.dispatcher = dispatcher
+        self.bot = dispatcher.bot
+        self.path = '/' + secret.strip('/')
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self.httpd = ThreadingHTTPServer((listen, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        if cert is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """The port the server is bound to"""
+        return self.httpd.server_address[1]
+
+    def _make_handler(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                # Constant time, not to leak the secret through the response time
+                if not hmac.compare_digest(self.path.encode(), server.path.encode()):
+                    self.send_error(403)
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+
+                # Answer first, the update is processed in the dispatcher anyway
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+                server.process(body)
+
+            def do_GET(self):
+                self.send_error(405)
+
+            def log_message(self, format, *args):
+                # The default handler writes every request to stderr
+                pass
+
+        return WebhookHandler
+
+    def process(self, body: bytes) -> None:
+        """Decode an update and queue it for the dispatcher"""
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except (ValueError, TypeError) as e:
+            self.logger.warning(f"Discarding invalid webhook update: {e}")
+            return
+        if update is not None:
+            self.dispatcher.update_queue.put(update)
+
+    def start(self) -> None:
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop serving"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -1,11 +1,8 @@
 import argparse
 import os
-from re import I
 
-from telegram.ext import CommandHandler, Filters, MessageHandler, Updater
-
-from bot.suckerfish_bot import SuckerfishBot
-from utils.config import get_config
+from utils.config import get_config, restart_changes
+from utils.config_watcher import ConfigWatcher
 from utils.loggers import DevChatLogger
 
 
@@ -17,6 +14,14 @@ def parse_args():
                         help="Run the bot in interactive mode.")
     parser.add_argument("--config", "-c", type=str,
                         help="Path to the config file.")
+    parser.add_argument("--webhook", "-w", action="store_true",
+                        help="Receive the updates through the webhook in the config instead of polling.")
+    parser.add_argument("--fast-start", "-f", action="store_true",
+                        help="Start answering first and claim the GPIO pins and ssh keys in the background.")
+    parser.add_argument("--runtime", "-r", choices=('threads', 'asyncio'),
+                        help="Run the handlers on threads or on one asyncio event loop, defaults to the config file.")
+    parser.add_argument("--low-memory", "-m", action="store_true",
+                        help="Fewer threads and one Telegram client for the bot and the dev chat logger.")
 
     return parser.parse_args()
 
@@ -36,33 +41,90 @@ def main():
 
     bot_config, log_config = get_config(config_file)
 
+    if args.webhook and bot_config['webhook'] is None:
+        raise ValueError('--webhook needs a webhook url in the config file')
+
+    runtime = args.runtime or bot_config['runtime']['type']
+    if args.webhook and runtime == 'asyncio':
+        raise ValueError('--webhook is only supported by the threads runtime')
+    low_memory = args.low_memory or bot_config['runtime']['low_memory']
+
     logger = DevChatLogger(
         log_config['dev_bot_token'],
         log_config['dev_chat_id'],
         chat_log_level=log_config['chat_log_level'],
         file_log_level=log_config['file_log_level'],
-        log_file=log_config['log_file']
+        log_file=log_config['log_file'],
+        chat_rate=log_config['chat_rate'],
+        chat_queue_size=log_config['chat_queue_size'],
+        log_max_bytes=log_config['log_max_bytes'],
+        log_total_bytes=log_config['log_total_bytes'],
+        log_flush_interval=log_config['log_flush_interval'],
+        base_url=bot_config['base_url'],
+        # The messages wait for the client of the bot
+        shared_client=low_memory
     )
 
+    watcher = None
     try:
-        bot = SuckerfishBot(
-            bot_config['bot_token'],
-            bot_config['host_ip'],
-            bot_config['host_username'],
-            bot_config['host_password'],
-            bot_config['power_pin'],
-            bot_config['reset_pin'],
-            bot_config['windows_entry_id'],
-            bot_config['allowed_chats'],
-            logger
+        common = dict(
+            state_dir=bot_config['state_dir'],
+            notify_host_changes=bot_config['notify_host_changes'],
+            lazy_init=args.fast_start,
+            base_url=bot_config['base_url'],
+            metrics=bot_config['metrics'],
+            run_commands=bot_config['run_commands'],
+            network=bot_config['network']
         )
+        if runtime == 'asyncio':
+            # Imported here, so each runtime only loads its own libraries
+            from bot.async_bot import AsyncSuckerfishBot
+            bot = AsyncSuckerfishBot(
+                bot_config['bot_token'],
+                bot_config['hosts'],
+                bot_config['allowed_chats'],
+                logger,
+                ssh_workers=bot_config['runtime']['ssh_workers'],
+                max_pending=bot_config['runtime']['max_pending'],
+                **common
+            )
+        else:
+            from bot.suckerfish_bot import SuckerfishBot
+            bot = SuckerfishBot(
+                bot_config['bot_token'],
+                bot_config['hosts'],
+                bot_config['allowed_chats'],
+                logger,
+                lanes=bot_config['lanes'],
+                low_memory=low_memory,
+                **common
+            )
+        if low_memory:
+            logger.use_client(bot.dev_chat_client(log_config['dev_bot_token']))
 
         if args.interactive:
             import IPython
             IPython.embed()
 
         # Start the bot
-        bot.start()
+        bot.start(bot_config['webhook'] if args.webhook else None)
+
+        # Apply the edits of the config file while running
+        if bot_config['reload']['enabled']:
+            startup = (bot_config, log_config)
+
+            def apply_config(config: tuple) -> None:
+                new_bot_config, new_log_config = config
+                restart = restart_changes(startup, config)
+                if restart:
+                    logger.warning(f"Restart the bot to apply the changes of {', '.join(restart)}")
+                bot.reload_config(new_bot_config)
+                logger.set_levels(new_log_config['chat_log_level'], new_log_config['file_log_level'])
+
+            watcher = ConfigWatcher(config_file, get_config, apply_config,
+                                    poll_interval=bot_config['reload']['poll_interval'],
+                                    logger=logger)
+            watcher.start()
 
         # Run the bot until you press Ctrl-C or the process receives SIGINT,
         # SIGTERM or SIGABRT. This should be used most of the time, since
@@ -72,6 +134,11 @@ def main():
         logger.info('KeyboardInterrupt received, exiting...')
     except Exception as e:
         logger.critical(f'An error occurred in suckerbot: {e}')
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        # Deliver the messages still queued for the dev chat
+        logger.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,312 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+from utils.metrics import REGISTRY
+from utils.text import TELEGRAM_MAX_LENGTH, render_output, split_message
+
+QUEUE_DEPTH = REGISTRY.gauge('suckerfish_chat_queue_depth', 'Messages waiting to be sent to a chat', ('chat',))
+SEND_SECONDS = REGISTRY.histogram('suckerfish_chat_send_seconds', 'Time of the sendMessage calls to a chat', ('chat',))
+DROPPED = REGISTRY.counter('suckerfish_chat_dropped', 'Messages dropped because the chat queue was full', ('chat',))
+
+
+def telegram_errors(bot) -> Tuple[type, type, type]:
+    """The (RetryAfter, BadRequest, base) error classes raised by a Bot API client
+
+    A client can list them in an errors attribute, e.g.
+    bot.async_telegram.BlockingTelegramClient. telegram.Bot raises the ones of
+    python-telegram-bot, which is only imported then.
+    """
+    errors = getattr(bot, 'errors', None)
+    if errors is None:
+        from telegram.error import BadRequest, RetryAfter, TelegramError
+        errors = (RetryAfter, BadRequest, TelegramError)
+    return errors
+
+
+class ChatSender:
+    """Sends messages to a chat from a background thread.
+
+    Callers only append to a bounded queue and never wait on the network.
+    Messages queued close together are merged into as few Telegram messages
+    as the 4096 character limit allows, and sending is paced by a token
+    bucket of ``rate`` messages per second. When the queue is full new
+    messages are dropped and a summary of how many were lost is sent instead.
+    """
+
+    def __init__(self,
+                 bot,
+                 chat_id,
+                 rate: float = 1.0,
+                 burst: int = 3,
+                 max_queue: int = 200,
+                 batch_delay: float = 0.5,
+                 parse_mode: Optional[str] = 'HTML',
+                 logger=None):
+        """Initialize the sender and start its thread
+
+        Args:
+            bot (telegram.Bot): The bot used to send the messages, if None they are queued until attach().
+            chat_id: The chat to send the messages to.
+            rate (float, optional): Messages per second sent on average. Defaults to 1.0.
+            burst (int, optional): Messages that can be sent back to back. Defaults to 3.
+            max_queue (int, optional): Messages kept waiting before dropping new ones. Defaults to 200.
+            batch_delay (float, optional): Seconds to wait for more messages to merge. Defaults to 0.5.
+            parse_mode (str, optional): Parse mode of the messages. Defaults to HTML.
+        """
+        self.bot = None
+        self.errors: Optional[Tuple[type, type, type]] = None
+        self.chat_id = chat_id
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.batch_delay = batch_delay
+        self.parse_mode = parse_mode
+        # Only log to the python logger, logging to the chat from here would loop
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._queue: Deque[str] = deque()
+        self._dropped = 0
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._idle = True
+
+        QUEUE_DEPTH.labels(chat_id).set_function(lambda: self.queue_depth)
+        self._send_seconds = SEND_SECONDS.labels(chat_id)
+        self._dropped_count = DROPPED.labels(chat_id)
+
+        if bot is not None:
+            self.attach(bot)
+        self._thread = threading.Thread(target=self._run, name='chat_sender', daemon=True)
+        self._thread.start()
+
+    def attach(self, bot) -> None:
+        """Send through bot from now on, the messages queued until then go out first"""
+        with self._cond:
+            self.bot = bot
+            self.errors = telegram_errors(bot)
+            self._cond.notify_all()
+
+    @property
+    def queue_depth(self) -> int:
+        """Messages waiting to be sent"""
+        return len(self._queue)
+
+    def send(self, text: str) -> bool:
+        """Queue a message, returns False if it was dropped because the queue is full"""
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self._dropped += 1
+                self._dropped_count.inc()
+                return False
+            self._queue.append(text)
+            self._cond.notify()
+        return True
+
+    def flush(self, timeout: float = 10) -> bool:
+        """Wait until the queue is empty, returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Nothing to send them with
+            if self.bot is None:
+                return False
+            while self._queue or self._dropped or not self._idle:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout: float = 10) -> None:
+        """Send what is queued and stop the thread"""
+        self.flush(timeout)
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _next_batch(self) -> List[str]:
+        """Wait for messages and merge them in chunks that fit a Telegram message"""
+        with self._cond:
+            while (self.bot is None or not self._queue and not self._dropped) and not self._stop:
+                self._idle = True
+                self._cond.notify_all()
+                self._cond.wait()
+            self._idle = False
+
+        # Give a burst the chance to arrive before merging it
+        if not self._stop:
+            time.sleep(self.batch_delay)
+
+        with self._cond:
+            texts = list(self._queue)
+            self._queue.clear()
+            if self._dropped:
+                texts.append(f'<i>{self._dropped} log messages dropped, the chat queue was full</i>')
+                self._dropped = 0
+
+        chunks = []
+        current = ''
+        for text in texts:
+            for part in split_message(text):
+                if current and len(current) + 1 + len(part) > TELEGRAM_MAX_LENGTH:
+                    chunks.append(current)
+                    current = part
+                else:
+                    current = f'{current}\n{part}' if current else part
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _take_token(self) -> None:
+        """Block until the rate limit allows another message"""
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self.rate)
+
+    def _send_chunk(self, text: str) -> None:
+        RetryAfter, BadRequest, _ = self.errors
+        for _ in range(3):
+            self._take_token()
+            try:
+                with self._send_seconds.time():
+                    self.bot.send_message(chat_id=self.chat_id, text=text, parse_mode=self.parse_mode)
+                return
+            except RetryAfter as e:
+                self.logger.warning(f"Chat rate limit hit, retrying in {e.retry_after} s")
+                time.sleep(e.retry_after)
+            except BadRequest as e:
+                if self.parse_mode is None:
+                    raise
+                # Splitting may cut through the markup, send it as plain text
+                self.logger.warning(f"Chat message rejected ({e}), sending it without markup")
+                self.bot.send_message(chat_id=self.chat_id, text=text)
+                return
+
+    def _run(self) -> None:
+        while True:
+            chunks = self._next_batch()
+            if not chunks and self._stop:
+                break
+            if self.bot is None:
+                # Stopped before a bot was attached
+                self.logger.warning(f"{len(chunks)} chat messages dropped, no bot to send them with")
+                break
+            for chunk in chunks:
+                try:
+                    self._send_chunk(chunk)
+                except self.errors[2] as e:
+                    self.logger.warning(f"Could not send log message to the chat: {e}")
+                except Exception as e:
+                    self.logger.warning(f"Unexpected error sending log message to the chat: {e}")
+        with self._cond:
+            self._idle = True
+            self._cond.notify_all()
+
+
+class LiveMessage:
+    """A message edited in place with the last lines of a growing output.
+
+    Edits are throttled to one every min_interval seconds, lines arriving
+    in between are shown by a delayed edit, so a command printing thousands
+    of lines costs a handful of API calls. Only the last max_lines are kept.
+    """
+
+    def __init__(self,
+                 bot,
+                 chat_id,
+                 message_id: int,
+                 title: str,
+                 max_lines: int = 30,
+                 min_interval: float = 3.0,
+                 logger=None):
+        """Initialize the message
+
+        Args:
+            bot (telegram.Bot): The bot that sent the message.
+            chat_id: The chat of the message.
+            message_id (int): The message to edit.
+            title (str): Shown above the output.
+            max_lines (int, optional): Output lines shown. Defaults to 30.
+            min_interval (float, optional): Seconds between edits. Defaults to 3.0.
+        """
+        self.bot = bot
+        self.errors = telegram_errors(bot)
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.title = title
+        self.min_interval = min_interval
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self.lines: Deque[str] = deque(maxlen=max_lines)
+        self.edits = 0
+        self._next_edit = 0.0
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+
+    def append(self, line: str) -> None:
+        """Add an output line, the message is edited when the throttle allows"""
+        with self._lock:
+            self.lines.append(line)
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(delay, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self._flush()
+
+    def finish(self, status: str) -> None:
+        """Show the whole output with a final status, waiting for the throttle if needed"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        # The final status must get through, even after a rate limit
+        for _ in range(3):
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if self._flush(status):
+                return
+
+    def render(self, status: str = '') -> str:
+        """The message text, the oldest lines are left out to fit a message"""
+        with self._lock:
+            lines = list(self.lines)
+        return render_output(self.title, lines, status)
+
+    def _flush(self, status: str = '') -> bool:
+        """Edit the message now, returns False if Telegram asked to retry later"""
+        with self._lock:
+            self._timer = None
+            self._next_edit = time.monotonic() + self.min_interval
+        RetryAfter, BadRequest, TelegramError = self.errors
+        try:
+            self.bot.edit_message_text(text=self.render(status),
+                                       chat_id=self.chat_id,
+                                       message_id=self.message_id,
+                                       parse_mode='HTML')
+            self.edits += 1
+        except RetryAfter as e:
+            with self._lock:
+                self._next_edit = time.monotonic() + e.retry_after
+            self.logger.warning(f"Live message throttled by Telegram for {e.retry_after} s")
+            return False
+        except BadRequest as e:
+            # Nothing new since the last edit
+            if 'not modified' not in str(e).lower():
+                self.logger.warning(f"Could not edit the live message: {e}")
+        except TelegramError as e:
+            self.logger.warning(f"Could not edit the live message: {e}")
+        return True
@@ -11,6 +11,73 @@ str2log_level = {
     'critical': CRITICAL
 }
 
+def get_host_config(host: dict, config: dict) -> dict:
+    """Preps the config of a single host
+
+    The probe and monitor settings of the host override the top level ones,
+    which in turn default to the ones of the single host layout.
+
+    Args:
+        host (dict): The host entry of the config file.
+        config (dict): The whole config file.
+
+    Returns:
+        dict: The keyword arguments for bot.host.Host.
+    """
+    # liveness probes, optional for older config files
+    probe_config = dict(config.get('probe') or (config.get('host_pc') or {}).get('probe') or {})
+    probe_config.update(host.get('probe') or {})
+
+    # background host monitor
+    monitor_config = dict(config.get('monitor') or (config.get('host_pc') or {}).get('monitor') or {})
+    monitor_config.update(host.get('monitor') or {})
+
+    return {
+        'name': str(host['name']),
+        'host_ip': host['local_ip'],
+        'host_username': host['username'],
+        'host_password': host['password'],
+        'power_pin': host['power_pin'],
+        'reset_pin': host['reset_pin'],
+        'windows_entry_id': host.get('grub_windows_entry', 1),
+        'grub_cfg': host.get('grub_cfg', '/boot/grub/grub.cfg'),
+        'arm_at_shutdown': host.get('arm_at_shutdown'),
+        'armed_check_timeout': host.get('armed_check_timeout', 10),
+        'telemetry_interval': host.get('telemetry_interval', 30),
+        'ssh_key': host.get('ssh_key', '/home/pi/.ssh/id_rsa'),
+        'ssh_port': host.get('ssh_port', 22),
+        'pulse_time': host.get('pulse_time', 1),
+        'hold_time': host.get('hold_time', 5),
+        'probe_timeout': probe_config.get('timeout', 1.0),
+        'probe_interval': probe_config.get('interval', 0.5),
+        'probe_sparse_interval': probe_config.get('sparse_interval', 5),
+        'boot_timeout': probe_config.get('boot_timeout', 75),
+        'probe_tcp_ports': probe_config.get('tcp_ports', [22]),
+        'fingerprint_timeout': probe_config.get('fingerprint_timeout', 0.5),
+        'monitor_interval': monitor_config.get('interval', 10),
+        'monitor_max_interval': monitor_config.get('max_interval', 60),
+        'monitor_ttl': monitor_config.get('ttl', 90),
+    }
+
+
+# Read once at start, changing them in the file needs a restart
+RESTART_KEYS = ('bot_token', 'base_url', 'state_dir', 'webhook', 'metrics', 'lanes', 'runtime', 'reload')
+LOG_RESTART_KEYS = ('dev_bot_token', 'dev_chat_id', 'log_file', 'chat_rate', 'chat_queue_size',
+                    'log_max_bytes', 'log_total_bytes', 'log_flush_interval')
+
+
+def restart_changes(old: tuple, new: tuple) -> List[str]:
+    """Settings of get_config that changed but are only applied by a restart
+
+    Args:
+        old (tuple): The (bot config, log config) the bot started with.
+        new (tuple): The (bot config, log config) read from the file now.
+    """
+    (old_bot, old_log), (new_bot, new_log) = old, new
+    return ([key for key in RESTART_KEYS if old_bot[key] != new_bot[key]]
+            + [key for key in LOG_RESTART_KEYS if old_log[key] != new_log[key]])
+
+
 def get_config(config_file: str):
     """Preps the config file for use in the bot and logger
 
@@ -32,16 +99,82 @@ def get_config(config_file: str):
             raise ValueError('No bot token found in config file')
 
         allowed_chats: List[str] = config['telegram_api']['allowed_chats']
+        if allowed_chats is not None and not isinstance(allowed_chats, list):
+            raise ValueError('allowed_chats must be a list of chat ids')
+        base_url: str = config['telegram_api'].get('base_url')
+
+        # hosts, either a list of hosts or the single host_pc + pin_wiring layout
+        if config.get('hosts'):
+            hosts = [get_host_config(host, config) for host in config['hosts']]
+        else:
+            host = dict(config['host_pc'])
+            host.setdefault('name', 'pc')
+            host.update(config['pin_wiring'])
+            hosts = [get_host_config(host, config)]
+
+        names = [host['name'] for host in hosts]
+        if len(set(names)) != len(names):
+            raise ValueError('Host names in the config file must be unique')
+        if any(':' in name for name in names):
+            # Separates the host from the OS or answer in the callback data of the buttons
+            raise ValueError("Host names in the config file can't contain ':'")
+        pins = [pin for host in hosts for pin in (host['power_pin'], host['reset_pin'])]
+        if len(set(pins)) != len(pins):
+            raise ValueError('Each host needs its own power and reset pins')
+
+        monitor_config = config.get('monitor') or (config.get('host_pc') or {}).get('monitor') or {}
+        notify_host_changes: bool = monitor_config.get('notify', True)
+
+        # optional webhook to receive the updates instead of polling
+        webhook = config.get('webhook') or {}
+        webhook_config = None
+        if webhook.get('url'):
+            webhook_config = {
+                'url': webhook['url'],
+                'listen': webhook.get('listen', '127.0.0.1'),
+                'port': webhook.get('port', 8443),
+                'secret': str(webhook.get('secret') or ''),
+                'cert': webhook.get('cert'),
+                'key': webhook.get('key'),
+            }
+
+        # optional prometheus endpoint
+        metrics = config.get('metrics') or {}
+        metrics_config = None
+        if metrics.get('port'):
+            metrics_config = {
+                'listen': metrics.get('listen', '127.0.0.1'),
+                'port': metrics['port'],
+            }
+
+        # commands allowed in /run, by name
+        run_commands = {str(name): str(command) for name, command in (config.get('run_commands') or {}).items()}
+
+        # public ip lookups of /current_ip
+        network = config.get('network') or {}
+        network_config = {key: network[key] for key in ('providers', 'ttl', 'timeout', 'notify')
+                          if network.get(key) is not None}
+
+        # threads (python-telegram-bot) or asyncio
+        runtime = config.get('runtime') or {}
+        runtime_config = {
+            'type': runtime.get('type') or 'threads',
+            'ssh_workers': runtime.get('ssh_workers', 2),
+            'max_pending': runtime.get('max_pending', 100),
+            'low_memory': bool(runtime.get('low_memory', False)),
+        }
+        if runtime_config['type'] not in ('threads', 'asyncio'):
+            raise ValueError(f"Unknown runtime: {runtime_config['type']}")
 
-        # Pin wiring por the switches
-        power_pin: int = config['pin_wiring']['power_pin']
-        reset_pin: int = config['pin_wiring']['reset_pin']
+        # applying the changes to the config file without a restart
+        reload = config.get('reload') or {}
+        reload_config = {
+            'enabled': bool(reload.get('enabled', True)),
+            'poll_interval': reload.get('poll_interval', 2),
+        }
 
-        # host pc data
-        host_ip: str = config['host_pc']['local_ip']
-        host_username: str = config['host_pc']['username']
-        password: str = config['host_pc']['password']
-        windows_entry_id: int = config['host_pc']['grub_windows_entry']
+        # runtime state such as the boot journal
+        state_dir: str = config.get('state_dir') or '.'
 
         # logging
         dev_chat_id: str = config['logging']['dev_chat_id']
@@ -49,17 +182,27 @@ def get_config(config_file: str):
         log_file: str = config['logging']['log_file']
         chat_log_level: int = config['logging']['chat_log_level']
         file_log_level: int = config['logging']['file_log_level']
+        chat_rate: float = config['logging'].get('chat_rate', 1.0)
+        chat_queue_size: int = config['logging'].get('chat_queue_size', 200)
+        log_max_mb: float = config['logging'].get('log_max_mb', 1)
+        log_total_mb: float = config['logging'].get('log_total_mb', 10)
+        log_flush_interval: float = config['logging'].get('log_flush_interval', 30)
 
-    # bot config: bot_token, host_ip, host_username, power_pin, reset_pin, windows_entry_id, allowed_chats)
+    # bot config: bot_token, hosts, allowed_chats, state_dir
     bot_config = {
         'bot_token': bot_token,
-        'host_ip': host_ip,
-        'host_username': host_username,
-        'host_password': password,
-        'power_pin': power_pin,
-        'reset_pin': reset_pin,
-        'windows_entry_id': windows_entry_id,
-        'allowed_chats': allowed_chats
+        'base_url': base_url,
+        'hosts': hosts,
+        'allowed_chats': allowed_chats,
+        'state_dir': state_dir,
+        'notify_host_changes': notify_host_changes,
+        'webhook': webhook_config,
+        'metrics': metrics_config,
+        'run_commands': run_commands,
+        'lanes': config.get('lanes') or {},
+        'network': network_config,
+        'runtime': runtime_config,
+        'reload': reload_config
     }
 
     # logging config: log_file, chat_log_level, file_log_level
@@ -68,7 +211,12 @@ def get_config(config_file: str):
         'dev_chat_id': dev_chat_id,
         'log_file': log_file,
         'chat_log_level': str2log_level[chat_log_level.lower()],
-        'file_log_level': str2log_level[file_log_level.lower()]
+        'file_log_level': str2log_level[file_log_level.lower()],
+        'chat_rate': chat_rate,
+        'chat_queue_size': chat_queue_size,
+        'log_max_bytes': int(log_max_mb * 1024 * 1024),
+        'log_total_bytes': int(log_total_mb * 1024 * 1024),
+        'log_flush_interval': log_flush_interval
     }
 
     return bot_config, log_config
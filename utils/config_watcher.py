@@ -0,0 +1,189 @@
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+from utils.metrics import REGISTRY
+
+RELOADS = REGISTRY.counter('suckerfish_config_reloads', 'Changes of the config file, by outcome', ('result',))
+
+# inotify(7) events of the folder that may replace the file: written, moved or linked in place
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_EVENT = struct.Struct('iIII')
+
+
+def inotify_watch(directory: str) -> Optional[int]:
+    """A non-blocking inotify descriptor watching the folder, None where inotify is missing"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def inotify_names(fd: int) -> set:
+    """File names of the events waiting on the descriptor"""
+    names = set()
+    while True:
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = IN_EVENT.unpack_from(data, offset)
+            offset += IN_EVENT.size
+            names.add(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+
+
+class ConfigWatcher:
+    """Loads a config file again whenever it changes on disk.
+
+    The folder of the file is watched with inotify, so editors saving it as
+    a new file renamed in place are seen too; where inotify is missing the
+    mtime, size and inode of the file are compared every poll_interval. The
+    events are debounced and the file is only loaded when its content
+    changed. A config that load rejects is logged and the current one is
+    kept, the valid ones are handed to on_change from the watcher thread.
+    """
+
+    def __init__(self,
+                 path: str,
+                 load: Callable[[str], object],
+                 on_change: Callable[[object], None],
+                 poll_interval: float = 2,
+                 debounce: float = 0.2,
+                 use_inotify: bool = True,
+                 logger=None):
+        """Initialize the watcher, the file is read for its current content
+
+        Args:
+            path (str): The config file.
+            load (Callable[[str], object]): Reads and validates the file, raising if it is invalid.
+            on_change (Callable[[object], None]): Applies what load returned.
+            poll_interval (float, optional): Seconds between checks without inotify. Defaults to 2.
+            debounce (float, optional): Seconds without events before the file is read. Defaults to 0.2.
+            use_inotify (bool, optional): Poll instead of watching if False. Defaults to True.
+        """
+        self.path = os.path.abspath(path)
+        self.load = load
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.use_inotify = use_inotify
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._digest = self._read_digest()
+        self._stat = self._read_stat()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._fd: Optional[int] = None
+
+    @property
+    def inotify(self) -> bool:
+        """Whether the file is watched with inotify rather than polled"""
+        return self._fd is not None
+
+    def _read_digest(self) -> Optional[bytes]:
+        try:
+            with open(self.path, 'rb') as f:
+                return hashlib.sha256(f.read()).digest()
+        except OSError:
+            return None
+
+    def _read_stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def start(self) -> None:
+        """Watch the file in the background"""
+        if self._thread is not None:
+            return
+        if self.use_inotify:
+            self._fd = inotify_watch(os.path.dirname(self.path))
+        if self._fd is None:
+            self.logger.info(f"Polling {self.path} for changes every {self.poll_interval:g} s")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='config_watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def check(self) -> bool:
+        """Load and apply the file if its content changed, returns whether a new config was applied"""
+        digest = self._read_digest()
+        if digest is None or digest == self._digest:
+            return False
+        # Not tried again until it changes, whether it works or not
+        self._digest = digest
+        try:
+            config = self.load(self.path)
+        except Exception as e:
+            RELOADS.labels('invalid').inc()
+            self.logger.error(f"Kept the current config, {self.path} is invalid: {e!r}")
+            return False
+        try:
+            self.on_change(config)
+        except Exception as e:
+            RELOADS.labels('failed').inc()
+            self.logger.error(f"Could not apply the new config: {e!r}")
+            return False
+        RELOADS.labels('applied').inc()
+        return True
+
+    def _changed(self) -> bool:
+        """Wait up to poll_interval for the file to change"""
+        if self._fd is None:
+            if self._stop.wait(self.poll_interval):
+                return False
+            stat = self._read_stat()
+            if stat == self._stat:
+                return False
+            # Let the writes of the save settle, like the inotify events
+            self._stop.wait(self.debounce)
+            self._stat = self._read_stat()
+            return True
+        name = os.path.basename(self.path)
+        readable, _, _ = select.select([self._fd], [], [], self.poll_interval)
+        if not readable or name not in inotify_names(self._fd):
+            return False
+        # Saving may take a few writes, wait for them to settle
+        while select.select([self._fd], [], [], self.debounce)[0]:
+            inotify_names(self._fd)
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self._changed() and not self._stop.is_set():
+                    t_start = time.monotonic()
+                    if self.check():
+                        self.logger.info(f"Applied {self.path} in {(time.monotonic() - t_start) * 1000:.0f} ms")
+            except Exception as e:
+                self.logger.error(f"Config watcher failed: {e!r}")
+                self._stop.wait(self.poll_interval)
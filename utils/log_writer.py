@@ -0,0 +1,195 @@
+import glob
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import List
+
+
+class BufferedRotatingHandler(logging.Handler):
+    """Log file handler that writes in large batches, for SD cards.
+
+    Records are kept in memory and appended to the file with a single
+    write once buffer_size bytes are waiting, every flush_interval seconds,
+    or at once for records of flush_level and above, so an error is on disk
+    before whatever follows it. The file is never truncated: it is rotated
+    once it reaches max_bytes, the rotated segments are gzipped by a
+    background thread and the oldest ones deleted to keep the log and its
+    segments under max_total_bytes.
+    """
+
+    def __init__(self,
+                 filename: str,
+                 max_bytes: int = 1024 * 1024,
+                 max_total_bytes: int = 10 * 1024 * 1024,
+                 buffer_size: int = 64 * 1024,
+                 flush_interval: float = 30,
+                 flush_level: int = logging.ERROR,
+                 compress: bool = True):
+        """Initialize the handler, appending to the file if it exists
+
+        Args:
+            filename (str): The log file, segments are named <filename>.<time>[.gz].
+            max_bytes (int, optional): Size at which the file is rotated. Defaults to 1 MiB.
+            max_total_bytes (int, optional): Disk used by the file and its segments. Defaults to 10 MiB.
+            buffer_size (int, optional): Bytes kept in memory before writing. Defaults to 64 KiB.
+            flush_interval (float, optional): Max seconds a record waits in memory. Defaults to 30.
+            flush_level (int, optional): Records of this level and above are written at once.
+                Defaults to logging.ERROR.
+            compress (bool, optional): Gzip the rotated segments. Defaults to True.
+        """
+        super().__init__()
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.compress = compress
+
+        self._buffer: List[bytes] = []
+        self._buffered = 0
+        self._fd = self._open()
+        self._size = os.fstat(self._fd).st_size
+
+        # Segments waiting for the background thread, including any a crash left uncompressed
+        self._segments = [path for path in self.segments() if not path.endswith('.gz')]
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='log_writer', daemon=True)
+        self._thread.start()
+
+    def _open(self) -> int:
+        return os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def segments(self) -> List[str]:
+        """Rotated segments on disk, oldest first"""
+        return sorted(glob.glob(glob.escape(self.filename) + '.*[0-9]') +
+                      glob.glob(glob.escape(self.filename) + '.*[0-9].gz'))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            data = (self.format(record) + '\n').encode('utf-8', errors='replace')
+        except Exception:
+            self.handleError(record)
+            return
+        with self.lock:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            if record.levelno >= self.flush_level or self._buffered >= self.buffer_size:
+                self._write()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._write()
+
+    def _write(self) -> None:
+        """Write the buffer in one call, rotating first if it would not fit, must hold the lock"""
+        if not self._buffer or self._fd is None:
+            return
+        data = b''.join(self._buffer)
+        self._buffer.clear()
+        self._buffered = 0
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        try:
+            os.write(self._fd, data)
+            self._size += len(data)
+        except OSError:
+            # Dropped, the next write may succeed (e.g. once there is space again)
+            self._size = os.fstat(self._fd).st_size
+
+    def _rotate(self) -> None:
+        """Move the file aside and start a new one, must hold the lock"""
+        os.close(self._fd)
+        segment = f"{self.filename}.{time.strftime('%Y%m%d-%H%M%S')}"
+        suffix = 0
+        while os.path.exists(segment) or os.path.exists(segment + '.gz'):
+            suffix += 1
+            segment = f"{self.filename}.{time.strftime('%Y%m%d-%H%M%S')}-{suffix}"
+        try:
+            os.rename(self.filename, segment)
+            self._segments.append(segment)
+        except OSError:
+            pass
+        self._fd = self._open()
+        self._size = os.fstat(self._fd).st_size
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self._acquire():
+                return
+            try:
+                self._write()
+                segments, self._segments = self._segments, []
+            finally:
+                self.lock.release()
+            for segment in segments:
+                self._compress(segment)
+            if segments:
+                self._enforce_cap()
+            if self._closing:
+                return
+
+    def _acquire(self) -> bool:
+        """Take the lock, False once closing: logging.shutdown() holds it while it closes the handler"""
+        while not self.lock.acquire(timeout=0.1):
+            if self._closing:
+                return False
+        return True
+
+    def _compress(self, segment: str) -> None:
+        if not self.compress:
+            return
+        try:
+            with open(segment, 'rb') as source, gzip.open(segment + '.gz.tmp', 'wb', compresslevel=6) as target:
+                shutil.copyfileobj(source, target, 256 * 1024)
+            os.replace(segment + '.gz.tmp', segment + '.gz')
+            os.remove(segment)
+        except OSError:
+            # Kept uncompressed, it still counts towards the cap
+            pass
+
+    def _enforce_cap(self) -> None:
+        """Delete the oldest segments until the log fits max_total_bytes"""
+        segments = self.segments()
+        sizes = {}
+        for path in segments:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                sizes[path] = 0
+        total = self._size + sum(sizes.values())
+        for path in segments:
+            if total <= self.max_total_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= sizes[path]
+
+    def close(self) -> None:
+        """Write what is buffered, finish the pending compression and close the file"""
+        if self._thread.is_alive():
+            self._closing = True
+            self._wakeup.set()
+            self._thread.join()
+        with self.lock:
+            self._write()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            # Those the thread gave up on
+            segments, self._segments = self._segments, []
+        for segment in segments:
+            self._compress(segment)
+        if segments:
+            self._enforce_cap()
+        super().close()
+
@@ -1,11 +1,16 @@
 import html
+import io
 import json
 import logging
 import traceback
 import time
+from typing import TYPE_CHECKING, Optional
 
-from telegram import ParseMode, Update
-from telegram.ext import CallbackContext, Updater
+from utils.chat_sender import ChatSender
+from utils.log_writer import BufferedRotatingHandler
+
+if TYPE_CHECKING:
+    from telegram.ext import CallbackContext
 
 
 class DevChatLogger:
@@ -15,7 +20,14 @@ class DevChatLogger:
                  dev_chat_id: str,
                  chat_log_level=logging.ERROR,
                  file_log_level=logging.INFO,
-                 log_file='dev_chat_log.log'):
+                 log_file='dev_chat_log.log',
+                 chat_rate: float = 1.0,
+                 chat_queue_size: int = 200,
+                 log_max_bytes: int = 1024 * 1024,
+                 log_total_bytes: int = 10 * 1024 * 1024,
+                 log_flush_interval: float = 30,
+                 base_url: Optional[str] = None,
+                 shared_client: bool = False):
         """
         Initialize the DevChatLogger.
 
@@ -23,13 +35,28 @@ class DevChatLogger:
             dev_chat_id (int): The telegram chat id of the developer.
             chat_log_level (int): The minimum level of logger messages to send to the developer chat.
             terminal_log_level (int): The minimum level of logger messages to print to the terminal.
+            chat_rate (float): Max messages per second sent to the developer chat.
+            chat_queue_size (int): Messages waiting for the chat before new ones are dropped.
+            log_max_bytes (int): Size at which the log file is rotated and compressed.
+            log_total_bytes (int): Disk used by the log file and its compressed segments.
+            log_flush_interval (float): Max seconds a record waits in memory, errors are written at once.
+            base_url (str): Bot API server url, e.g. a self-hosted one. Defaults to Telegram's.
+            shared_client (bool): Wait for use_client() to send through the client of the bot instead of
+                creating one, the chat messages are queued until then.
         """
+        self.bot_token = bot_token
+        self.base_url = base_url
         self.dev_chat_id = dev_chat_id
+        # Buffered and appended to, so the log of a crashed run is kept and the SD card spared
+        self.file_handler = BufferedRotatingHandler(log_file,
+                                                    max_bytes=log_max_bytes,
+                                                    max_total_bytes=log_total_bytes,
+                                                    flush_interval=log_flush_interval)
         logging.basicConfig(
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
             level=file_log_level,
             handlers=[
-                logging.FileHandler(log_file, mode='w'),
+                self.file_handler,
                 logging.StreamHandler()
             ]
         )
@@ -37,10 +64,60 @@ class DevChatLogger:
 
         self.chat_log_level = chat_log_level
 
-        # Use the updater to send the messages
-        self.updater = Updater(bot_token, use_context=True)
+        # The messages are sent from a background thread so logging never blocks on the network
+        self.client = None
+        self.sender = ChatSender(None,
+                                 self.dev_chat_id,
+                                 rate=chat_rate,
+                                 max_queue=chat_queue_size)
+        if not shared_client:
+            self.use_client(self.own_client())
+
+    def own_client(self):
+        """A telegram.Bot of its own, on a small connection pool"""
+        # Just a bot, an updater would add a dispatcher and its workers
+        from telegram import Bot
+        from telegram.utils.request import Request
+        return Bot(self.bot_token, base_url=self.base_url, request=Request(con_pool_size=2))
+
+    def use_client(self, client) -> None:
+        """Send the chat messages through a Bot API client, e.g. one sharing the connections of the bot
 
-    def error_handler(self, update: object, context: CallbackContext) -> None:
+        Args:
+            client: A telegram.Bot or bot.async_telegram.BlockingTelegramClient of bot_token.
+        """
+        self.client = client
+        self.sender.attach(client)
+
+    def set_levels(self, chat_log_level: int, file_log_level: int) -> None:
+        """Change the log levels while running, e.g. from a reloaded config"""
+        self.chat_log_level = chat_log_level
+        logging.getLogger().setLevel(file_log_level)
+
+    def close(self) -> None:
+        """Send the queued chat messages and stop the sender"""
+        if self.client is None and self.sender.queue_depth:
+            # The bot never shared its client, e.g. it failed to start
+            self.use_client(self.own_client())
+        self.sender.stop()
+        self.file_handler.flush()
+
+    def send_report(self, title: str, summary: str, filename: str, content: str) -> None:
+        """Send a summary to the dev chat followed by the full content as a file, e.g. a profile"""
+        self.sender.send(f'<b>{html.escape(title)}</b>\n<pre>{html.escape(summary)}</pre>')
+        if self.client is None:
+            self.logger.warning(f"Could not send {filename} to the dev chat: no client yet")
+            return
+        # Files skip the queue, let the summary go first
+        self.sender.flush()
+        try:
+            self.client.send_document(self.dev_chat_id,
+                                      document=io.BytesIO(content.encode()),
+                                      filename=filename)
+        except self.sender.errors[2] as e:
+            self.logger.warning(f"Could not send {filename} to the dev chat: {e}")
+
+    def error_handler(self, update: object, context: 'CallbackContext') -> None:
         """Log the error and send a telegram message to notify the developer."""
         # Log the error before we do anything else, so we can see it even if something breaks.
         self.logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -51,8 +128,8 @@ class DevChatLogger:
         tb_string = ''.join(tb_list)
 
         # Build the message with some markup and additional information about what happened.
-        # You might need to add some logic to deal with messages longer than the 4096 character limit.
-        update_str = update.to_dict() if isinstance(update, Update) else str(update)
+        # The sender splits messages longer than the 4096 character limit.
+        update_str = update.to_dict() if hasattr(update, 'to_dict') else str(update)
         message = (
             f'An exception was raised while handling an update\n'
             f'<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}'
@@ -63,7 +140,7 @@ class DevChatLogger:
         )
 
         # Finally, send the message
-        context.bot.send_message(chat_id=self.dev_chat_id, text=message, parse_mode=ParseMode.HTML)
+        self.sender.send(message)
         self.error(msg=message)
 
     def __send_log_message(self, log_msg: str) -> None:
@@ -72,8 +149,8 @@ class DevChatLogger:
         # Add timestamp to the message
         chat_msg = f'{time.strftime("%Y-%m-%d %H:%M:%S")}: {log_msg}'
 
-        # use the updater to send the message to the dev chat
-        self.updater.bot.send_message(chat_id=self.dev_chat_id, text=log_msg, parse_mode=ParseMode.HTML)
+        # queue the message for the dev chat, sent in batches by the sender thread
+        self.sender.send(chat_msg)
 
     # python logger wrappers to log to the dev chat
     def debug(self, msg: str) -> None:
@@ -0,0 +1,335 @@
+import bisect
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Bucket bounds in seconds, from sub-millisecond probes to multi-minute boots
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300)
+INF_LABEL = 'le="+Inf"'
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    """A named metric with one child per combination of label values"""
+
+    kind = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values) -> object:
+        """The child for the given label values, created on first use"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.label_names):
+                raise ValueError(f"{self.name} takes the labels {self.label_names}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        """The child of a metric without labels"""
+        return self.labels()
+
+    def children(self) -> List[Tuple[Tuple[str, ...], object]]:
+        with self._lock:
+            return list(self._children.items())
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. commands handled"""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self._default().inc(amount)
+
+    def render(self) -> List[str]:
+        return [f'{self.name}_total{_format_labels(self.label_names, key)} {_format_value(child.value)}'
+                for key, child in self.children()]
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Read the value from function when the metrics are collected"""
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. the depth of a queue"""
+
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self._default().set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._default().set_function(function)
+
+    def render(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.label_names, key)} {_format_value(child.get())}'
+                for key, child in self.children()]
+
+
+class _HistogramChild:
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = bounds
+        # One count per bucket plus the +Inf one, not cumulative
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> '_Timer':
+        """Context manager observing the seconds spent in its block"""
+        return _Timer(self)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile, an estimate"""
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        rank = q * count
+        seen = 0
+        for bound, bucket in zip(self.bounds, counts):
+            seen += bucket
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class _Timer:
+    def __init__(self, histogram: _HistogramChild):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.t_start)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies, in fixed buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._default().observe(value)
+
+    def time(self) -> _Timer:
+        return self._default().time()
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, child in self.children():
+            with child._lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, INF_LABEL)} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """Holds the metrics of the process and renders them.
+
+    Metrics are created once, usually at import time, and updated in place:
+    recording a value is a dict lookup and a short lock, cheap enough to
+    leave on all the time.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, help: str, labels: Sequence[str], **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.label_names != tuple(labels):
+                raise ValueError(f"Metric {name} already registered as a different metric")
+            return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def metrics(self) -> List[_Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """A short human readable summary, e.g. for a chat message"""
+        lines = []
+        for metric in self.metrics():
+            for key, child in sorted(metric.children()):
+                label = metric.name + (f"[{','.join(key)}]" if key else '')
+                if isinstance(metric, Histogram):
+                    if not child.count:
+                        continue
+                    lines.append(f'{label}: n={child.count} mean={child.sum / child.count * 1000:.1f}ms '
+                                 f'p50<={child.quantile(0.5) * 1000:g}ms p99<={child.quantile(0.99) * 1000:g}ms')
+                elif isinstance(metric, Gauge):
+                    lines.append(f'{label}: {_format_value(child.get())}')
+                elif child.value:
+                    lines.append(f'{label}: {_format_value(child.value)}')
+        return '\n'.join(lines) if lines else 'No metrics recorded yet'
+
+
+# Registry of the bot process, the modules register their metrics here
+REGISTRY = MetricsRegistry()
+
+
+class MetricsServer:
+    """Serves the registry to Prometheus on ``GET /metrics``"""
+
+    def __init__(self,
+                 registry: MetricsRegistry = REGISTRY,
+                 listen: str = '127.0.0.1',
+                 port: int = 9464,
+                 logger=None):
+        """Initialize the server
+
+        Args:
+            registry (MetricsRegistry, optional): The metrics to serve. Defaults to REGISTRY.
+            listen (str, optional): Address to bind. Defaults to '127.0.0.1'.
+            port (int, optional): Port to bind, 0 picks a free one. Defaults to 9464.
+        """
+        # Only loaded when the metrics are served, every module imports the registry
+        from http.server import ThreadingHTTPServer
+
+        self.registry = registry
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+        self.httpd = ThreadingHTTPServer((listen, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """The port the server is bound to"""
+        return self.httpd.server_address[1]
+
+    def _make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+
+        server = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = server.registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                # The default handler writes every request to stderr
+                pass
+
+        return MetricsHandler
+
+    def start(self) -> None:
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        self.logger.info(f"Serving metrics on port {self.port}")
+
+    def stop(self) -> None:
+        """Stop serving"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,280 @@
+"""On-demand profilers for the running bot, toggled from the dev chat.
+
+CPUProfiler samples the stacks of every thread from a thread of its own
+and charges them the CPU time the thread used in between.
+Nothing is hooked into the profiled code, so it costs nothing while it is
+stopped. MemoryProfiler wraps tracemalloc, which only slows down the
+allocations while it traces.
+"""
+import inspect
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable, Dict, Iterable, NamedTuple, Optional
+
+# Innermost frames of a thread parked waiting for work, not counted
+IDLE_FILES = ('threading.py', 'queue.py', 'selectors.py', 'socketserver.py')
+
+
+class ProfileReport(NamedTuple):
+    """Top entries for the chat and the full results for a file"""
+    summary: str
+    dump: str
+
+
+def code_label(code) -> str:
+    """Name of a function and where it is defined"""
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def thread_group(name: str) -> str:
+    """Thread name with the numbers masked, so the workers of a pool add up"""
+    return re.sub(r'\d+', 'N', name)
+
+
+def handler_codes(callbacks: Iterable[Callable]) -> Dict[object, str]:
+    """Code objects of the handlers, under their decorators, to attribute the samples to them"""
+    codes = {}
+    for callback in callbacks:
+        function = inspect.unwrap(callback)
+        codes[function.__code__] = function.__name__
+    return codes
+
+
+def table(counts: Counter, total: int, top: Optional[int]) -> str:
+    return '\n'.join(f"{count / total * 100:5.1f}% {label}" for label, count in counts.most_common(top))
+
+
+class CPUProfiler:
+    """Sampling profiler of all the threads of the process.
+
+    Every interval the stack of each thread is read with
+    sys._current_frames() and charged with the CPU time the thread used
+    since the previous sample, from its own CPU clock, so threads waiting on
+    a socket or a lock cost nothing. Where the thread CPU clocks are missing
+    the samples are counted instead, skipping the threads parked waiting for
+    work. The stacks running one of the handlers are also charged to it, so
+    the slow commands show up next to the slow functions.
+    """
+
+    def __init__(self,
+                 interval: float = 0.005,
+                 max_duration: float = 600,
+                 handlers: Optional[Dict[object, str]] = None,
+                 logger=None):
+        """Initialize the profiler, nothing runs until start()
+
+        Args:
+            interval (float, optional): Seconds between samples. Defaults to 0.005.
+            max_duration (float, optional): Seconds after which the sampling stops on its own. Defaults to 600.
+            handlers (Dict[object, str], optional): Name of the handlers by their code object. Defaults to None.
+        """
+        self.interval = interval
+        self.max_duration = max_duration
+        self.handlers = dict(handlers or {})
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self._samples: Optional[Counter] = None
+        self._duration = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: Optional[float] = None) -> bool:
+        """Start sampling, returns False if it already runs or has results waiting for stop()
+
+        Raises:
+            ValueError: If the interval is not positive.
+        """
+        if interval is not None and not interval > 0:
+            raise ValueError(f"The sampling interval must be positive, got {interval}")
+        with self._lock:
+            if self._samples is not None:
+                return False
+            if interval is not None:
+                self.interval = interval
+            self._samples = Counter()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='cpu_profiler', daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self) -> Optional[ProfileReport]:
+        """Stop sampling and return the results, None if it was not started"""
+        with self._lock:
+            if self._samples is None:
+                return None
+            self._stop.set()
+            self._thread.join()
+            samples, self._samples = self._samples, None
+        return self.report(samples, self._duration)
+
+    @staticmethod
+    def thread_cpu(ident: int) -> Optional[float]:
+        """CPU seconds used by a thread, None if its clock can't be read"""
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            return None
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        samples = self._samples
+        cpu: Dict[int, float] = {}
+        t_start = time.monotonic()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                used = self.thread_cpu(ident)
+                if used is None:
+                    weight = 0.0 if os.path.basename(frame.f_code.co_filename) in IDLE_FILES else self.interval
+                else:
+                    # A thread seen for the first time has no interval to charge yet
+                    weight = used - cpu.get(ident, used)
+                    cpu[ident] = used
+                if weight <= 0:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                samples[(thread_group(names.get(ident, '?')), tuple(reversed(stack)))] += weight
+            self._duration = time.monotonic() - t_start
+            if self._duration >= self.max_duration:
+                self.logger.info(f"CPU profiling stopped after {self._duration:.0f} s, /profile stop for the results")
+                break
+
+    def report(self, samples: Counter, duration: float, top: int = 10) -> ProfileReport:
+        """Summary of the top functions, handlers and threads, and the full tables with the collapsed stacks"""
+        total = sum(samples.values())
+        header = f"{total:.2f} s of CPU in {duration:.1f} s, sampled every {self.interval * 1000:.0f} ms"
+        if not total:
+            return ProfileReport(header, header)
+
+        own, cumulative, handlers, threads = Counter(), Counter(), Counter(), Counter()
+        labels: Dict[object, str] = {}
+        for (group, stack), seconds in samples.items():
+            for code in stack:
+                if code not in labels:
+                    labels[code] = code_label(code)
+            own[labels[stack[-1]]] += seconds
+            for label in {labels[code] for code in stack}:
+                cumulative[label] += seconds
+            handler = next((self.handlers[code] for code in stack if code in self.handlers), None)
+            handlers[handler or f'({group})'] += seconds
+            threads[group] += seconds
+
+        def sections(top: Optional[int]) -> str:
+            return (f"{header}\n\nself:\n{table(own, total, top)}"
+                    f"\n\ncumulative:\n{table(cumulative, total, top)}"
+                    f"\n\nhandlers:\n{table(handlers, total, top)}"
+                    f"\n\nthreads:\n{table(threads, total, top)}")
+
+        # One line per stack with its CPU microseconds, the input of flamegraph.pl and speedscope
+        collapsed = '\n'.join(f"{group};{';'.join(labels[code] for code in stack)} {seconds * 1e6:.0f}"
+                               for (group, stack), seconds in samples.most_common())
+        return ProfileReport(sections(top), f"{sections(None)}\n\ncollapsed stacks:\n{collapsed}\n")
+
+
+class MemoryProfiler:
+    """tracemalloc snapshots compared to the one taken when tracing started"""
+
+    # Allocations of the profiling itself
+    IGNORED = (tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+               tracemalloc.Filter(False, '<unknown>'))
+
+    def __init__(self, frames: int = 1):
+        """Initialize the profiler, nothing is traced until start()
+
+        Args:
+            frames (int, optional): Frames kept of the traceback of each allocation, each one
+                slows down the allocations further. Defaults to 1.
+        """
+        self.frames = frames
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._started = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._baseline is not None
+
+    def start(self, frames: Optional[int] = None) -> bool:
+        """Start tracing, returns False if tracemalloc already traces
+
+        Raises:
+            ValueError: If frames is not in the range tracemalloc takes, 1 to 65535.
+        """
+        with self._lock:
+            if tracemalloc.is_tracing():
+                return False
+            # Raises before tracing on a bad number of frames
+            tracemalloc.start(self.frames if frames is None else frames)
+            if frames is not None:
+                self.frames = frames
+            self._baseline = tracemalloc.take_snapshot().filter_traces(self.IGNORED)
+            self._started = time.monotonic()
+        return True
+
+    def snapshot(self, top: int = 10) -> Optional[ProfileReport]:
+        """Compare the memory to when tracing started, None if it is not tracing"""
+        with self._lock:
+            if self._baseline is None:
+                return None
+            return self._report(top)
+
+    def stop(self, top: int = 10) -> Optional[ProfileReport]:
+        """Take a last snapshot and stop tracing, None if it was not tracing"""
+        with self._lock:
+            if self._baseline is None:
+                return None
+            try:
+                return self._report(top)
+            finally:
+                self._baseline = None
+                tracemalloc.stop()
+
+    def _report(self, top: int) -> ProfileReport:
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.IGNORED)
+        current, peak = tracemalloc.get_traced_memory()
+        header = (f"traced {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB, "
+                  f"after {time.monotonic() - self._started:.0f} s")
+
+        growth = [stat for stat in snapshot.compare_to(self._baseline, 'lineno') if stat.size_diff]
+        growth.sort(key=lambda stat: stat.size_diff, reverse=True)
+        largest = snapshot.statistics('lineno')
+
+        def lines(stats, diff: bool) -> str:
+            rows = []
+            for stat in stats:
+                frame = stat.traceback[0]
+                where = f"{os.path.join(*frame.filename.split(os.sep)[-2:])}:{frame.lineno}"
+                if diff:
+                    rows.append(f"{stat.size_diff / 1024:+9.1f} KiB {stat.count_diff:+7d} blocks {where}")
+                else:
+                    rows.append(f"{stat.size / 1024:9.1f} KiB {stat.count:7d} blocks {where}")
+            return '\n'.join(rows)
+
+        summary = (f"{header}\n\ngrowth since start:\n{lines(growth[:top], True)}"
+                   f"\n\nlargest:\n{lines(largest[:top], False)}")
+        blocks = []
+        for stat in snapshot.statistics('traceback')[:100]:
+            # Without the source lines, reading them would fill linecache and the next snapshot
+            frames = [f"  {frame.filename}:{frame.lineno}" for frame in stat.traceback]
+            blocks.append('\n'.join([f"{stat.size / 1024:.1f} KiB in {stat.count} blocks"] + frames))
+        tracebacks = '\n\n'.join(blocks)
+        dump = (f"{header}\n\ngrowth since start:\n{lines(growth, True)}"
+                f"\n\nlargest:\n{lines(largest, False)}\n\nlargest tracebacks:\n{tracebacks}\n")
+        return ProfileReport(summary, dump)
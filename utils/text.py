@@ -0,0 +1,33 @@
+import html
+from typing import Iterable, List
+
+# Longest text accepted by sendMessage
+TELEGRAM_MAX_LENGTH = 4096
+
+
+def split_message(text: str, limit: int = TELEGRAM_MAX_LENGTH) -> List[str]:
+    """Split a text in chunks of at most limit characters, at line breaks when possible"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def render_output(title: str, lines: Iterable[str], status: str = '') -> str:
+    """HTML message with a title, the last output lines that fit and a status"""
+    head = f'<b>{html.escape(title)}</b>\n'
+    tail = f'\n{html.escape(status)}' if status else ''
+    room = TELEGRAM_MAX_LENGTH - len(head) - len(tail) - len('<pre></pre>')
+    output = ''
+    for line in reversed(list(lines)):
+        line = html.escape(line)
+        if len(output) + len(line) + 1 > room:
+            break
+        output = f'{line}\n{output}' if output else line
+    return f'{head}<pre>{output or " "}</pre>{tail}'